@@ -1,5 +1,4 @@
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 import os
 from flask.ext.login import LoginManager    # Flask-Login extension will handle users logged in state
 from flask.ext.openid import OpenID         # Flask-OpenID extension will handle authentication
@@ -11,7 +10,10 @@ app = Flask(__name__)
 # all the config information from config.py. We can access that information like this:
 #    app.config['CONFIG_ITEM_NAME']     e.g.: app.config['OPENID_PROVIDERS']
 app.config.from_object('config')
-db = SQLAlchemy(app)
+# Flask-SQLAlchemy, with SQLite tuned for concurrent access and the reads of read-only views going to separate
+# connections (see engine.py)
+from .engine import RoutingSQLAlchemy
+db = RoutingSQLAlchemy(app)
 
 # initialization for Flask-Mail
 from flask.ext.mail import Mail
@@ -34,6 +36,13 @@ from app import views   # Decorators in views.py will cause the routes to be map
                         # And when the request comes from the browser via those routes the appropriate function
                         # will be called to supply the response.
 from app import models
+from app import sqlstats   # counts the SQL statements of each request (see sqlstats.py)
+from app import search     # full text search index, created together with the post table (see search.py)
+from app import fragments  # cache of rendered posts, the render_post() template function (see fragments.py)
+from app import api        # the JSON API, /api/v1/... (see api.py)
+from app import metrics    # request metrics for Prometheus on /metrics, slow request log (see metrics.py)
+from app import sampler    # sampling profiler, switched on at runtime from /admin/profiler (see sampler.py)
+from app import export     # export of the data of a user, /user/<nickname>/export (see export.py)
 
 # Normally, error messages are displayed to stderr.
 # Here we will set up a logger that will send us an email every time an error occurrs, and we will also
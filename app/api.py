@@ -0,0 +1,160 @@
+# Version 1 of the JSON API.
+#
+# Until now the only way for a program to get our posts was to scrape the HTML pages. The API gives the same data
+# as the index and profile pages, as JSON, built on the same queries (timeline.home_timeline(), User.posts) and
+# with the same cursors (see pagination.py):
+#     /api/v1/timeline                        the home timeline of the logged in user
+#     /api/v1/users/<nickname>/posts          the posts of a user
+#     /api/v1/users/<nickname>/followers      the followers of a user
+# A page is a JSON object with the items and the cursor of the next page:
+#     {"posts": [...], "next": "20141219103011000000-42", "next_url": "http://.../api/v1/timeline?before=..."}
+# With ?format=ndjson the whole list (from the cursor on) is streamed instead, one JSON object per line. The rows
+# are read from the database in batches (yield_per) while the response is being sent, so the memory used doesn't
+# grow with the size of the list. The API uses the same login (session cookie) as the web pages.
+import json
+from functools import wraps
+from itertools import chain
+from flask import g, request, jsonify, url_for, Response, stream_with_context
+from app import app, db
+from .models import User, Post, ArchivedPost, post_rows, followers
+from . import timeline, archive
+from .pagination import make_cursor, newest_first, merge_newest_first
+from .decorators import read_only
+
+
+def api_login_required(f):
+    """ Like login_required of Flask-Login, but answers with 401 instead of redirecting to the login page. """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.user.is_authenticated():
+            return jsonify({'error': 'Authentication required.'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def page_size():
+    limit = request.args.get('limit', app.config.get('API_PAGE_SIZE', 50), type=int)
+    return max(1, min(limit, app.config.get('API_MAX_PAGE_SIZE', 200)))
+
+
+def streaming():
+    return request.args.get('format') == 'ndjson'
+
+
+def stream(queries, to_json, merge=None):
+    """ Streams the rows as NDJSON (one JSON object per line).
+    :param queries: a query, or a list of queries that are sent one after the other; they're read from the
+                    database in batches, while the response is being sent
+    :param to_json: function that turns a row into a dictionary
+    :param merge: function that merges the rows of the queries into one stream (e.g. merge_newest_first), instead
+                  of sending them one after the other
+    """
+    if not isinstance(queries, list):
+        queries = [queries]
+
+    def generate():
+        batch_size = app.config.get('API_STREAM_BATCH_SIZE', 500)
+        results = [query.execution_options(stream_results=True).yield_per(batch_size) for query in queries]
+        for row in merge(results) if merge is not None else chain.from_iterable(results):
+            yield json.dumps(to_json(row)) + '\n'
+    # the database session has to stay alive until the last row is sent, so we keep the request context
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def post_json(post):
+    """
+    :param post: a PostRow (see models.py)
+    """
+    return {'id': post.id,
+            'body': post.body,
+            'timestamp': post.timestamp.isoformat() + 'Z',
+            'language': post.known_language,
+            'author': {'nickname': post.author_nickname,
+                       'avatar': post.author_avatar(128),
+                       'url': url_for('api_user_posts', nickname=post.author_nickname, _external=True)}}
+
+
+def user_json(user):
+    return {'id': user.id,
+            'nickname': user.nickname,
+            'about_me': user.about_me,
+            'avatar': user.avatar(128),
+            'url': url_for('api_user_posts', nickname=user.nickname, _external=True)}
+
+
+def posts_response(query, endpoint, archive=None, keys=(Post.timestamp, Post.id), **values):
+    """ Answers with a page of posts, or with all of them as NDJSON.
+    :param query: a query of posts, in any order
+    :param endpoint: endpoint of the list, for the URL of the next page
+    :param archive: the same query over the archived posts (see archive.py), merged with the posts of the query
+    :param keys: the timestamp and id columns the query is sorted by (see timeline.home_timeline_keys)
+    """
+    before = request.args.get('before')
+    tiers = [post_rows(newest_first(query, before, *keys))]
+    # the archive is read only if the user (or the users he follows) has any archived posts at all
+    if archive is not None and db.session.query(archive.order_by(None).exists()).scalar():
+        tiers.append(post_rows(newest_first(archive, before, ArchivedPost.timestamp, ArchivedPost.id), ArchivedPost))
+    if streaming():
+        return stream(tiers, post_json, merge=merge_newest_first)
+    limit = page_size()
+    # one row more from each tier, to see if there's another page; any of them can have the posts of the page
+    rows = list(merge_newest_first(tier.limit(limit + 1).all() for tier in tiers))[:limit + 1]
+    result = {'posts': [post_json(row) for row in rows[:limit]], 'next': None, 'next_url': None}
+    if len(rows) > limit:
+        result['next'] = make_cursor(rows[limit - 1])
+        result['next_url'] = url_for(endpoint, before=result['next'], limit=limit, _external=True, **values)
+    return jsonify(result)
+
+
+def get_user(nickname):
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        return None, (jsonify({'error': 'User {} not found.'.format(nickname)}), 404)
+    return user, None
+
+
+@app.route('/api/v1/timeline')
+@api_login_required
+@read_only
+def api_timeline():
+    home_timeline, timestamp_column, id_column = timeline.home_timeline_keys(g.user)
+    return posts_response(home_timeline, 'api_timeline', archive.followed_posts(g.user) if archive.enabled() else None,
+                          (timestamp_column, id_column))
+
+
+@app.route('/api/v1/users/<nickname>/posts')
+@api_login_required
+@read_only
+def api_user_posts(nickname):
+    user, error = get_user(nickname)
+    if error:
+        return error
+    return posts_response(user.posts, 'api_user_posts', archive.user_posts(user) if archive.enabled() else None,
+                          nickname=nickname)
+
+
+@app.route('/api/v1/users/<nickname>/followers')
+@api_login_required
+@read_only
+def api_followers(nickname):
+    """ The followers of a user, in the order of their ids. The cursor is the id of the last follower on the page. """
+    user, error = get_user(nickname)
+    if error:
+        return error
+    # sorted by the column of the followers table, so the page is read from ix_followers_followed_id in order
+    query = User.query.join(followers, followers.c.follower_id == User.id).\
+        filter(followers.c.followed_id == user.id, User.id != user.id).\
+        order_by(followers.c.follower_id)   # every user follows himself
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.filter(followers.c.follower_id > after)
+    if streaming():
+        return stream(query, user_json)
+    limit = page_size()
+    rows = query.limit(limit + 1).all()
+    result = {'followers': [user_json(row) for row in rows[:limit]], 'next': None, 'next_url': None}
+    if len(rows) > limit:
+        result['next'] = rows[limit - 1].id
+        result['next_url'] = url_for('api_followers', nickname=nickname, after=result['next'], limit=limit,
+                                     _external=True)
+    return jsonify(result)
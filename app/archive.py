@@ -0,0 +1,78 @@
+# Hot/cold storage of the posts.
+#
+# Almost all the traffic reads the newest pages of the timelines and the profiles, but the post table (and its
+# indexes) keeps growing, and so does the part of it the database has to keep in memory. So the posts older than
+# POST_ARCHIVE_AGE_DAYS are moved to the post_archive table by ./archive_posts.py (run it from cron), in batches of
+# POST_ARCHIVE_BATCH_SIZE posts, one transaction each, so the application can keep running. The post table stays
+# small, and the pages everybody reads only touch the post table.
+#
+# The pages read the archive only when they have to: the query of the validators (see conditional.py) also tells
+# if the page has any archived posts at all. If it has, KeysetPage (see pagination.py) reads a page from the post
+# table and one from the archive, with the same cursor, and merges them - the post table can have posts older than
+# some archived ones (the archiver hasn't run yet, or the posts were imported). The API does the same.
+#
+# The archive is cold storage: archived posts are not in the materialized timelines (the home page reads them from
+# the archive with the join over followers). They have a full text index of their own (see search.py), and their
+# authors can still delete them.
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_
+from app import app, db
+from .models import Post, ArchivedPost, followers, timeline
+
+
+def enabled():
+    return app.config.get('POST_ARCHIVE_ENABLED', True)
+
+
+def cutoff(age_days=None, now=None):
+    """
+    :param age_days: posts older than this many days are archived, defaults to POST_ARCHIVE_AGE_DAYS
+    :return: the time before which the posts are archived
+    """
+    if age_days is None:
+        age_days = app.config.get('POST_ARCHIVE_AGE_DAYS', 365)
+    return (now or datetime.utcnow()) - timedelta(days=age_days)
+
+
+def archive_posts(age_days=None, batch_size=None):
+    """ Moves the old posts from the post table to the archive.
+    :param age_days: posts older than this many days are archived, defaults to POST_ARCHIVE_AGE_DAYS
+    :param batch_size: number of posts moved in one transaction, defaults to POST_ARCHIVE_BATCH_SIZE
+    :return: number of posts archived
+    """
+    before = cutoff(age_days)
+    batch_size = batch_size or app.config.get('POST_ARCHIVE_BATCH_SIZE', 1000)
+    posts = Post.__table__
+    columns = [posts.c.id, posts.c.body, posts.c.timestamp, posts.c.user_id, posts.c.language]
+    archived = 0
+    # The ids of the archived posts are never given to new posts, the post table is AUTOINCREMENT (see models.py).
+    while True:
+        with db.engine.begin() as connection:
+            ids = [post_id for (post_id,) in connection.execute(
+                select([posts.c.id]).where(posts.c.timestamp < before).order_by(posts.c.id).limit(batch_size))]
+            if not ids:
+                break
+            # the batch is the old posts up to the last id we got (not IN (ids), SQLite has a limit on parameters)
+            batch = and_(posts.c.timestamp < before, posts.c.id <= ids[-1])
+            connection.execute(ArchivedPost.__table__.insert().from_select(
+                [column.name for column in columns], select(columns).where(batch)))
+            connection.execute(timeline.delete().where(timeline.c.post_id.in_(select([posts.c.id]).where(batch))))
+            # the triggers move the posts from the full text index of the posts to the one of the archive (search.py)
+            connection.execute(posts.delete().where(batch))
+        archived += len(ids)
+    return archived
+
+
+def user_posts(user):
+    """
+    :return: query of the archived posts of the user, the archive's version of user.posts
+    """
+    return ArchivedPost.query.filter(ArchivedPost.user_id == user.id)
+
+
+def followed_posts(user):
+    """
+    :return: query of the archived posts of the users the user follows, the archive's version of followed_posts()
+    """
+    return ArchivedPost.query.join(followers, followers.c.followed_id == ArchivedPost.user_id).\
+        filter(followers.c.follower_id == user.id)
@@ -0,0 +1,259 @@
+# Bulk import of users, posts and follow relationships (./bulk_import.py is the command line).
+#
+# Creating users through after_login() and posts through index() is one transaction per row, with all the indexes,
+# the full text triggers and the timeline fan-out on the way. That's fine for a person using the site, and hopeless
+# for loading an existing community of a few million rows. Here:
+#     - the files are read as a stream (NDJSON, one JSON object per line, or CSV with a header line), so their
+#       size doesn't matter,
+#     - the rows go in with executemany, BULK_IMPORT_BATCH_SIZE rows per transaction, around the ORM,
+#     - the indexes that the import doesn't need (posts by author, followers by followed user) and the full text
+#       triggers are dropped during the import, and built once at the end, which is much faster than keeping them
+#       up to date row by row. The timelines are rebuilt at the end too (if they're switched on),
+#     - nickname collisions are resolved for the whole batch with a few queries (User.make_unique_nicknames),
+#     - every batch also writes the position in the file to the import_checkpoint table, in the same transaction,
+#       and an interrupted import continues from there when it's started again. The checkpoint is committed
+#       together with the rows it counts, so no batch is imported twice (which would duplicate the posts).
+#
+# The users are identified by their email in all the files:
+#     users:   nickname, email, about_me, last_seen          (nickname defaults to the part of the email before @)
+#     posts:   email, body, timestamp, language              (the email of the author)
+#     follows: follower, followed                            (the emails of both users)
+# Rows with users we don't know are skipped, so are users whose email is already in the database - which also
+# makes running the same users or follows file again harmless. Every imported user follows himself, like the ones
+# created by after_login().
+# Don't run this while the application is running: its caches (follow graph, users) don't see the import.
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import inspect, text, select, and_
+from app import app, db
+from .models import User, Post, followers, import_checkpoint, email_hash, follow_graph
+from .usercache import user_cache
+from .conditional import touch_users
+from . import search, timeline
+
+KINDS = ('users', 'follows', 'posts')       # in this order, the posts and follows need the users
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+# maximum number of parameters of an IN (...), SQLite doesn't allow more than 999 parameters in a statement
+IN_CHUNK_SIZE = 500
+
+
+def read_rows(path):
+    """ Reads a file one row at a time.
+    :param path: name of a CSV file (.csv) or an NDJSON file (anything else)
+    :return: generator of dictionaries, one per row
+    """
+    with io.open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield dict((key, value if value != '' else None) for key, value in row.items())
+        else:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    raise ValueError('{}, line {}: {}'.format(path, number, e))
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def parse_time(value):
+    """
+    :param value: a time in the ISO format (2014-12-19T10:30:11.123456Z, also with a space instead of T)
+    :return: the time as datetime, None if there's no value
+    """
+    if not value:
+        return None
+    value = value.rstrip('Z')
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: {}'.format(value))
+
+
+def user_ids(connection, emails):
+    """
+    :return: dictionary email -> user id, for the emails that belong to users in the database
+    """
+    emails = list(set(email for email in emails if email))
+    result = {}
+    users = User.__table__
+    for start in range(0, len(emails), IN_CHUNK_SIZE):
+        result.update((email, user_id) for user_id, email in connection.execute(
+            users.select().with_only_columns([users.c.id, users.c.email]).
+            where(users.c.email.in_(emails[start:start + IN_CHUNK_SIZE]))))
+    return result
+
+
+def load_users(connection, rows):
+    """ Inserts a batch of users, together with their self-follows.
+    :return: number of users inserted
+    """
+    existing = user_ids(connection, [row.get('email') for row in rows])
+    new_rows = {}
+    for row in rows:
+        email = row.get('email')
+        if email and email not in existing and email not in new_rows:
+            new_rows[email] = row
+    if not new_rows:
+        return 0
+    rows = list(new_rows.values())
+    nicknames = User.make_unique_nicknames([row.get('nickname') or row['email'].split('@')[0] for row in rows])
+    connection.execute(User.__table__.insert(),
+                       [{'nickname': nickname, 'email': row['email'], 'avatar_hash': email_hash(row['email']),
+                         'about_me': row.get('about_me'), 'last_seen': parse_time(row.get('last_seen')),
+                         'timeline_pull': False}
+                        for row, nickname in zip(rows, nicknames)])
+    # executemany doesn't tell us the new ids, so we read them back
+    ids = user_ids(connection, list(new_rows))
+    connection.execute(followers.insert(), [{'follower_id': user_id, 'followed_id': user_id}
+                                            for user_id in ids.values()])
+    return len(rows)
+
+
+def load_posts(connection, rows):
+    """
+    :return: number of posts inserted
+    """
+    authors = user_ids(connection, [row.get('email') for row in rows])
+    now = datetime.utcnow()
+    values = [{'body': row['body'], 'user_id': authors[row['email']], 'language': row.get('language'),
+               'timestamp': parse_time(row.get('timestamp')) or now}
+              for row in rows if row.get('email') in authors and row.get('body')]
+    if values:
+        connection.execute(Post.__table__.insert(), values)
+        touch_users(connection, [value['user_id'] for value in values])   # old posts don't change the newest one
+    return len(values)
+
+
+def load_follows(connection, rows):
+    """
+    :return: number of follow relationships inserted (the ones we already have are left alone)
+    """
+    users = user_ids(connection, [row.get(key) for row in rows for key in ('follower', 'followed')])
+    values = [{'follower_id': users[row['follower']], 'followed_id': users[row['followed']]}
+              for row in rows if row.get('follower') in users and row.get('followed') in users]
+    if not values:
+        return 0
+    return connection.execute(followers.insert().prefix_with('OR IGNORE'), values).rowcount
+
+
+LOADERS = {'users': load_users, 'posts': load_posts, 'follows': load_follows}
+
+
+def read_checkpoint(kind, path):
+    """
+    :return: number of rows of the file that were already imported, according to its checkpoint
+    """
+    with db.engine.connect() as connection:
+        rows = connection.execute(select([import_checkpoint.c.rows]).
+                                  where(and_(import_checkpoint.c.path == os.path.abspath(path),
+                                             import_checkpoint.c.kind == kind))).scalar()
+    return rows or 0
+
+
+def write_checkpoint(connection, kind, path, rows):
+    """ Records that the first rows of the file are imported. Called in the transaction of the batch. """
+    connection.execute(import_checkpoint.insert().prefix_with('OR REPLACE'),
+                       {'path': os.path.abspath(path), 'kind': kind, 'rows': rows})
+
+
+def clear_checkpoint(path):
+    with db.engine.begin() as connection:
+        connection.execute(import_checkpoint.delete().where(import_checkpoint.c.path == os.path.abspath(path)))
+
+
+def load_file(kind, path, batch_size=None, resume=True, progress=None):
+    """ Imports one file.
+    :param kind: 'users', 'posts' or 'follows'
+    :param path: name of the file
+    :param batch_size: number of rows in one transaction, defaults to BULK_IMPORT_BATCH_SIZE
+    :param resume: continue after the rows imported by an earlier, interrupted run
+    :param progress: function that is called with (kind, stats) every BULK_IMPORT_REPORT_INTERVAL seconds
+    :return: dictionary with the numbers of rows read, inserted and skipped (not inserted), and the seconds it took
+    """
+    batch_size = batch_size or app.config.get('BULK_IMPORT_BATCH_SIZE', 5000)
+    interval = app.config.get('BULK_IMPORT_REPORT_INTERVAL', 5)
+    done = read_checkpoint(kind, path) if resume else 0
+    stats = {'rows': 0, 'inserted': 0, 'skipped': 0, 'seconds': 0.0, 'resumed_at': done}
+    start = last_report = time.time()
+    for batch in batches(islice(read_rows(path), done, None), batch_size):
+        with db.engine.begin() as connection:
+            inserted = LOADERS[kind](connection, batch)
+            write_checkpoint(connection, kind, path, done + stats['rows'] + len(batch))
+        stats['rows'] += len(batch)
+        stats['inserted'] += inserted
+        stats['skipped'] += len(batch) - inserted
+        stats['seconds'] = time.time() - start
+        if progress is not None and time.time() - last_report >= interval:
+            progress(kind, stats)
+            last_report = time.time()
+    stats['seconds'] = time.time() - start
+    clear_checkpoint(path)      # the whole file is in, next time it starts from the beginning
+    return stats
+
+
+def deferred_indexes():
+    """
+    :return: the indexes that the import doesn't need, they're built after the import
+    """
+    return list(Post.__table__.indexes) + list(followers.indexes)
+
+
+def drop_indexes():
+    with db.engine.begin() as connection:
+        search.drop_triggers(connection)
+        for index in deferred_indexes():
+            if index.name in [ix['name'] for ix in inspect(connection).get_indexes(index.table.name)]:
+                index.drop(connection)
+
+
+def build_indexes():
+    """ Builds everything that was switched off for the import: the indexes, the full text index and its
+    triggers, the timelines. Also throws out the cached data that the import made stale.
+    """
+    with db.engine.begin() as connection:
+        for index in deferred_indexes():
+            if index.name not in [ix['name'] for ix in inspect(connection).get_indexes(index.table.name)]:
+                index.create(connection)
+        connection.execute(text('ANALYZE'))     # the statistics the query planner uses to pick the indexes
+    search.rebuild()
+    if timeline.enabled():
+        timeline.backfill()
+    follow_graph.clear()
+    user_cache.clear()
+
+
+def import_files(files, batch_size=None, resume=True, progress=None):
+    """ Imports the files. When there are posts or follows to import, the indexes are dropped first and built
+    again at the end, also if the import fails or is interrupted (it can be continued later).
+    :param files: dictionary kind -> file name, kind is 'users', 'posts' or 'follows'
+    :return: dictionary kind -> the stats returned by load_file
+    """
+    result = {}
+    deferred = bool(files.get('posts') or files.get('follows'))
+    if deferred:
+        drop_indexes()
+    try:
+        for kind in KINDS:
+            if files.get(kind):
+                result[kind] = load_file(kind, files[kind], batch_size, resume, progress)
+    finally:
+        if deferred:
+            build_indexes()
+    return result
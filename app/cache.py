@@ -0,0 +1,72 @@
+# A small in-process cache with LRU eviction and optional time-to-live.
+#
+# When the cache is full, the entry that was used least recently is thrown out. When a ttl is given, entries older
+# than ttl seconds are treated as missing. The cache counts hits and misses, so we can see if it's doing any good.
+# It's shared between the threads of the process, so all the access goes through a lock.
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize, ttl=None):
+        """
+        :param maxsize: maximum number of entries
+        :param ttl: number of seconds an entry is valid, None for no time limit
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()   # key -> (value, expiry time); the least recently used key is the first one
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        :return: the cached value, or default if the key is not in the cache or has expired
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self.data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """ Removes all the entries whose key matches the predicate. This walks the whole cache, so it's meant for
+        rare events (e.g. a user changing his profile), not for every request.
+        :param predicate: a function that gets a key and returns True if that entry should be removed
+        """
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def hit_ratio(self):
+        """
+        :return: share of the lookups that found a value in the cache, between 0 and 1
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
@@ -0,0 +1,128 @@
+# Conditional GET for the pages with posts (index and user profile).
+#
+# The browser remembers the ETag and Last-Modified headers of a page, and sends them back (If-None-Match,
+# If-Modified-Since) when it asks for the same page again. If the page hasn't changed, we answer with an empty
+# "304 Not Modified" and the browser shows the copy it already has. To know if the page has changed without building
+# it, we compute the validators with one query of a few index lookups: the newest post on the page, and the
+# posts_version of the authors on the page (see models.py), which goes up whenever one of their posts is written,
+# changed or deleted. Plus the other things the page shows: the viewer, his locale, the profile data, ... The
+# expensive part - the page query and the rendering of the templates - only runs when the page has really changed.
+# Only the ETag is used for that. The Last-Modified header is sent too, but If-Modified-Since isn't trusted: a
+# deleted post or a changed profile doesn't make the page any newer.
+#
+# Things that are not in the validators: changes of the nickname or avatar of the other authors on the page. They
+# show up with the next post, or when the browser drops its copy.
+import time
+from hashlib import md5
+from flask import request, session, g, make_response
+from sqlalchemy import event, func, select
+from app import app, db
+from .models import User, Post, ArchivedPost, followers
+from .pagination import newest_first
+
+
+def user_version(user_id):
+    """
+    :return: select of the version of the posts of the user, for page_validators
+    """
+    return select([User.posts_version]).where(User.id == user_id).as_scalar()
+
+
+def timeline_version(user_id):
+    """
+    :return: select of the version of the posts on the home page of the user (the sum of the versions of the
+             users he follows, himself included), for page_validators
+    """
+    return select([func.coalesce(func.sum(User.posts_version), 0)]).\
+        select_from(followers.join(User, User.id == followers.c.followed_id)).\
+        where(followers.c.follower_id == user_id).as_scalar()
+
+
+def validators_query(posts, version, keys=(Post.timestamp, Post.id), archive=None):
+    """ The query behind page_validators, on its own so queryplan.py can check its plan.
+    :return: query of one row (id of the newest post, its timestamp, version, [True if there are archived posts])
+    """
+    timestamp_column, id_column = keys
+    # the newest post is read from the index the pages are read from, without going through all the posts
+    newest = newest_first(posts, None, timestamp_column, id_column).limit(1)
+    columns = [newest.with_entities(id_column).as_scalar(), newest.with_entities(timestamp_column).as_scalar(),
+               version]
+    if archive is not None:
+        columns.append(archive.order_by(None).exists())
+    return db.session.query(*columns)
+
+
+def page_validators(posts, version, keys=(Post.timestamp, Post.id), state=(), modified=(), archive=None):
+    """ Computes the validators of a page.
+    :param posts: query of all the posts the page is paging through
+    :param version: select of the version of the posts, user_version() or timeline_version()
+    :param keys: the timestamp and id columns the posts are sorted by (see timeline.home_timeline_keys)
+    :param state: tuple with everything else the page shows (profile data, counts, ...)
+    :param modified: tuple of times when the rest of the state was changed (or None), for Last-Modified
+    :param archive: query of the archived posts of the page (see archive.py). The archive never changes (its posts
+                    can't be deleted), we only find out if there are any, in the same query.
+    :return: tuple (ETag, Last-Modified time or None, True if the page has archived posts)
+    """
+    row = validators_query(posts, version, keys, archive).one()
+    newest_id, newest_timestamp, posts_version = row[:3]
+    archived = bool(row[3]) if archive is not None else False
+    # The form on the page has a CSRF token that expires after WTF_CSRF_TIME_LIMIT seconds, so a cached copy of
+    # the page may not be older than half of that. The token itself is stored in the session.
+    csrf_period = (app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2
+    parts = (request.full_path, g.locale, g.user.id, g.user.nickname, session.get('csrf_token'),
+             int(time.time() // csrf_period), newest_id, posts_version) + tuple(state)
+    etag = md5(repr(parts).encode('utf-8')).hexdigest()
+    times = [t for t in (newest_timestamp,) + tuple(modified) if t is not None]
+    return etag, max(times) if times else None, archived
+
+
+def not_modified(etag, last_modified):
+    """
+    :return: True if the browser already has this version of the page
+    """
+    if request.method != 'GET' or '_flashes' in session:
+        return False    # flashed messages are shown only once, so the page has to be rendered
+    # If-Modified-Since alone is not enough, the newest post is not the only thing that changes the page
+    return bool(request.if_none_match) and request.if_none_match.contains(etag)
+
+
+def conditional_response(body, etag, last_modified):
+    """ Makes a response with the validators, so the browser can ask for the page conditionally next time.
+    :param body: the rendered page, or None for a 304 Not Modified response
+    """
+    response = make_response(body) if body is not None else app.response_class(status=304)
+    if request.method == 'GET':
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # the page is different for every user, and the browser has to ask us each time whether it's still valid
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def touch_users(connection, user_ids):
+    """ Raises the posts_version of the users, their pages have changed. """
+    user_ids = list(set(user_id for user_id in user_ids if user_id is not None))
+    if user_ids:
+        users = User.__table__
+        connection.execute(users.update().where(users.c.id.in_(user_ids)).
+                           values(posts_version=users.c.posts_version + 1))
+
+
+def touch_authors(connection, post_ids):
+    """ Raises the posts_version of the authors of the posts. """
+    posts = Post.__table__
+    users = User.__table__
+    if post_ids:
+        connection.execute(users.update().where(users.c.id.in_(select([posts.c.user_id]).
+                                                                where(posts.c.id.in_(post_ids)))).
+                           values(posts_version=users.c.posts_version + 1))
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Post, 'after_delete')
+@event.listens_for(ArchivedPost, 'after_delete')       # the archived posts can only be deleted
+def on_post_write(mapper, connection, target):
+    touch_users(connection, [target.user_id])
@@ -1,12 +1,68 @@
-from threading import Thread
+from functools import wraps
+from flask import g, request, abort
+from app import app
+from config import ADMINS
 
 
-def async(f):
-    """ This is our custom decorator for starting a function asynchronously in a separate thread.
-    :param f: a function to be decorated
+def admin_required(f):
+    """ This is our custom decorator for the views that only the administrators may see (metrics, profiles).
+    The request is let through if the logged in user has one of the emails in ADMINS, or if it carries the
+    ADMIN_TOKEN from config.py in the Authorization header ("Authorization: Bearer <token>"), which is how
+    programs like a Prometheus server get in. Everybody else gets 404, we don't advertise these pages.
+    :param f: a view function to be decorated
     :return: a wrapper
     """
+    @wraps(f)
     def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
+        if is_admin():
+            return f(*args, **kwargs)
+        abort(404)
+    return wrapper
+
+
+def admin_token_required(f):
+    """ Like admin_required, but only the ADMIN_TOKEN lets the request through, the login of an administrator doesn't.
+    For the views that change something (e.g. switch on the profiler): a browser sends the session cookie with a
+    request another site makes it send, but never the Authorization header, so there's no cross-site request
+    forgery.
+    :param f: a view function to be decorated
+    :return: a wrapper
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if has_admin_token():
+            return f(*args, **kwargs)
+        abort(404)
+    return wrapper
+
+
+def has_admin_token():
+    """
+    :return: True if the request carries the ADMIN_TOKEN in the Authorization header
+    """
+    token = app.config.get('ADMIN_TOKEN')
+    return bool(token) and request.headers.get('Authorization') == 'Bearer ' + token
+
+
+def is_admin():
+    """
+    :return: True if the current request comes from an administrator (see admin_required)
+    """
+    if has_admin_token():
+        return True
+    user = getattr(g, 'user', None)
+    return user is not None and user.is_authenticated() and bool(user.email) and user.email in ADMINS
+
+
+def read_only(f):
+    """ Marks a view that only reads from the database. Its queries go to the read connections (see engine.py),
+    the writer is left to the requests that write. Only GET and HEAD requests are read-only, the same view may
+    handle a form that is posted to it.
+    :param f: a view function to be decorated
+    :return: a wrapper
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.read_only = request.method in ('GET', 'HEAD')
+        return f(*args, **kwargs)
     return wrapper
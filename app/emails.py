@@ -1,14 +1,11 @@
+from datetime import datetime
 from flask.ext.mail import Message
-from app import mail, app
+from app import mail, app, db
 from config import ADMINS
 from flask import render_template
-from .decorators import async
-
-
-@async              # our custom decorator from .decorators
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+from sqlalchemy import and_, exists, func
+from .mailqueue import mail_dispatcher
+from .models import User, followers, notification
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
@@ -17,14 +14,75 @@ def send_email(subject, sender, recipients, text_body, html_body):
                   recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    # Instead of sending the email from here ( mail.send(msg) ), we'll create and start a new thread to send
-    # the email in the background, so this process doesn't have to wait for the email to get sent.
-    send_async_email(app, msg)
+    # Instead of sending the email from here ( mail.send(msg) ), we'll put it into a queue. A few worker threads
+    # are sending the emails from the queue in the background, so this process doesn't have to wait for the email
+    # to get sent (see mailqueue.py).
+    mail_dispatcher.send(msg)
 
 
 def follower_notification(followed, follower):
-    send_email(subject="[microblog] {} is now following you!".format(follower.nickname),
+    ''' Records that the followed user has a new follower. The email is not sent from here: the follow events are
+    collected in the notification table, and send_follower_digests() sends one email with all the new followers
+    of a user. This way a popular user doesn't get an email for every follow, and the follow request doesn't wait
+    for the templates and the mail server.
+    The row is added to the current transaction, so it's committed together with the follow.
+    '''
+    db.session.execute(notification.insert().values(user_id=followed.id, follower_id=follower.id,
+                                                    timestamp=datetime.utcnow()))
+
+
+def send_follower_digests(batch_size=None):
+    ''' Sends the digests of new followers: one email per user, with all his follow events collected since the
+    last run. It's meant to run periodically (see follower_digest.py), so the period of the job is the window in
+    which the follows are collected.
+    Follows that have been undone in the meantime are left out of the digest.
+    :param batch_size: number of users whose digests are built from one round of queries
+    :return: number of digests sent
+    '''
+    if batch_size is None:
+        batch_size = app.config.get('FOLLOWER_DIGEST_BATCH_SIZE', 100)
+    # the events that arrive while we're working go to the next digest
+    last_id = db.session.query(func.max(notification.c.id)).scalar()
+    if last_id is None:
+        return 0
+    user_ids = [user_id for (user_id,) in db.session.query(notification.c.user_id).
+                filter(notification.c.id <= last_id).distinct().order_by(notification.c.user_id)]
+    sent = 0
+    # url_for(..., _external=True) needs to know the address of the site, and there's no request here
+    with app.test_request_context(base_url=app.config.get('SERVER_URL', 'http://localhost:5000/')):
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            # the still valid follow events of this batch of users, the oldest first
+            still_following = exists().where(and_(followers.c.follower_id == notification.c.follower_id,
+                                                  followers.c.followed_id == notification.c.user_id))
+            events = db.session.query(notification.c.user_id, notification.c.follower_id).\
+                filter(notification.c.user_id.in_(batch), notification.c.id <= last_id, still_following).\
+                order_by(notification.c.user_id, notification.c.timestamp).all()
+            # load all the users we need in one query
+            ids = set(batch) | set(follower_id for user_id, follower_id in events)
+            users = dict((u.id, u) for u in User.query.filter(User.id.in_(ids)))
+            new_followers = {}
+            for user_id, follower_id in events:
+                user_followers = new_followers.setdefault(user_id, [])
+                if users.get(follower_id) is not None and users[follower_id] not in user_followers:
+                    user_followers.append(users[follower_id])
+            for user_id, user_followers in new_followers.items():
+                if user_followers:
+                    follower_digest(users[user_id], user_followers)
+                    sent += 1
+            db.session.execute(notification.delete().where(and_(notification.c.user_id.in_(batch),
+                                                                notification.c.id <= last_id)))
+            db.session.commit()
+    return sent
+
+
+def follower_digest(user, new_followers):
+    if len(new_followers) == 1:
+        subject = "[microblog] {} is now following you!".format(new_followers[0].nickname)
+    else:
+        subject = "[microblog] You have {} new followers!".format(len(new_followers))
+    send_email(subject=subject,
                sender=ADMINS[0],
-               recipients=[followed.email],
-               text_body=render_template("follower_email.txt", user=followed, follower=follower),
-               html_body=render_template("follower_email.html", user=followed, follower=follower))
+               recipients=[user.email],
+               text_body=render_template("follower_email.txt", user=user, followers=new_followers),
+               html_body=render_template("follower_email.html", user=user, followers=new_followers))
@@ -0,0 +1,183 @@
+# The database engines: a tuned SQLite profile and the read/write split.
+#
+# With the default settings every connection opens SQLite in the rollback journal mode, where a writer locks out
+# all the readers, so the reads of index() and user() were waiting for the writes of other requests (and the
+# other way around). Now:
+#     - every connection gets the pragmas from config.py: the WAL journal (readers don't block the writer and the
+#       writer doesn't block the readers), synchronous=NORMAL (safe with WAL, just fewer fsyncs), a bigger page
+#       cache, memory mapped I/O and a busy timeout instead of an immediate "database is locked",
+#     - the views marked with @read_only (decorators.py) run their queries on a pool of read connections, which
+#       can be pointed at a replica of the database with SQLALCHEMY_READ_URI. The read connections are opened
+#       with query_only, so a write that ends up there by mistake fails instead of going to the replica,
+#     - everything else, and whatever a read-only view flushes, goes to the writer. The writer keeps one
+#       connection open (with its page cache), and the writes of all the threads of the process are serialized
+#       with one lock, so they queue up in the process instead of fighting for the SQLite write lock. A write that
+#       doesn't get the lock within SQLITE_BUSY_TIMEOUT fails (and is logged), it doesn't go ahead without it.
+#       (The pool of the writer can still open more connections, because a thread that holds the lock may need a
+#       second one, e.g. for the last_seen buffer - with a pool of exactly one connection it would wait for itself.)
+import threading
+import weakref
+from flask import g, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase, TextClause
+
+READ_STATEMENTS = ('SELECT', 'PRAGMA', 'EXPLAIN', 'WITH')
+
+
+def is_read(statement):
+    """
+    :param statement: text of a SQL statement
+    :return: True if the statement only reads
+    """
+    return statement.lstrip().split(None, 1)[0].upper() in READ_STATEMENTS if statement.strip() else True
+
+
+def is_file(url):
+    return url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:')
+
+
+class WriteLock(object):
+    """ One lock for all the writes of the process. A connection takes it with its first write statement and gives
+    it back when its transaction ends. The lock is reentrant, a thread that is in the middle of a write (e.g. a
+    flush of the session) can write through another connection too (e.g. the last_seen buffer).
+    """
+    def __init__(self, timeout, logger):
+        self.lock = threading.RLock()
+        self.timeout = timeout
+        self.logger = logger
+        self.timeouts = 0       # writes that failed because they didn't get the lock in time
+        self.timeouts_lock = threading.Lock()
+
+    def register(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.acquire)
+        event.listen(engine, 'commit', self.release)
+        event.listen(engine, 'rollback', self.release)
+
+    def acquire(self, conn, cursor, statement, parameters, context, executemany):
+        if 'write_lock' in conn.info or is_read(statement):
+            return
+        if not self.lock.acquire(timeout=self.timeout):
+            with self.timeouts_lock:
+                self.timeouts += 1
+            self.logger.error('No write lock after {} seconds, the write fails: {}'.format(self.timeout,
+                                                                                         statement[:200]))
+            raise TimeoutError('Write lock not acquired within {} seconds'.format(self.timeout))
+        conn.info['write_lock'] = True
+
+    def release(self, conn):
+        if conn.info.pop('write_lock', False):
+            self.lock.release()
+
+
+def set_pragmas(dbapi_connection, config, read_only):
+    """ Sets the pragmas from config.py on a new SQLite connection. """
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # the journal mode is stored in the database file, and a replica may be a read-only file
+        cursor.execute('PRAGMA journal_mode = {}'.format(config.get('SQLITE_JOURNAL_MODE', 'WAL')))
+    cursor.execute('PRAGMA synchronous = {}'.format(config.get('SQLITE_SYNCHRONOUS', 'NORMAL')))
+    cursor.execute('PRAGMA cache_size = {:d}'.format(config.get('SQLITE_CACHE_SIZE', -2000)))
+    cursor.execute('PRAGMA mmap_size = {:d}'.format(config.get('SQLITE_MMAP_SIZE', 0)))
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(config.get('SQLITE_BUSY_TIMEOUT', 5000)))
+    if read_only:
+        cursor.execute('PRAGMA query_only = ON')
+    cursor.close()
+
+
+def tune(engine, app, read_only=False):
+    """ Registers the pragmas on the engine, they are set on every new connection. """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        set_pragmas(dbapi_connection, app.config, read_only)
+
+
+def reading():
+    """
+    :return: True if the current request was marked with @read_only
+    """
+    return has_request_context() and g.get('read_only', False)
+
+
+class RoutingSession(SignallingSession):
+    """ The session that sends the queries of read-only requests to the read engine, and all the rest (including
+    everything it flushes) to the writer.
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if reading() and not self._flushing and not is_write(clause):
+            return self.db.get_read_engine(self.app)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    return isinstance(clause, TextClause) and not is_read(clause.text)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with the tuned engines and the read/write split. db.engine is still the writer. """
+    def __init__(self, *args, **kwargs):
+        self.engine_lock = threading.Lock()
+        self.tuned = weakref.WeakSet()  # the writer engines that already have their pragmas
+        self.read_engines = {}          # read URI -> engine
+        self.write_lock = None
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        if is_file(info) and options.get('pool_size') is None:
+            # one connection that stays open, more are opened (and closed again) only when it's taken
+            options['poolclass'] = QueuePool
+            options['pool_size'] = 1
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self.tuned:
+            with self.engine_lock:
+                if engine not in self.tuned:
+                    tune(engine, app)
+                    if self.write_lock is None:
+                        self.write_lock = WriteLock(app.config.get('SQLITE_BUSY_TIMEOUT', 5000) / 1000.0,
+                                                    app.logger)
+                    if engine.dialect.name == 'sqlite':
+                        self.write_lock.register(engine)
+                    self.tuned.add(engine)
+        return engine
+
+    def get_read_engine(self, app):
+        """
+        :return: the engine of the read connections, for SQLALCHEMY_READ_URI or, if that's not set, for the same
+                 database as the writer
+        """
+        uri = app.config.get('SQLALCHEMY_READ_URI') or app.config['SQLALCHEMY_DATABASE_URI']
+        engine = self.read_engines.get(uri)
+        if engine is None:
+            info = make_url(uri)
+            if info.drivername.startswith('sqlite') and not is_file(info):
+                return self.get_engine(app)     # another connection to an in-memory database sees another database
+            with self.engine_lock:
+                engine = self.read_engines.get(uri)
+                if engine is None:
+                    options = {'convert_unicode': True}
+                    if is_file(info):
+                        options.update(poolclass=QueuePool, pool_size=app.config.get('SQLITE_READ_POOL_SIZE', 5),
+                                       connect_args={'check_same_thread': False})
+                    SQLAlchemy.apply_driver_hacks(self, app, info, options)
+                    engine = self.read_engines[uri] = create_engine(info, **options)
+                    tune(engine, app, read_only=True)
+        return engine
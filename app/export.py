@@ -0,0 +1,156 @@
+# Export of all the data of a user: the profile, the posts, the followers and the followed users.
+#
+# The export is a stream of records, one per line, each with its type:
+#     {"type": "user", "id": 1, "nickname": "john", "about_me": "...", "last_seen": "2014-12-19T10:30:11Z"}
+#     {"type": "post", "id": 42, "body": "...", "timestamp": "2014-12-19T10:30:11Z", "language": "en"}
+#     {"type": "follower", "id": 7, "nickname": "susan"}
+#     {"type": "followed", "id": 8, "nickname": "david"}
+# as NDJSON, or as CSV with the columns in CSV_COLUMNS (the columns a record doesn't have are empty), optionally
+# compressed with gzip. The rows are read from the database in batches of EXPORT_BATCH_SIZE (yield_per) and sent
+# in chunks of about EXPORT_CHUNK_SIZE bytes while they're being read, so an export of a user with a million posts
+# takes as much memory as one with ten, and the response starts right away instead of after the whole export is
+# built. The export is available to the user himself and to the administrators on
+#     /user/<nickname>/export?format=csv&gzip=1
+# and to the operators on the command line, ./export_user.py.
+import csv
+import io
+import json
+import zlib
+from urllib.parse import quote
+from flask import g, request, abort, Response, stream_with_context
+from werkzeug.utils import secure_filename
+from app import app, db
+from .models import User, Post, ArchivedPost, followers, known_language
+from .pagination import merge_newest_first
+from .decorators import is_admin, read_only
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+CSV_COLUMNS = ('type', 'id', 'nickname', 'about_me', 'last_seen', 'body', 'timestamp', 'language')
+
+
+def iso(timestamp):
+    return timestamp.isoformat() + 'Z' if timestamp is not None else None
+
+
+def streamed(query):
+    """ The query, read from the database in batches instead of all at once. """
+    return query.execution_options(stream_results=True).yield_per(app.config.get('EXPORT_BATCH_SIZE', 1000))
+
+
+def records(user):
+    """
+    :param user: the user we're exporting
+    :return: generator of the records of the export (dictionaries)
+    """
+    yield {'type': 'user', 'id': user.id, 'nickname': user.nickname, 'about_me': user.about_me,
+           'last_seen': iso(user.last_seen)}
+    # the posts in the post table are mostly newer than the archived ones, but not all of them (see archive.py)
+    tiers = [streamed(db.session.query(model.id, model.body, model.timestamp, model.language).
+                      filter(model.user_id == user.id).order_by(model.timestamp.desc(), model.id.desc()))
+             for model in (Post, ArchivedPost)]
+    for post_id, body, timestamp, language in merge_newest_first(tiers):
+        yield {'type': 'post', 'id': post_id, 'body': body, 'timestamp': iso(timestamp),
+               'language': known_language(language)}
+    # every user follows himself, that's not something to export
+    for kind, this_side, other_side in (('follower', followers.c.followed_id, followers.c.follower_id),
+                                        ('followed', followers.c.follower_id, followers.c.followed_id)):
+        users = db.session.query(User.id, User.nickname).join(followers, other_side == User.id).\
+            filter(this_side == user.id, User.id != user.id).order_by(User.id)
+        for user_id, nickname in streamed(users):
+            yield {'type': kind, 'id': user_id, 'nickname': nickname}
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS, restval='', lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def chunks(lines, size):
+    """ Joins the lines into chunks of about size bytes, it's cheaper to send (and compress) a few big pieces. """
+    chunk = []
+    length = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        chunk.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def gzipped(chunks):
+    """ Compresses the stream of chunks on the fly, into the gzip format. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)    # 16 + ...: with the gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(user, export_format='ndjson', compress=False):
+    """
+    :param user: the user we're exporting
+    :param export_format: 'ndjson' or 'csv'
+    :param compress: compress the export with gzip
+    :return: generator of the export as chunks of bytes
+    """
+    lines = csv_lines(records(user)) if export_format == 'csv' else ndjson_lines(records(user))
+    result = chunks(lines, app.config.get('EXPORT_CHUNK_SIZE', 64 * 1024))
+    return gzipped(result) if compress else result
+
+
+def export_name(user, export_format, compress):
+    return 'microblog-{}.{}{}'.format(user.nickname, export_format, '.gz' if compress else '')
+
+
+def filename(user, export_format, compress):
+    """
+    :return: name of the export file. The nickname can be anything the user typed (quotes, slashes, non-ASCII
+             letters), so only ASCII letters, digits and '-_.' are kept - safe for the disk and for a header.
+    """
+    return secure_filename(export_name(user, export_format, compress))
+
+
+def content_disposition(user, export_format, compress):
+    """
+    :return: the Content-Disposition header of the export: the safe file name for every browser, and the name with
+             the real nickname (RFC 5987, percent-encoded UTF-8) for the browsers that understand filename*
+    """
+    return "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+        filename(user, export_format, compress), quote(export_name(user, export_format, compress), safe=''))
+
+
+@app.route('/user/<nickname>/export')
+@read_only
+def export_user(nickname):
+    """ Streams the export of the user, e.g. /user/john/export?format=csv&gzip=1 """
+    if not is_admin() and not (g.user.is_authenticated() and g.user.nickname == nickname):
+        abort(403)
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        abort(404)
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        abort(400)
+    compress = bool(request.args.get('gzip'))
+    # the database session has to stay alive until the last row is sent, so we keep the request context
+    response = Response(stream_with_context(export(user, export_format, compress)),
+                        mimetype='application/gzip' if compress else FORMATS[export_format])
+    response.headers['Content-Disposition'] = content_disposition(user, export_format, compress)
+    return response
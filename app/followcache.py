@@ -0,0 +1,213 @@
+# In-process cache of the follow graph.
+#
+# User.is_following() used to run a COUNT query, and it's called from follow(), unfollow(), the follow/unfollow
+# views and the profile page. Here we keep, for every user we have seen, a sorted array of the ids of the users he
+# follows and a sorted array of the ids of his followers. A membership check is then a binary search, and the
+# follower/followed counts are just the lengths of the arrays - no SQL at all.
+# An array('i') takes 4 bytes per id, so even a big graph fits into memory easily (a million follow relationships
+# take about 8MB for both directions).
+#
+# The arrays are loaded lazily, one query per user and direction, or all at once with warm() (see FOLLOW_CACHE_WARM
+# in config.py). They are loaded from the writer (a replica may be behind), and the follows and unfollows that
+# happen while an array is being loaded are recorded and replayed on it before it goes into the cache.
+# They are updated by User.follow() and User.unfollow(). The session remembers whose arrays it changed, and if its
+# transaction is rolled back, those arrays are thrown away (they're loaded again on the next use).
+# The cache lives in the process memory, so every process of the application has its own copy, and the follows and
+# unfollows made by the other processes don't update it. So an array is used for FOLLOW_CACHE_TTL seconds after it
+# was loaded, then it's loaded again. The follow and unfollow views don't trust the cache, they throw away the
+# arrays of both users and check the database before they write (see views.py).
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app import app, db
+
+SESSION_KEY = 'follow_graph'     # key in session.info, set of ids of the users whose arrays the session changed
+
+
+class FollowGraph(object):
+    def __init__(self, table):
+        """
+        :param table: the followers association table (columns follower_id and followed_id)
+        """
+        self.table = table
+        self.lock = threading.Lock()
+        self.followed = {}      # user id -> sorted array of ids of the users he follows
+        self.followers = {}     # user id -> sorted array of ids of his followers
+        self.loaded = {}        # ('followed' or 'followers', user id) -> the time the array was loaded
+        # ('followed' or 'followers', user id) -> Loading, for the arrays that are being loaded right now
+        self.loading = {}
+        event.listen(Session, 'after_commit', self.on_commit)
+        event.listen(Session, 'after_rollback', self.on_rollback)
+
+    def enabled(self):
+        return app.config.get('FOLLOW_CACHE_ENABLED', True)
+
+    def ttl(self):
+        return app.config.get('FOLLOW_CACHE_TTL', 60)
+
+    def _ids(self, name, user_id, key_column, value_column):
+        """ Returns the cached array, or loads it from the database.
+        :param name: 'followed' or 'followers', the attribute with the cached arrays
+        """
+        key = (name, user_id)
+        with self.lock:
+            ids = getattr(self, name).get(user_id)
+            if ids is not None:
+                if time.time() - self.loaded.get(key, 0) < self.ttl():
+                    return ids
+                del getattr(self, name)[user_id]    # too old, other processes may have changed it
+            loading = self.loading.get(key)
+            if loading is None:
+                loading = self.loading[key] = Loading()
+            loading.readers += 1
+        loaded_at = time.time()
+        try:
+            # through the session's connection to the writer, so we see what this session has already written
+            ids = array('i', [value for (value,) in db.session.connection(bind=db.engine).execute(
+                select([value_column]).where(key_column == user_id).order_by(value_column))])
+        finally:
+            with self.lock:
+                loading.readers -= 1
+                if not loading.readers and self.loading.get(key) is loading:
+                    del self.loading[key]
+        with self.lock:
+            for change, value in loading.changes:
+                change(ids, value)
+            if loading.stale:
+                return ids      # it was thrown away while we were loading it, we use it once but don't keep it
+            if user_id not in getattr(self, name):
+                getattr(self, name)[user_id] = ids
+                self.loaded[key] = loaded_at
+            return getattr(self, name)[user_id]
+
+    def followed_ids(self, user_id):
+        """
+        :return: sorted array of ids of the users that the given user follows
+        """
+        return self._ids('followed', user_id, self.table.c.follower_id, self.table.c.followed_id)
+
+    def follower_ids(self, user_id):
+        """
+        :return: sorted array of ids of the followers of the given user
+        """
+        return self._ids('followers', user_id, self.table.c.followed_id, self.table.c.follower_id)
+
+    def is_following(self, follower_id, followed_id):
+        ids = self.followed_ids(follower_id)
+        i = bisect_left(ids, followed_id)
+        return i < len(ids) and ids[i] == followed_id
+
+    def followed_count(self, user_id):
+        return len(self.followed_ids(user_id))
+
+    def follower_count(self, user_id):
+        return len(self.follower_ids(user_id))
+
+    def _change(self, change, name, user_id, value):
+        """ Applies the change (_insert or _remove) to the loaded array, and records it for the array that is being
+        loaded. The caller holds the lock.
+        """
+        change(getattr(self, name).get(user_id), value)
+        loading = self.loading.get((name, user_id))
+        if loading is not None:
+            loading.changes.append((change, value))
+
+    def add(self, follower_id, followed_id, session=None):
+        """ Records a new follow relationship in the arrays that are already loaded.
+        :param session: the session that will commit the relationship, the arrays are thrown away if it rolls back
+        """
+        with self.lock:
+            self._change(_insert, 'followed', follower_id, followed_id)
+            self._change(_insert, 'followers', followed_id, follower_id)
+        _touch(session, follower_id, followed_id)
+
+    def remove(self, follower_id, followed_id, session=None):
+        """ Removes a follow relationship from the arrays that are already loaded.
+        :param session: the session that will commit the change, the arrays are thrown away if it rolls back
+        """
+        with self.lock:
+            self._change(_remove, 'followed', follower_id, followed_id)
+            self._change(_remove, 'followers', followed_id, follower_id)
+        _touch(session, follower_id, followed_id)
+
+    def invalidate(self, user_ids):
+        """ Throws away the arrays of the users, they are loaded again when they're needed. """
+        with self.lock:
+            for user_id in user_ids:
+                for name in ('followed', 'followers'):
+                    getattr(self, name).pop(user_id, None)
+                    self.loaded.pop((name, user_id), None)
+                    if (name, user_id) in self.loading:
+                        self.loading[name, user_id].stale = True
+
+    def clear(self):
+        with self.lock:
+            self.followed = {}
+            self.followers = {}
+            self.loaded = {}
+            for loading in self.loading.values():
+                loading.stale = True
+
+    def on_commit(self, session):
+        session.info.pop(SESSION_KEY, None)
+
+    def on_rollback(self, session):
+        self.invalidate(session.info.pop(SESSION_KEY, ()))
+
+    def warm(self):
+        """ Loads the whole follow graph with a single query.
+        :return: number of follow relationships loaded
+        """
+        followed = {}
+        followers = {}
+        loaded_at = time.time()
+        rows = db.session.connection(bind=db.engine).execute(
+            select([self.table.c.follower_id, self.table.c.followed_id]).
+            order_by(self.table.c.follower_id, self.table.c.followed_id))
+        count = 0
+        for follower_id, followed_id in rows:
+            followed.setdefault(follower_id, array('i')).append(followed_id)
+            followers.setdefault(followed_id, array('i')).append(follower_id)
+            count += 1
+        # Both directions come out sorted, because the rows are ordered by follower first.
+        # Users without any relationship are not in the result, they'll be loaded (empty) on first use.
+        with self.lock:
+            self.followed = followed
+            self.followers = followers
+            self.loaded = dict([(('followed', user_id), loaded_at) for user_id in followed] +
+                               [(('followers', user_id), loaded_at) for user_id in followers])
+        return count
+
+
+class Loading(object):
+    """ An array that is being loaded: the changes made in the meantime, and the number of threads loading it. """
+    def __init__(self):
+        self.readers = 0
+        self.changes = []
+        self.stale = False
+
+
+def _touch(session, *user_ids):
+    if session is not None:
+        session.info.setdefault(SESSION_KEY, set()).update(user_ids)
+
+
+def _insert(ids, value):
+    """ Inserts a value into a sorted array, unless it's already there (or the array is not loaded). """
+    if ids is None:
+        return
+    i = bisect_left(ids, value)
+    if i == len(ids) or ids[i] != value:
+        ids.insert(i, value)
+
+
+def _remove(ids, value):
+    """ Removes a value from a sorted array, if it's there (and the array is loaded). """
+    if ids is None:
+        return
+    i = bisect_left(ids, value)
+    if i < len(ids) and ids[i] == value:
+        del ids[i]
@@ -0,0 +1,81 @@
+# Cache of rendered posts.
+#
+# The index, profile and search pages used to render post.html for every post on every request: the avatar URL,
+# url_for, the MomentJS script and the translation link, again and again for the same posts. The HTML of a post
+# depends only on the post itself (and its author's nickname and avatar), on the language of the viewer (g.locale)
+# and on whether the viewer is the author (the Delete link). The time is rendered by moment.js in the browser, so it
+# doesn't go stale. So we keep the rendered HTML in an LRU cache under those keys (POST_FRAGMENT_CACHE_SIZE), and the
+# templates call render_post(post) instead of including post.html.
+#
+# A post is thrown out of the cache when it's changed or deleted, and when its language is detected (langdetect.py).
+# All the posts of a user are thrown out when the user's data changes (nickname, avatar, about me) - but not when
+# he follows someone or is seen again, that doesn't change his posts. Bulk updates clear the whole cache.
+from flask import g, render_template
+from jinja2 import Markup
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from app import app
+from .cache import LRUCache
+from .models import User, Post, ArchivedPost
+
+post_fragments = LRUCache(app.config.get('POST_FRAGMENT_CACHE_SIZE', 10000))
+
+
+@app.template_global()
+def render_post(post):
+    """ Renders post.html for the given post, or takes the HTML from the cache. Used by the templates instead of
+    {% include 'post.html' %}.
+    :param post: a PostRow (see models.py)
+    :return: HTML of the post
+    """
+    if not app.config.get('POST_FRAGMENT_CACHE_ENABLED', True):
+        return Markup(render_template('post.html', post=post))
+    # the author is the first part of the key, so that all the posts of a user can be found
+    key = (post.user_id, post.id, g.locale, post.user_id == g.user.id)
+    html = post_fragments.get(key)
+    if html is None:
+        html = Markup(render_template('post.html', post=post))
+        post_fragments.set(key, html)
+    return html
+
+
+def invalidate_posts(post_ids):
+    post_ids = set(post_ids)
+    post_fragments.delete_where(lambda key: key[1] in post_ids)
+
+
+def invalidate_user(user_id):
+    post_fragments.delete_where(lambda key: key[0] == user_id)
+
+
+def hit_ratio():
+    return post_fragments.hit_ratio()
+
+
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Post, 'after_delete')
+@event.listens_for(ArchivedPost, 'after_delete')
+def on_post_write(mapper, connection, target):
+    invalidate_posts([target.id])
+
+
+USER_FIELDS = ('nickname', 'avatar_hash', 'about_me')     # the data of the author that can show up in a post
+
+
+@event.listens_for(User, 'after_update')
+def on_user_update(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if any(attrs[field].history.has_changes() for field in USER_FIELDS):
+        invalidate_user(target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def on_user_delete(mapper, connection, target):
+    invalidate_user(target.id)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def on_bulk_write(context):
+    if context.mapper is not None and context.mapper.class_ in (User, Post):
+        post_fragments.clear()
@@ -0,0 +1,151 @@
+# Detection of the language of new posts, in the background.
+#
+# We used to call guess_language() in the index view, before committing the new post, so every submit waited for
+# the detection. Now the post is saved without a language (NULL), its id is put into a queue, and a worker thread
+# detects the languages of the queued posts in batches and writes them with one UPDATE per batch. The same bodies
+# are posted again and again ("+1", "Hello world!"), so the results are cached by body.
+#
+# The queue lives in memory, so the ids that were queued when the process stopped are lost (and the queue is
+# bounded, so ids may be dropped when the worker can't keep up). Those posts keep an empty language (NULL), and
+# backfill() (./language_backfill.py) detects the language of every post that doesn't have one. The posts whose
+# language can't be detected get UNDETERMINED_LANGUAGE, so the backfill doesn't try them again and again.
+import atexit
+import threading
+try:
+    import Queue as queue   # Python 2
+except ImportError:
+    import queue            # Python 3
+from guess_language import guess_language
+from sqlalchemy import bindparam
+from app import app, db
+from .cache import LRUCache
+from .fragments import invalidate_posts
+from .conditional import touch_authors
+from .models import Post, UNDETERMINED_LANGUAGE
+
+STOP = object()     # put into the queue to tell the worker to stop
+
+
+class LanguageDetector(object):
+    def __init__(self, queue_size=None, batch_size=None, cache_size=None):
+        """ The settings that are not given are taken from the application configuration. """
+        config = app.config
+        self.batch_size = batch_size or config.get('LANGUAGE_BATCH_SIZE', 100)
+        self.queue = queue.Queue(queue_size or config.get('LANGUAGE_QUEUE_SIZE', 10000))
+        self.cache = LRUCache(cache_size or config.get('LANGUAGE_CACHE_SIZE', 10000))
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """ Starts the worker thread, if it's not running yet. """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='language-detector')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def enqueue(self, post_id):
+        """ Queues a new post for language detection. Call it after the post is committed, the worker reads the
+        body from the database.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait(post_id)
+        except queue.Full:
+            # the post keeps an empty language, the backfill will take care of it
+            app.logger.warning('Language detection queue is full, skipping post {}'.format(post_id))
+
+    def depth(self):
+        """
+        :return: number of posts waiting for language detection
+        """
+        return self.queue.qsize()
+
+    def detect(self, body):
+        """
+        :return: language code of the text, UNDETERMINED_LANGUAGE if it can't be detected
+        """
+        language = self.cache.get(body)
+        if language is None:
+            language = guess_language(body)
+            if language == 'UNKNOWN' or len(language) > 5:
+                language = UNDETERMINED_LANGUAGE
+            self.cache.set(body, language)
+        return language
+
+    def classify(self, post_ids):
+        """ Detects the languages of the given posts and writes them to the database.
+        :return: number of posts updated
+        """
+        if not post_ids:
+            return 0
+        # going around the session, like LastSeenBuffer, so this doesn't mix with the session of a request
+        posts = Post.__table__
+        with db.engine.begin() as connection:
+            rows = connection.execute(posts.select().with_only_columns([posts.c.id, posts.c.body]).
+                                      where(posts.c.id.in_(post_ids))).fetchall()
+            if not rows:
+                return 0
+            connection.execute(posts.update().where(posts.c.id == bindparam('post_id')).
+                               values(language=bindparam('lang')),
+                               [{'post_id': post_id, 'lang': self.detect(body)} for post_id, body in rows])
+            touch_authors(connection, [post_id for post_id, body in rows])     # the pages show the language
+        invalidate_posts([post_id for post_id, body in rows])     # the cached HTML shows the old language
+        return len(rows)
+
+    def work(self):
+        """ The main loop of the worker thread. """
+        stop = False
+        while not stop:
+            post_id = self.queue.get()
+            batch = []
+            while post_id is not STOP:
+                batch.append(post_id)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    post_id = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stop = post_id is STOP
+            try:
+                with app.app_context():
+                    self.classify(batch)
+            except Exception as e:
+                app.logger.error('Language detection failed for posts {}: {}'.format(batch, e))
+            for i in range(len(batch) + (1 if stop else 0)):
+                self.queue.task_done()
+
+    def join(self):
+        """ Waits until all the queued posts are processed. """
+        self.queue.join()
+
+    def shutdown(self, timeout=None):
+        """ Stops the worker, after it has processed the posts that are in the queue. """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(STOP)
+            thread.join(timeout)
+
+    def backfill(self, batch_size=None):
+        """ Detects the language of all the posts that don't have one. It runs in the calling thread, one batch of
+        posts (in the order of their ids) at a time.
+        :return: number of posts processed
+        """
+        batch_size = batch_size or self.batch_size
+        last_id = 0
+        total = 0
+        while True:
+            ids = [post_id for (post_id,) in db.session.query(Post.id).
+                   filter(Post.id > last_id, Post.language.is_(None)).
+                   order_by(Post.id).limit(batch_size)]
+            db.session.commit()     # don't keep the read transaction open while we write
+            if not ids:
+                return total
+            total += self.classify(ids)
+            last_id = ids[-1]
+
+
+language_detector = LanguageDetector()
+atexit.register(language_detector.shutdown)
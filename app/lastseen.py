@@ -0,0 +1,77 @@
+# Write-behind buffer for User.last_seen.
+#
+# We used to set g.user.last_seen and commit in before_request, which meant one write transaction on every request
+# of every logged in user. SQLite has a single write lock for the whole database, so those tiny commits were
+# serializing all our traffic.
+# Now the "last seen" times are only collected in memory. They are written to the database with one batched UPDATE
+# when enough of them are collected (LAST_SEEN_FLUSH_SIZE), when enough time has passed since the last write
+# (LAST_SEEN_FLUSH_INTERVAL), and when the process exits. Users that were seen recently (LAST_SEEN_THRESHOLD) are
+# not even put into the buffer - nobody cares if the profile page says "a minute ago" or "two minutes ago".
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+from app import app, db
+from .models import User
+from .usercache import user_cache
+
+
+class LastSeenBuffer(object):
+    def __init__(self):
+        self.lock = threading.Lock()    # the buffer is shared between all the threads of the process
+        self.pending = {}               # user id -> time the user was last seen
+        self.last_flush = time.time()
+
+    def touch(self, user, now=None):
+        """ Records that the user has just been seen. This is called from before_request, instead of committing
+        the new last_seen value.
+        :param user: the logged in user
+        :param now: the time the user was seen, defaults to now
+        """
+        if now is None:
+            now = datetime.utcnow()
+        threshold = timedelta(seconds=app.config.get('LAST_SEEN_THRESHOLD', 60))
+        with self.lock:
+            seen = self.pending.get(user.id) or user.last_seen
+            if seen is not None and now - seen < threshold:
+                return      # seen recently enough, nothing to do
+            self.pending[user.id] = now
+            flush_due = (len(self.pending) >= app.config.get('LAST_SEEN_FLUSH_SIZE', 100) or
+                         time.time() - self.last_flush >= app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30))
+        if flush_due:
+            self.flush()
+
+    def flush(self):
+        """ Writes all the buffered last_seen values to the database with a single UPDATE statement
+        (executemany with one set of parameters per user).
+        :return: number of users updated
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        if not pending:
+            return 0
+        users = User.__table__
+        statement = users.update().where(users.c.id == bindparam('user_id')).values(last_seen=bindparam('seen'))
+        try:
+            # We're going around the session on purpose: this must not interfere with whatever the current request
+            # has in its session, and we don't need ORM objects for this.
+            with db.engine.begin() as connection:
+                connection.execute(statement, [{'user_id': user_id, 'seen': seen}
+                                               for user_id, seen in pending.items()])
+        except Exception as e:
+            # Put the values back (unless there are newer ones already), they'll be written with the next flush.
+            with self.lock:
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+            app.logger.warning('Could not write last_seen values: {}'.format(e))
+            return 0
+        for user_id in pending:
+            user_cache.invalidate(user_id)      # the cached users have the old last_seen
+        return len(pending)
+
+
+last_seen_buffer = LastSeenBuffer()
+# whatever is still in the buffer when the process stops gets written to the database
+atexit.register(last_seen_buffer.flush)
@@ -0,0 +1,175 @@
+# Sending of emails in the background, through a bounded queue and a fixed pool of worker threads.
+#
+# We used to start a new thread for every email (the @async decorator), and every thread opened its own SMTP
+# session. A burst of follows could start hundreds of threads and SSL handshakes at the same time.
+# Now the emails are put into a queue, and a few worker threads (MAIL_WORKERS) send them. Every worker keeps its
+# SMTP connection open and sends whatever is waiting in the queue over it (up to MAIL_BATCH_SIZE messages at a time).
+# The connection is closed when the worker has had nothing to do for MAIL_IDLE_TIMEOUT seconds.
+#
+# The queue has a limited size (MAIL_QUEUE_SIZE). When it's full, send() waits a bit for the workers to catch up
+# (backpressure), and if that doesn't help, the email is dropped and the error is logged.
+# When sending fails because of an SMTP or network error, the worker reconnects and tries again, waiting longer
+# after each attempt (MAIL_RETRY_DELAY, doubled every time, at most MAIL_MAX_RETRIES times).
+# When the process exits, the workers send everything that's still in the queue before stopping.
+import atexit
+import socket
+import smtplib
+import threading
+import time
+try:
+    import Queue as queue   # Python 2
+except ImportError:
+    import queue            # Python 3
+from flask.ext.mail import Connection
+from app import app
+
+STOP = object()     # put into the queue to tell a worker to stop
+
+
+def open_connection(state=None):
+    """ Opens an SMTP connection the way Flask-Mail does, but doesn't close it after one message.
+    :param state: Flask-Mail settings (what Mail.init_mail returns), defaults to the settings of our application
+    :return: a Flask-Mail Connection object; close it with close_connection
+    """
+    connection = Connection(state or app.extensions['mail'])
+    return connection.__enter__()
+
+
+def close_connection(connection):
+    try:
+        connection.__exit__(None, None, None)
+    except (smtplib.SMTPException, socket.error):
+        pass    # the server has probably closed the connection already
+
+
+class MailDispatcher(object):
+    def __init__(self, workers=None, queue_size=None, batch_size=None, max_retries=None, retry_delay=None,
+                 idle_timeout=None, put_timeout=None, connect=open_connection):
+        """ The settings that are not given are taken from the application configuration.
+        :param connect: function that opens an SMTP connection, see open_connection
+        """
+        config = app.config
+        self.workers = workers or config.get('MAIL_WORKERS', 2)
+        self.batch_size = batch_size or config.get('MAIL_BATCH_SIZE', 20)
+        self.max_retries = max_retries if max_retries is not None else config.get('MAIL_MAX_RETRIES', 3)
+        self.retry_delay = retry_delay if retry_delay is not None else config.get('MAIL_RETRY_DELAY', 1.0)
+        self.idle_timeout = idle_timeout or config.get('MAIL_IDLE_TIMEOUT', 30)
+        self.put_timeout = put_timeout if put_timeout is not None else config.get('MAIL_PUT_TIMEOUT', 5)
+        self.connect = connect
+        self.queue = queue.Queue(queue_size or config.get('MAIL_QUEUE_SIZE', 1000))
+        self.threads = []
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        """ Starts the worker threads, if they are not running yet. It's called by send(), so the threads are started
+        only when the first email is sent.
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='mail-worker-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def send(self, msg):
+        """ Puts an email into the queue.
+        :param msg: a Flask-Mail Message
+        :return: True if the email is in the queue, False if the queue was full and the email was dropped
+        """
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            app.logger.error('Mail queue is full, dropping email "{}" to {}'.format(msg.subject, msg.recipients))
+            return False
+
+    def depth(self):
+        """
+        :return: number of emails waiting in the queue
+        """
+        return self.queue.qsize()
+
+    def work(self):
+        """ The main loop of a worker thread. """
+        connection = None
+        stop = False
+        while not stop:
+            try:
+                msg = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # nothing to do for a while, no need to keep the server busy
+                if connection is not None:
+                    close_connection(connection)
+                    connection = None
+                continue
+            batch = []
+            while msg is not STOP:
+                batch.append(msg)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    msg = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stop = msg is STOP
+            with app.app_context():     # Flask-Mail needs the application context for sending
+                for msg in batch:
+                    connection = self.deliver(connection, msg)
+                    self.queue.task_done()
+            if stop:
+                self.queue.task_done()
+        if connection is not None:
+            close_connection(connection)
+
+    def deliver(self, connection, msg):
+        """ Sends one email, reconnecting and retrying if the SMTP server or the network fails.
+        :return: the connection to use for the next email (None if there's no open connection)
+        """
+        attempt = 0
+        while True:
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.send(msg)
+                self.sent += 1
+                return connection
+            except (smtplib.SMTPException, socket.error) as e:
+                if connection is not None:
+                    close_connection(connection)
+                    connection = None
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.failed += 1
+                    app.logger.error('Could not send email "{}" to {}: {}'.format(msg.subject, msg.recipients, e))
+                    return None
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            except Exception as e:
+                # something is wrong with the message itself, retrying won't help
+                self.failed += 1
+                app.logger.error('Could not send email "{}" to {}: {}'.format(msg.subject, msg.recipients, e))
+                return connection
+
+    def shutdown(self, timeout=None):
+        """ Stops the workers, after they have sent all the emails that are in the queue. """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            try:
+                self.queue.put(STOP, timeout=self.put_timeout)
+            except queue.Full:
+                # the workers are stuck and the queue is full, there's no point in waiting for them
+                app.logger.error('Mail workers are not responding, {} emails are not sent'.format(self.depth()))
+                return
+        for thread in threads:
+            thread.join(timeout)
+
+
+mail_dispatcher = MailDispatcher()
+atexit.register(mail_dispatcher.shutdown)
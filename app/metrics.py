@@ -0,0 +1,235 @@
+# Always-on instrumentation of the application, exposed in the Prometheus text format on /metrics.
+#
+# For every endpoint we keep:
+#     - a histogram of the request latency (time from the start of the request to the end of the view),
+#     - the number of requests by status code,
+#     - the number of SQL statements and the time spent in them (measured with SQLAlchemy engine events),
+#     - the time spent rendering templates (measured with the Flask template signals).
+# Plus the gauges of the background work: the mail queue, the language detection queue, the translator and caches.
+# All this is a few counters per request, cheap enough to stay on in production.
+#
+# Requests that take longer than SLOW_REQUEST_THRESHOLD seconds are logged as warnings, with the list of the SQL
+# statements they executed and the time of each one (at most SLOW_REQUEST_MAX_QUERIES of them).
+#
+# The numbers live in the process memory, so every process of the application reports its own.
+import threading
+import time
+from flask import g, request, request_started, before_render_template, template_rendered, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app, db
+from .decorators import admin_required
+from .sqlstats import statement_count
+from .mailqueue import mail_dispatcher
+from .langdetect import language_detector
+from . import translate
+from .usercache import user_cache
+from .fragments import post_fragments
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)    # upper bounds in seconds
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # the last one is for the values above all the bounds (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of tuples (upper bound as text, number of values up to that bound), like Prometheus wants them
+        """
+        result = []
+        total = 0
+        for bound, count in zip([repr(b) for b in self.buckets] + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}           # endpoint -> Histogram
+        self.responses = {}         # (endpoint, status code) -> number of responses
+        self.sql_statements = {}    # endpoint -> number of SQL statements
+        self.sql_seconds = {}       # endpoint -> time spent in SQL statements
+        self.template_seconds = {}  # endpoint -> time spent rendering templates
+        self.slow_requests = 0
+
+    def observe_request(self, endpoint, status, seconds, statements, sql_seconds, template_seconds):
+        with self.lock:
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = Histogram()
+            histogram.observe(seconds)
+            self.responses[(endpoint, status)] = self.responses.get((endpoint, status), 0) + 1
+            self.sql_statements[endpoint] = self.sql_statements.get(endpoint, 0) + statements
+            self.sql_seconds[endpoint] = self.sql_seconds.get(endpoint, 0.0) + sql_seconds
+            self.template_seconds[endpoint] = self.template_seconds.get(endpoint, 0.0) + template_seconds
+
+    def slow_request(self):
+        with self.lock:
+            self.slow_requests += 1
+
+    def clear(self):
+        with self.lock:
+            self.latency = {}
+            self.responses = {}
+            self.sql_statements = {}
+            self.sql_seconds = {}
+            self.template_seconds = {}
+            self.slow_requests = 0
+
+    def render(self):
+        """
+        :return: all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, escape(value)) for key, value in labels)
+                lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if label_text else '',
+                                                format_value(value)))
+
+        with self.lock:
+            samples = []
+            for endpoint, histogram in sorted(self.latency.items()):
+                for bound, count in histogram.cumulative():
+                    samples.append(('_bucket', [('endpoint', endpoint), ('le', bound)], count))
+                samples.append(('_sum', [('endpoint', endpoint)], histogram.sum))
+                samples.append(('_count', [('endpoint', endpoint)], histogram.count))
+            metric('microblog_request_duration_seconds', 'histogram', 'Request latency by endpoint.', samples)
+            metric('microblog_responses_total', 'counter', 'Responses by endpoint and status code.',
+                   [('', [('endpoint', endpoint), ('status', str(status))], count)
+                    for (endpoint, status), count in sorted(self.responses.items())])
+            metric('microblog_sql_statements_total', 'counter', 'SQL statements executed by requests.',
+                   [('', [('endpoint', endpoint)], count) for endpoint, count in sorted(self.sql_statements.items())])
+            metric('microblog_sql_seconds_total', 'counter', 'Time spent in SQL statements by requests.',
+                   [('', [('endpoint', endpoint)], s) for endpoint, s in sorted(self.sql_seconds.items())])
+            metric('microblog_template_seconds_total', 'counter', 'Time spent rendering templates.',
+                   [('', [('endpoint', endpoint)], s) for endpoint, s in sorted(self.template_seconds.items())])
+            metric('microblog_slow_requests_total', 'counter', 'Requests slower than SLOW_REQUEST_THRESHOLD.',
+                   [('', [], self.slow_requests)])
+        metric('microblog_write_lock_timeouts_total', 'counter', 'Writes that failed waiting for the write lock.',
+               [('', [], db.write_lock.timeouts if db.write_lock is not None else 0)])
+        metric('microblog_mail_queue_depth', 'gauge', 'Emails waiting to be sent.',
+               [('', [], mail_dispatcher.depth())])
+        metric('microblog_mail_total', 'counter', 'Emails handled by the mail workers.',
+               [('', [('result', 'sent')], mail_dispatcher.sent), ('', [('result', 'failed')], mail_dispatcher.failed),
+                ('', [('result', 'dropped')], mail_dispatcher.dropped)])
+        metric('microblog_language_queue_depth', 'gauge', 'Posts waiting for language detection.',
+               [('', [], language_detector.depth())])
+        metric('microblog_translate_queue_depth', 'gauge', 'Translations waiting for the translation service.',
+               [('', [], translate.translator.waiting)])
+        metric('microblog_translator_requests_total', 'counter', 'Requests sent to the translation service.',
+               [('', [('host', host)], count) for host, count in sorted(translate.translator.requests.items())])
+        metric('microblog_cache_hit_ratio', 'gauge', 'Share of the lookups that were found in the cache.',
+               [('', [('cache', 'translations')], translate.translator.cache.hit_ratio()),
+                ('', [('cache', 'users')], user_cache.cache.hit_ratio()),
+                ('', [('cache', 'posts')], post_fragments.hit_ratio())])
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+
+
+def enabled():
+    return app.config.get('METRICS_ENABLED', True)
+
+
+@request_started.connect_via(app)
+def start_request(sender, **extra):
+    g.metrics_start = time.time()
+    g.sql_seconds = 0.0
+    g.sql_queries = []
+    g.template_seconds = 0.0
+    g.template_depth = 0
+
+
+# The start time is kept on the execution context of the statement, which goes away with it. (Not on the
+# connection: a statement that fails, or one outside a real request, would leave it there for the next user of the
+# pooled connection.)
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None or not has_request_context() or not hasattr(g, 'sql_queries'):
+        return
+    seconds = time.time() - start
+    g.sql_seconds += seconds
+    if len(g.sql_queries) < app.config.get('SLOW_REQUEST_MAX_QUERIES', 100):
+        g.sql_queries.append((statement, seconds))
+
+
+@before_render_template.connect_via(app)
+def start_template(sender, template, context, **extra):
+    if hasattr(g, 'template_depth'):
+        if g.template_depth == 0:
+            g.template_start = time.time()
+        g.template_depth += 1
+
+
+@template_rendered.connect_via(app)
+def end_template(sender, template, context, **extra):
+    # templates rendered from other templates (render_post) are part of the outer one, they're not counted twice
+    if getattr(g, 'template_depth', 0) > 0:
+        g.template_depth -= 1
+        if g.template_depth == 0:
+            g.template_seconds += time.time() - g.template_start
+
+
+@app.after_request
+def remember_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_request(exception):
+    start = getattr(g, 'metrics_start', None)
+    if start is None or not enabled():
+        return
+    seconds = time.time() - start
+    endpoint = request.endpoint or 'none'       # requests that didn't match any route (404)
+    statements = statement_count()
+    metrics.observe_request(endpoint, getattr(g, 'metrics_status', 500), seconds, statements, g.sql_seconds,
+                            g.template_seconds)
+    if seconds >= app.config.get('SLOW_REQUEST_THRESHOLD', 1.0):
+        metrics.slow_request()
+        app.logger.warning('Slow request: {} {} took {:.0f} ms, {} SQL statements in {:.0f} ms, templates {:.0f} ms\n'
+                           '{}'.format(request.method, request.full_path, seconds * 1000, statements,
+                                       g.sql_seconds * 1000, g.template_seconds * 1000,
+                                       '\n'.join('    {:.1f} ms: {}'.format(s * 1000, ' '.join(statement.split()))
+                                                 for statement, s in g.sql_queries)))
+
+
+@app.route('/metrics')
+@admin_required
+def metrics_view():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,14 +1,10 @@
 from app import db    # this is our database object, created in __init_py__
 from app import app    # this is our flask application object, created in __init_py__
 from hashlib import md5   # we'll need this for the avatars from Gravatar
-
-import sys
-if sys.version_info >= (3, 0):
-    enable_search = False
-else:
-    enable_search = True
-    import flask.ext.whooshalchemy as whooshalchemy
-
+from collections import namedtuple, Counter
+from functools import lru_cache
+from sqlalchemy.orm import Bundle, validates, object_session
+from .followcache import FollowGraph
 
 # For the many-to-many table that will record followers we're not using a model like for
 # other tables. Since this is an auxiliary table that has no data other than the foreign keys,
@@ -19,9 +15,44 @@ else:
 # The 'followers' is just an object that defines a table, it doesn't contain data.
 # The actual data in this table will be maintained through relationships of the User objects ('followed' and
 # 'followers').
+# The primary key (follower_id, followed_id) finds the users someone follows and answers "does A follow B", the
+# index in the other direction (followed_id, follower_id) finds and counts the followers of a user. Both are
+# covering, so SQLite never has to read the table itself. See db_repository/versions/010_migration.py.
 followers = db.Table('followers',
-                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Index('ix_followers_followed_id', 'followed_id', 'follower_id'))
+
+# In-process cache of the followers table, it answers is_following() and the follower counts without SQL.
+# See followcache.py.
+follow_graph = FollowGraph(followers)
+
+# Materialized home timelines. Every row of this table says "this post belongs on this user's home page".
+# The rows are written when a post is created (fan-out on write, see timeline.py), so building a home page
+# becomes a lookup on (user_id, timestamp) instead of a join of the whole post table with followers.
+# Like followers, this is an auxiliary table without a model.
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id'),
+                    db.Index('ix_timeline_post_id', 'post_id'))
+
+# Follow events waiting to be sent to the followed users. Instead of sending an email for every follow, the events
+# are collected here and a periodic job sends one digest per user (see send_follower_digests in emails.py).
+notification = db.Table('notification',
+                        db.Column('id', db.Integer, primary_key=True),
+                        db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+                        db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
+                        db.Column('timestamp', db.DateTime),
+                        db.Index('ix_notification_user_id', 'user_id'))
+
+# How far the bulk import (see bulkload.py) got in each of its files. The row is written in the transaction of the
+# batch it counts, so it can't get ahead of or behind the data.
+import_checkpoint = db.Table('import_checkpoint',
+                             db.Column('path', db.String(255), primary_key=True),
+                             db.Column('kind', db.String(16)),
+                             db.Column('rows', db.Integer))
 
 class User(db.Model):
     ''' This class represents a record in User database table
@@ -29,6 +60,9 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nickname = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    # MD5 hash of the email, which is what Gravatar needs for the avatar URL. We keep it in the database so that we
+    # don't have to calculate it every time an avatar is displayed. It's kept in sync by update_avatar_hash.
+    avatar_hash = db.Column(db.String(32))
     # This is not an actual database field. With this relationship we get a user.posts member
     # that gets us the list of posts from the user.
     # The backref argument defines a field that will be added to the objects of the Post class
@@ -37,6 +71,14 @@ class User(db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    # True for users with so many followers that copying each of their posts into every follower's timeline
+    # would be too expensive. Their posts are not fanned out, and their followers' home pages fall back to
+    # the followed_posts() join (see timeline.py).
+    timeline_pull = db.Column(db.Boolean, default=False)
+    # Goes up every time the posts on the user's pages change: when one of his posts is written, changed (its
+    # language detected) or deleted, and when he follows or unfollows someone (his home page changes). The ETags of
+    # the pages are built from it (see conditional.py).
+    posts_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     # Relationship to get a list of followed users. This list acts as a member of objects of this class
     # and we can work with this list as with any other list (count it, get first or last element, ...).
     followed = db.relationship('User',                                           # We're ultimately linking to
@@ -94,12 +136,21 @@ class User(db.Model):
         except NameError:
             return str(self.id)        # this works in Python 3
 
+    @validates('email')
+    def update_avatar_hash(self, key, email):
+        """ SQLAlchemy calls this every time the email is set (also in the constructor), so the avatar hash
+        can never get out of sync with the email.
+        :return: the email, unchanged
+        """
+        self.avatar_hash = email_hash(email) if email is not None else None
+        return email
+
     def avatar(self, size):
         """
         :param size: the size of the avatar image you need
         :return: returns the URL of the user's avatar image, scaled to the requested size in pixels.
         """
-        return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (md5(self.email.encode('utf-8')).hexdigest(), size)
+        return gravatar_url(self.avatar_hash, size)
 
     @staticmethod        # because this method does not apply to any particular instance of the User class
     def make_unique_nickname(nickname):
@@ -108,14 +159,56 @@ class User(db.Model):
         :param nickname: the nickname we want to check for uniqueness
         :return: a new nickname with added suffix to make it unique
         """
+        # We used to check the nicknames one by one (john, john2, john3, ...), which was one query per taken
+        # nickname. Now we fetch all the nicknames that start with the given one in a single query, and look for
+        # a free suffix in memory.
+        # The prefix is given as a range (nickname >= 'john' and nickname < 'joho') instead of LIKE 'john%',
+        # because SQLite can use the index on nickname for a range, but not for a case-insensitive LIKE.
+        query = db.session.query(User.nickname).filter(User.nickname >= nickname)
+        if nickname:
+            query = query.filter(User.nickname < nickname[:-1] + chr(ord(nickname[-1]) + 1))
+        taken = set(taken_nickname for (taken_nickname,) in query)
         new_nickname = nickname
         suffix = 1
-        while User.query.filter_by(nickname=new_nickname).first():
-            # query has returned a user, increase suffix and generate a new nickname
+        while new_nickname in taken:
+            # this nickname is taken, increase suffix and generate a new nickname
             suffix += 1
             new_nickname = nickname + str(suffix)
         return new_nickname
 
+    @staticmethod
+    def make_unique_nicknames(nicknames, chunk_size=200):
+        """ make_unique_nickname for many nicknames at once, for the bulk import (see bulkload.py).
+        The nicknames are checked with a few queries for the whole list (not one query per nickname), and they are
+        also made unique among themselves: two johns become john and john2.
+        :param nicknames: list of the nicknames we want
+        :param chunk_size: maximum number of nicknames checked in one query
+        :return: list of unique nicknames, in the same order
+        """
+        counts = Counter(nicknames)
+        wanted = list(counts)
+        taken = set()
+        for start in range(0, len(wanted), chunk_size):
+            taken.update(nickname for (nickname,) in db.session.query(User.nickname).
+                         filter(User.nickname.in_(wanted[start:start + chunk_size])))
+        # For the nicknames that are taken, or wanted more than once, we need all the nicknames that start with them
+        # (the same ranges as in make_unique_nickname), then the free suffixes are found in memory.
+        colliding = [nickname for nickname in wanted if nickname and (nickname in taken or counts[nickname] > 1)]
+        for start in range(0, len(colliding), chunk_size):
+            taken.update(nickname for (nickname,) in db.session.query(User.nickname).filter(db.or_(
+                *[db.and_(User.nickname >= nickname, User.nickname < nickname[:-1] + chr(ord(nickname[-1]) + 1))
+                  for nickname in colliding[start:start + chunk_size]])))
+        result = []
+        for nickname in nicknames:
+            new_nickname = nickname
+            suffix = 1
+            while new_nickname in taken:
+                suffix += 1
+                new_nickname = nickname + str(suffix)
+            taken.add(new_nickname)
+            result.append(new_nickname)
+        return result
+
     # The follow and unfollow methods are amazingly simple, thanks to the power of sqlalchemy who does a lot of
     # work under the covers. We just add or remove items from the followed relationship and sqlalchemy takes care
     # of managing the association table for us.
@@ -130,6 +223,9 @@ class User(db.Model):
         """
         if not self.is_following(user_to_follow):
             self.followed.append(user_to_follow)
+            if self.id is not None and user_to_follow.id is not None:
+                follow_graph.add(self.id, user_to_follow.id, object_session(self))
+                self.posts_version = User.posts_version + 1     # in SQL, two requests can't both write 1
             return self
 
     def unfollow(self, user_to_unfollow):
@@ -139,6 +235,9 @@ class User(db.Model):
         """
         if self.is_following(user_to_unfollow):
             self.followed.remove(user_to_unfollow)
+            if self.id is not None and user_to_unfollow.id is not None:
+                follow_graph.remove(self.id, user_to_unfollow.id, object_session(self))
+                self.posts_version = User.posts_version + 1
             return self
 
     def is_following(self, user):
@@ -146,7 +245,26 @@ class User(db.Model):
         :param user: we want to check if we're following that user
         :return: True or False
         """
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        if self.id is None or user.id is None or not follow_graph.enabled():
+            # users that are not in the database yet are not in the cache either
+            return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return follow_graph.is_following(self.id, user.id)
+
+    def follower_count(self):
+        """
+        :return: number of followers of this user (including the user himself), without an SQL query
+        """
+        if not follow_graph.enabled():
+            return self.followers.count()
+        return follow_graph.follower_count(self.id)
+
+    def followed_count(self):
+        """
+        :return: number of users this user follows (including himself), without an SQL query
+        """
+        if not follow_graph.enabled():
+            return self.followed.count()
+        return follow_graph.followed_count(self.id)
 
     def followed_posts(self):
         return ((Post.query.join(followers,                                  # join Post query with followers table
@@ -156,19 +274,102 @@ class User(db.Model):
                ).order_by(Post.timestamp.desc())                # and order them by time, descending
 
 
+# The language of the posts whose language couldn't be detected (the ISO 639 code for "undetermined"). A post whose
+# language wasn't detected yet has NULL (see langdetect.py).
+UNDETERMINED_LANGUAGE = 'und'
+
+
+def known_language(language):
+    """
+    :return: the language of a post, None if it's not known (not detected yet, or undetermined)
+    """
+    return language if language and language != UNDETERMINED_LANGUAGE else None
+
+
 class Post(db.Model):
     ''' This class represents a record in Post database table
     '''
-    __searchable__ = ['body']    # this indicates that body column will be indexed by Flask-WhooshAlchemy
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    # The posts of a user, newest first (profile pages, the join in followed_posts), are read from this index.
+    # AUTOINCREMENT: without it SQLite gives a new post the biggest id in the table plus one, which would reuse the
+    # ids of the newest posts after they're archived (see archive.py).
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'), {'sqlite_autoincrement': True})
 
     def __repr__(self):
-        return '<Post "{}" by {}>'.format(self.body, self.author.nickname)
+        # not using self.author here, that would load the author from the database just for printing the post
+        return '<Post "{}" by user {}>'.format(self.body, self.user_id)
+
+
+class ArchivedPost(db.Model):
+    ''' A post that was moved out of the post table because it's old (see archive.py). The columns are the same as
+    in Post, and so is the id - a post keeps its id when it's archived.
+    '''
+    __tablename__ = 'post_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    language = db.Column(db.String(5))
+    __table_args__ = (db.Index('ix_post_archive_user_id_timestamp', 'user_id', 'timestamp'),)
+
+    def __repr__(self):
+        return '<ArchivedPost "{}" by user {}>'.format(self.body, self.user_id)
+
+
+def email_hash(email):
+    """
+    :param email: email address of a user
+    :return: the hash that identifies the user on Gravatar (stored in User.avatar_hash)
+    """
+    return md5(email.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)    # the same avatars show up on every page, there's no need to format their URLs every time
+def gravatar_url(avatar_hash, size):
+    """
+    :param avatar_hash: the avatar_hash of a user
+    :param size: the size of the avatar image you need
+    :return: the URL of the Gravatar image
+    """
+    return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (avatar_hash, size)
+
+
+class PostRow(namedtuple('PostRow', ['id', 'body', 'timestamp', 'language', 'user_id',
+                                     'author_nickname', 'author_avatar_hash'])):
+    """ A lightweight, read-only version of a post, together with the bits of its author that we need for
+    displaying the post (see post.html). It's a tuple, so it's much cheaper to create than a Post object,
+    and there's no way for it to trigger lazy loading of anything.
+    """
+    __slots__ = ()
+
+    def author_avatar(self, size):
+        return gravatar_url(self.author_avatar_hash, size)
+
+    @property
+    def known_language(self):
+        return known_language(self.language)
+
+
+class PostRowBundle(Bundle):
+    """ A bundle of columns that comes out of the query as one PostRow instead of a plain tuple. """
+    def create_row_processor(self, query, procs, labels):
+        def proc(row):
+            return PostRow(*[p(row) for p in procs])
+        return proc
 
 
-if enable_search:
-    whooshalchemy.whoosh_index(app, Post)
\ No newline at end of file
+def post_rows(query, model=Post):
+    """ Turns a query of posts into a query of PostRow tuples.
+    The author of every post is fetched in the same SELECT (a join with the user table), so displaying a page of
+    posts doesn't issue one more query per post to load post.author.
+    :param query: a query of posts, e.g. user.followed_posts() or user.posts
+    :param model: Post, or ArchivedPost for a query of archived posts
+    :return: a query that returns PostRow objects
+    """
+    return query.join(User, User.id == model.user_id).\
+        with_entities(PostRowBundle('post', model.id, model.body, model.timestamp, model.language, model.user_id,
+                                    User.nickname, User.avatar_hash, single_entity=True))
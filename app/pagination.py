@@ -0,0 +1,138 @@
+# Keyset (cursor) pagination.
+#
+# Flask-SQLAlchemy's paginate() uses LIMIT/OFFSET and an extra COUNT query. With OFFSET the database still has to
+# read and throw away all the rows of the previous pages, so page 1000 is a thousand times more expensive than
+# page 1, and the COUNT reads the whole result set on every page.
+# Here a page is addressed by a cursor instead: the (timestamp, id) of the post where the page starts. Getting
+# the next page is then "give me N posts older than this one", which is a simple index range scan no matter how
+# deep we are. The price is that we don't know the total number of pages, so there are only "Newer"/"Older" links.
+from datetime import datetime
+from sqlalchemy import and_, or_
+from flask import abort
+from .models import Post, ArchivedPost
+
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(post):
+    """
+    :param post: a post (or anything that has the timestamp and id attributes)
+    :return: a string that can be used in URLs to address the position of this post, e.g. '20141219103011000000-42'
+    """
+    return '{}-{}'.format(post.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), post.id)
+
+
+def parse_cursor(cursor):
+    """ The opposite of make_cursor. Aborts with 404 if someone has tampered with the cursor in the URL.
+    :param cursor: a string created by make_cursor
+    :return: a tuple (timestamp, id)
+    """
+    try:
+        timestamp, post_id = cursor.split('-')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(post_id)
+    except ValueError:
+        abort(404)
+
+
+def position(post):
+    """ The sort key of posts, in the order of the cursors. """
+    return post.timestamp, post.id
+
+
+def merge_newest_first(iterables):
+    """ Merges lists (or streams) of posts, each of them newest first, into one stream, newest first. Used for the
+    post table and the archive: the posts in the post table are mostly newer than the archived ones, but not all of
+    them (the archiver hasn't run yet, or an old post was imported).
+    :param iterables: the posts of each tier
+    :return: generator of the posts
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    heads = [next(iterator, None) for iterator in iterators]
+    while True:
+        tiers = [tier for tier, head in enumerate(heads) if head is not None]
+        if not tiers:
+            return
+        newest = max(tiers, key=lambda tier: position(heads[tier]))
+        yield heads[newest]
+        heads[newest] = next(iterators[newest], None)
+
+
+def newest_first(query, before=None, timestamp_column=Post.timestamp, id_column=Post.id):
+    """ Orders a query of posts from the newest to the oldest, starting after the cursor.
+    :param query: a query of posts. Its ordering doesn't matter, it will be replaced.
+    :param before: a cursor; if given, the query starts with the first post older than the cursor
+    :return: the ordered query, without a limit
+    """
+    query = query.order_by(None)
+    if before is not None:
+        timestamp, post_id = parse_cursor(before)
+        query = query.filter(or_(timestamp_column < timestamp,
+                                 and_(timestamp_column == timestamp, id_column < post_id)))
+    return query.order_by(timestamp_column.desc(), id_column.desc())
+
+
+class KeysetPage(object):
+    """ One page of posts, fetched with a keyset query. It's used in the templates similar to the Pagination
+    object we get from paginate(): the posts are in items, and has_newer/has_older with newer_cursor/older_cursor
+    are used for building the navigation links.
+    """
+    def __init__(self, query, per_page, before=None, after=None, timestamp_column=Post.timestamp,
+                 id_column=Post.id, archive=None):
+        """
+        :param query: a query of posts. Its ordering doesn't matter, it will be replaced.
+        :param per_page: number of posts on a page
+        :param before: a cursor; if given, the page starts with the first post older than the cursor
+        :param after: a cursor; if given, the page ends with the last post newer than the cursor
+        :param timestamp_column: the column we're sorting by
+        :param id_column: the column that breaks the ties between posts with the same timestamp
+        :param archive: the same query over the archived posts (see archive.py). A page is merged from both.
+        """
+        tiers = [(query.order_by(None), timestamp_column, id_column)]
+        if archive is not None:
+            tiers.append((archive.order_by(None), ArchivedPost.timestamp, ArchivedPost.id))
+        if after is not None:
+            # We're going back towards the newest posts. We have to read them in ascending order (the ones
+            # right after the cursor first), and then turn the list around.
+            timestamp, post_id = parse_cursor(after)
+            rows = []
+            for tier_query, tier_timestamp, tier_id in tiers:
+                rows += tier_query.filter(or_(tier_timestamp > timestamp,
+                                              and_(tier_timestamp == timestamp, tier_id > post_id))).\
+                    order_by(tier_timestamp.asc(), tier_id.asc()).limit(per_page + 1).all()
+            rows = sorted(rows, key=position)[:per_page + 1]
+            self.has_newer = len(rows) > per_page
+            self.has_older = True
+            rows = rows[:per_page]
+            rows.reverse()
+        else:
+            # We're reading one post more than we need, just to find out if there is another page. Any of the tiers
+            # can have the posts of the page, so we read a page from each of them and merge them.
+            rows = list(merge_newest_first(newest_first(tier_query, before, tier_timestamp, tier_id).
+                                           limit(per_page + 1).all()
+                                           for tier_query, tier_timestamp, tier_id in tiers))
+            self.has_newer = before is not None
+            self.has_older = len(rows) > per_page
+            rows = rows[:per_page]
+        self.items = rows
+        self.per_page = per_page
+        if not rows:
+            # there's nothing to point the cursors at, the only way out is back to the newest posts
+            self.has_older = False
+
+    @property
+    def newer_cursor(self):
+        """
+        :return: cursor for the page with newer posts, or None if that page is the first page
+        """
+        if self.has_newer and self.items:
+            return make_cursor(self.items[0])
+        return None
+
+    @property
+    def older_cursor(self):
+        """
+        :return: cursor for the page with older posts
+        """
+        if self.has_older:
+            return make_cursor(self.items[-1])
+        return None
@@ -0,0 +1,112 @@
+# Query plans of the hot queries.
+#
+# An index that is missing (or a query that was changed so that SQLite can't use the index any more) doesn't break
+# anything, the query just reads the whole table. With the handful of rows in tests.py nobody notices, with a
+# million posts every page does. So we ask SQLite how it would run each of the hot queries (EXPLAIN QUERY PLAN)
+# and look for steps that read a whole table:
+#     SEARCH post USING INDEX ix_post_user_id_timestamp (user_id=?)      fine, a lookup in an index
+#     SCAN post                                                         a full table scan
+#     SCAN followers USING COVERING INDEX ix_followers_followed_id      a scan of the whole index, just as bad
+# Scans of subqueries (SCAN anon_1) and of the full text index are not scans of a table and are ignored.
+# The paged queries must also come out of the index in the order of the page:
+#     USE TEMP B-TREE FOR ORDER BY                                      all the matching rows are read and sorted
+# means every page reads and sorts the whole timeline, just to return the first ten posts. The queries that merge
+# the posts of many authors (followed_posts, the fallback of the timelines, and the archived timeline) can't avoid
+# the sort, they are left out.
+# tests.py runs check() on every test run, so a query plan regression fails the tests.
+import re
+from datetime import datetime
+from sqlalchemy import event
+from app import db
+from .models import User, Post, ArchivedPost, followers, post_rows
+from . import timeline, archive
+from .pagination import make_cursor, newest_first
+from .conditional import validators_query, user_version, timeline_version
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+TEMP_SORT = re.compile(r'^USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY')
+
+
+def explain(query):
+    """
+    :param query: an SQLAlchemy query (ORM query or Core select)
+    :return: list of the steps of its query plan, the detail text of each row of EXPLAIN QUERY PLAN
+    """
+    statement = getattr(query, 'statement', query)
+
+    def prefix(conn, cursor, sql, parameters, context, executemany):
+        return 'EXPLAIN QUERY PLAN ' + sql, parameters
+
+    # The statement is executed the usual way, so the parameters are processed like in the real query, and the
+    # text of the statement gets the prefix just before it goes to the database.
+    with db.engine.connect() as connection:
+        event.listen(connection, 'before_cursor_execute', prefix, retval=True)
+        return [row[-1] for row in connection.execute(statement).fetchall()]
+
+
+def table_scans(plan):
+    """
+    :param plan: list of steps returned by explain()
+    :return: the steps that read a whole table or a whole index of a table
+    """
+    tables = set(db.metadata.tables)
+    return [step for step in plan if SCAN.match(step) and SCAN.match(step).group(1) in tables]
+
+
+def temp_sorts(plan):
+    """
+    :param plan: list of steps returned by explain()
+    :return: the steps that sort the rows, because they don't come out of an index in the right order
+    """
+    return [step for step in plan if TEMP_SORT.match(step)]
+
+
+def hot_queries(user, other):
+    """ The queries of the pages everybody keeps loading, as the views build them.
+    :param user: the logged in user
+    :param other: another user, whose profile the logged in user looks at
+    :return: list of tuples (name, query, True if the query is paged and must not sort)
+    """
+    post = Post.query.order_by(Post.id.desc()).first() or Post(id=0, timestamp=datetime.utcnow())
+    home_timeline, timestamp_column, id_column = timeline.home_timeline_keys(user)
+    # without the timelines (or with authors that aren't fanned out) the home page is followed_posts, which sorts
+    from_timeline = timestamp_column is not Post.timestamp
+    return [('followed_posts', post_rows(user.followed_posts()).limit(10), False),
+            ('home_timeline', newest_first(post_rows(home_timeline), None, timestamp_column, id_column).limit(10),
+             from_timeline),
+            ('home_timeline_before', newest_first(post_rows(home_timeline), make_cursor(post), timestamp_column,
+                                                  id_column).limit(10), from_timeline),
+            ('home_validators', validators_query(home_timeline, timeline_version(user.id),
+                                                 (timestamp_column, id_column)), from_timeline),
+            ('user_posts', newest_first(post_rows(other.posts)).limit(10), True),
+            ('user_posts_before', newest_first(post_rows(other.posts), make_cursor(post)).limit(10), True),
+            ('user_validators', validators_query(other.posts, user_version(other.id)), True),
+            ('archived_user_posts', newest_first(post_rows(archive.user_posts(other), ArchivedPost),
+                                                 make_cursor(post), ArchivedPost.timestamp, ArchivedPost.id).limit(10),
+             True),
+            ('archived_followed_posts', newest_first(post_rows(archive.followed_posts(user), ArchivedPost),
+                                                     make_cursor(post), ArchivedPost.timestamp,
+                                                     ArchivedPost.id).limit(10), False),
+            ('is_following', user.followed.filter(followers.c.followed_id == other.id), False),
+            ('follower_count', db.session.query(db.func.count()).select_from(followers).
+                filter(followers.c.followed_id == other.id), False),
+            ('followed_count', db.session.query(db.func.count()).select_from(followers).
+                filter(followers.c.follower_id == user.id), False),
+            ('followers_page', User.query.join(followers, followers.c.follower_id == User.id).
+                filter(followers.c.followed_id == other.id, followers.c.follower_id > 0).
+                order_by(followers.c.follower_id).limit(10), True),
+            ('user_by_nickname', User.query.filter_by(nickname=other.nickname), False)]
+
+
+def check(user, other):
+    """ Explains all the hot queries.
+    :return: dictionary query name -> the steps that scan a table (or sort a paged query), only for the queries
+             that have such steps
+    """
+    result = {}
+    for name, query, paged in hot_queries(user, other):
+        plan = explain(query)
+        problems = table_scans(plan) + (temp_sorts(plan) if paged else [])
+        if problems:
+            result[name] = problems
+    return result
@@ -0,0 +1,186 @@
+# Sampling profiler that can be switched on at runtime, on a production worker.
+#
+# profile.py runs every request under cProfile, which makes the requests several times slower - fine for the
+# development server, useless for finding out why production is slow. This profiler doesn't trace anything: a
+# background thread wakes up every SAMPLER_INTERVAL seconds, looks at the stacks of the threads that are handling
+# a sampled request (sys._current_frames()) and counts them. Only a share of the requests is sampled, and only while
+# the profiler is on (for a limited time), so the overhead stays small.
+#
+# The stacks are counted per endpoint, in the "collapsed" format of the FlameGraph tools (one line per distinct
+# stack, frames separated by semicolons, followed by the number of samples), which flamegraph.pl or speedscope turn
+# into a flame graph. The administrators control it with:
+#     POST /admin/profiler/start?percent=10&seconds=60    sample 10% of the requests for the next minute
+#     POST /admin/profiler/stop
+#     GET  /admin/profiler                                status
+#     GET  /admin/profiler/stacks[?endpoint=index]        download the collapsed stacks
+# Starting and stopping need the ADMIN_TOKEN in the Authorization header, being logged in as an administrator is
+# not enough for them (see admin_token_required).
+import random
+import sys
+import threading
+import time
+from flask import g, request, request_started, jsonify
+from app import app
+from .decorators import admin_required, admin_token_required
+
+
+class Sampler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.rate = 0.0             # share of the requests that are sampled
+        self.until = 0              # time when the profiler switches itself off
+        self.interval = 0.01        # seconds between two samples
+        self.threads = {}           # id of a thread handling a sampled request -> endpoint
+        self.stacks = {}            # endpoint -> {collapsed stack -> number of samples}
+        self.samples = 0
+        self.thread = None
+
+    def start(self, rate=0.1, seconds=60, interval=None):
+        """ Switches the profiler on.
+        :param rate: share of the requests to sample, between 0 and 1
+        :param seconds: the profiler switches itself off after this many seconds
+        :param interval: seconds between two samples, defaults to SAMPLER_INTERVAL
+        """
+        with self.lock:
+            self.rate = rate
+            self.until = time.time() + seconds
+            self.interval = interval or app.config.get('SAMPLER_INTERVAL', 0.01)
+            self.active = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='sampler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.active = False
+
+    def clear(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def is_active(self):
+        if self.active and time.time() >= self.until:
+            self.active = False
+        return self.active
+
+    def begin_request(self, endpoint):
+        """ Decides if the current request is sampled, and if it is, starts watching its thread. """
+        if self.is_active() and random.random() < self.rate:
+            with self.lock:
+                self.threads[threading.current_thread().ident] = endpoint
+            return True
+        return False
+
+    def end_request(self):
+        with self.lock:
+            self.threads.pop(threading.current_thread().ident, None)
+
+    def run(self):
+        """ The main loop of the sampling thread. It stops when the profiler is switched off. """
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.is_active():
+                    self.thread = None      # start() will start a new thread
+                    return
+            self.sample()
+
+    def sample(self):
+        """ Takes one sample of the stacks of all the sampled requests. """
+        with self.lock:
+            if not self.threads:
+                return
+            threads = dict(self.threads)
+        frames = sys._current_frames()
+        max_stacks = app.config.get('SAMPLER_MAX_STACKS', 10000)
+        for thread_id, endpoint in threads.items():
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = collapse(frame)
+            with self.lock:
+                stacks = self.stacks.setdefault(endpoint, {})
+                if stack in stacks or len(stacks) < max_stacks:
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def collapsed(self, endpoint=None):
+        """
+        :param endpoint: only the stacks of this endpoint, all of them if None
+        :return: the stacks in the collapsed format, the endpoint is the root frame of every stack
+        """
+        with self.lock:
+            lines = ['{};{} {}'.format(name, stack, count)
+                     for name, stacks in sorted(self.stacks.items()) if endpoint in (None, name)
+                     for stack, count in sorted(stacks.items())]
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def status(self):
+        return {'active': self.is_active(),
+                'percent': self.rate * 100,
+                'seconds_left': max(0, int(self.until - time.time())) if self.active else 0,
+                'samples': self.samples,
+                'endpoints': sorted(self.stacks)}
+
+
+def collapse(frame, limit=100):
+    """
+    :return: the stack of the frame as 'module.function;module.function;...', the outermost call first
+    """
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append('{}.{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+sampler = Sampler()
+
+
+@request_started.connect_via(app)
+def start_sampling(sender, **extra):
+    if sampler.active:      # a quick check first, the rest happens only while the profiler is on
+        g.sampled = sampler.begin_request(request.endpoint or 'none')
+
+
+@app.teardown_request
+def stop_sampling(exception):
+    if getattr(g, 'sampled', False):
+        sampler.end_request()
+
+
+@app.route('/admin/profiler')
+@admin_required
+def profiler_status():
+    return jsonify(sampler.status())
+
+
+@app.route('/admin/profiler/start', methods=['POST'])
+@admin_token_required
+def profiler_start():
+    percent = min(100.0, max(0.0, request.args.get('percent', 10.0, type=float)))
+    seconds = min(app.config.get('SAMPLER_MAX_SECONDS', 3600), request.args.get('seconds', 60, type=int))
+    if request.args.get('clear'):
+        sampler.clear()
+    sampler.start(percent / 100, seconds)
+    return jsonify(sampler.status())
+
+
+@app.route('/admin/profiler/stop', methods=['POST'])
+@admin_token_required
+def profiler_stop():
+    sampler.stop()
+    return jsonify(sampler.status())
+
+
+@app.route('/admin/profiler/stacks')
+@admin_required
+def profiler_stacks():
+    endpoint = request.args.get('endpoint')
+    response = app.response_class(sampler.collapsed(endpoint), mimetype='text/plain')
+    response.headers['Content-Disposition'] = 'attachment; filename={}.folded'.format(endpoint or 'microblog')
+    return response
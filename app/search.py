@@ -0,0 +1,115 @@
+# Full text search of posts, with the FTS5 extension of SQLite.
+#
+# Flask-WhooshAlchemy only works on Python 2, and it keeps a second index store (the WHOOSH_BASE directory) that is
+# written synchronously on every commit. FTS5 is built into SQLite, so the index lives in the same database file:
+# post_fts is an "external content" FTS5 table - it stores only the index, the text itself stays in the post table.
+# Triggers on the post table keep the index in sync with inserts, updates and deletes, in the same transaction.
+#
+# The archived posts (see archive.py) have an index of their own, post_archive_fts over the post_archive table, with
+# the same triggers. Archiving a post moves it from one index to the other, and the search reads both.
+#
+# The tables and the triggers are created together with the post tables (db.create_all()), and by migrations 008
+# and 017 for existing databases. If the index ever gets out of sync, ./search_rebuild.py builds it again from the
+# post tables.
+from sqlalchemy import event, DDL, text
+from app import app, db
+from .models import Post, ArchivedPost, post_rows
+
+CREATE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body, content='post', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+]
+ARCHIVE_CREATE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_archive_fts USING fts5(body, content='post_archive', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_insert AFTER INSERT ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_delete AFTER DELETE ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_update AFTER UPDATE OF body ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_archive_fts (rowid, body) VALUES (new.id, new.body); END",
+]
+TRIGGERS = ['post_fts_insert', 'post_fts_delete', 'post_fts_update']
+
+# create the indexes whenever the post tables are created, and drop them together with the post tables
+for table, statements, index in ((Post.__table__, CREATE_STATEMENTS, 'post_fts'),
+                                 (ArchivedPost.__table__, ARCHIVE_CREATE_STATEMENTS, 'post_archive_fts')):
+    for statement in statements:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(table, 'before_drop', DDL('DROP TABLE IF EXISTS ' + index).execute_if(dialect='sqlite'))
+
+
+def install(connection):
+    """ Creates the index tables and the triggers, if they don't exist yet.
+    :param connection: a database connection (or the session)
+    """
+    for statement in CREATE_STATEMENTS + ARCHIVE_CREATE_STATEMENTS:
+        connection.execute(text(statement))
+
+
+def drop_triggers(connection):
+    """ Drops the triggers that keep the index in sync. Used by bulk loaders, which rebuild the index at the end. """
+    for trigger in TRIGGERS:
+        connection.execute(text('DROP TRIGGER IF EXISTS ' + trigger))
+
+
+def rebuild():
+    """ Builds the whole index again from the post tables. """
+    install(db.session)
+    db.session.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+    db.session.execute(text("INSERT INTO post_archive_fts (post_archive_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def fts_query(query_string):
+    """ Turns what the user typed into an FTS5 query. Every word is quoted, so that characters that have a special
+    meaning in the FTS5 query syntax (quotes, colons, AND, OR, NEAR, ...) are searched for as ordinary text.
+    All the words have to be in the post. A word ending with * is searched for as a prefix.
+    :param query_string: text from the search box
+    :return: an FTS5 query, e.g. '"flask" "tutor"*'
+    """
+    terms = []
+    for word in query_string.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"{}"{}'.format(word.replace('"', '""'), '*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def search_posts(query_string, page=1, per_page=None):
+    """ Searches the posts, the best matches first (ranked by the bm25 function of FTS5).
+    :param query_string: text from the search box
+    :param page: page of results, starting with 1
+    :param per_page: number of results on a page, defaults to POSTS_PER_PAGE
+    :return: a tuple (list of PostRow objects, True if there's another page of results)
+    """
+    if per_page is None:
+        per_page = app.config['POSTS_PER_PAGE']
+    match = fts_query(query_string)
+    # we don't page through the whole database, nobody reads that far anyway
+    if not match or page < 1 or (page - 1) * per_page >= app.config['MAX_SEARCH_RESULTS']:
+        return [], False
+    # the posts and the archived posts, ranked together (a post is in one of the indexes, never in both)
+    ids = [post_id for (post_id,) in db.session.execute(
+        text('SELECT id FROM (SELECT rowid AS id, bm25(post_fts) AS score FROM post_fts WHERE post_fts MATCH :match '
+             'UNION ALL SELECT rowid, bm25(post_archive_fts) FROM post_archive_fts '
+             'WHERE post_archive_fts MATCH :match) ORDER BY score LIMIT :limit OFFSET :offset'),
+        {'match': match, 'limit': per_page + 1, 'offset': (page - 1) * per_page})]
+    has_next = len(ids) > per_page and page * per_page < app.config['MAX_SEARCH_RESULTS']
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+    # load the posts with their authors, one query per table, then put them back in the order of relevance
+    rows = dict((row.id, row) for row in post_rows(Post.query.filter(Post.id.in_(ids))))
+    missing = [post_id for post_id in ids if post_id not in rows]
+    if missing:
+        rows.update((row.id, row) for row in post_rows(ArchivedPost.query.filter(ArchivedPost.id.in_(missing)),
+                                                       ArchivedPost))
+    return [rows[post_id] for post_id in ids if post_id in rows], has_next
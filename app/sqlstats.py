@@ -0,0 +1,35 @@
+# Counting of SQL statements per request.
+#
+# Every statement that SQLAlchemy sends to the database is counted in flask.g, so at the end of the request we
+# know how many queries the request has issued. In debug and testing mode we use that as an assertion: if a page
+# issues more than SQL_STATEMENT_LIMIT statements (config.py), the request fails. That's how we catch the N+1
+# problem (one query for the list, then one more query for every item in the list) before it gets to production.
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """ SQLAlchemy calls this before each statement, on every engine we have. """
+    if has_app_context():
+        g.sql_statements = getattr(g, 'sql_statements', 0) + 1
+
+
+def statement_count():
+    """
+    :return: number of SQL statements issued so far in the current request (application context)
+    """
+    return getattr(g, 'sql_statements', 0)
+
+
+@app.after_request
+def check_statement_limit(response):
+    """ Fails the request if it has issued too many SQL statements. This is only done in debug and testing mode. """
+    limit = app.config.get('SQL_STATEMENT_LIMIT')
+    if limit and (app.debug or app.testing):
+        count = statement_count()
+        assert count <= limit, \
+            '{} {} issued {} SQL statements, the limit is {}'.format(request.method, request.path, count, limit)
+    return response
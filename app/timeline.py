@@ -0,0 +1,149 @@
+# Materialized home timelines (fan-out on write).
+#
+# User.followed_posts() builds a home page by joining the post table with the followers table and sorting the
+# result by time. The cost of that join grows with the number of followed users and with the total number of posts,
+# and we pay it on every hit of the index page.
+# Here we do the work once, when a post is written: the id of a new post is copied into the timeline table for
+# every follower of its author. Reading a home page is then just a lookup of the newest rows for one user.
+#
+# Authors with a huge number of followers would make every post of theirs write thousands of rows, so they are
+# not fanned out. They get the timeline_pull flag, and the home pages of their followers are built with the
+# old followed_posts() join.
+#
+# The whole thing can be switched off with TIMELINE_ENABLED in config.py. After switching it on for a database
+# that already has posts, run ./timeline_backfill.py once.
+from sqlalchemy import select, literal, exists, and_
+from app import app, db
+from .models import User, Post, followers, timeline
+
+
+def enabled():
+    """
+    :return: True if the materialized timelines are switched on in the configuration
+    """
+    return app.config.get('TIMELINE_ENABLED', False)
+
+
+def fanout_limit():
+    """
+    :return: the number of followers above which an author's posts are not fanned out
+    """
+    return app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+
+
+def fan_out(post):
+    """ Copies a new post into the home timelines of all followers of its author.
+    The post must already be flushed (it needs an id). Like the follow and unfollow methods of the User class,
+    this function doesn't commit - the caller has to do that.
+    :param post: a newly created post
+    """
+    if not enabled():
+        return
+    author = User.query.get(post.user_id)
+    if author.timeline_pull or author.follower_count() > fanout_limit():
+        # too many followers, the readers will pull this post with the followed_posts() join
+        if not author.timeline_pull:
+            author.timeline_pull = True
+            db.session.add(author)
+        return
+    # INSERT INTO timeline (user_id, post_id, timestamp) SELECT follower_id, <id>, <timestamp> FROM followers ...
+    # This is a single statement, no matter how many followers the author has.
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id,
+                literal(post.id, db.Integer),
+                literal(post.timestamp, db.DateTime)]).where(followers.c.followed_id == post.user_id)))
+
+
+def on_follow(follower, followed):
+    """ Copies existing posts of a newly followed user into the follower's timeline.
+    Call it after follower.follow(followed) succeeded, the caller commits.
+    """
+    if not enabled() or followed.timeline_pull:
+        return
+    already_there = exists().where(and_(timeline.c.user_id == follower.id, timeline.c.post_id == Post.id))
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([literal(follower.id, db.Integer), Post.id, Post.timestamp]).
+        where(and_(Post.user_id == followed.id, ~already_there))))
+
+
+def on_unfollow(follower, unfollowed):
+    """ Removes the posts of an unfollowed user from the follower's timeline.
+    Call it after follower.unfollow(unfollowed) succeeded, the caller commits.
+    """
+    if not enabled():
+        return
+    posts_of_unfollowed = select([Post.id]).where(Post.user_id == unfollowed.id)
+    db.session.execute(timeline.delete().where(and_(timeline.c.user_id == follower.id,
+                                                    timeline.c.post_id.in_(posts_of_unfollowed))))
+
+
+def remove_post(post):
+    """ Removes a post from all timelines. Call it before the post itself is deleted, the caller commits.
+    We're doing this even when the timelines are switched off, so that no dangling rows are left behind.
+    """
+    db.session.execute(timeline.delete().where(timeline.c.post_id == post.id))
+
+
+def home_timeline(user):
+    """ This is the replacement for user.followed_posts() in the views.
+    :param user: the user whose home page we're building
+    :return: a query of posts for the home page of the user, newest first
+    """
+    return home_timeline_keys(user)[0]
+
+
+def home_timeline_keys(user):
+    """ The home timeline with the columns it's sorted by. The pages (KeysetPage, the API) have to sort and cut it
+    by the same columns: sorted by the columns of the post table, SQLite can't read a page of the timeline from
+    its index, it reads and sorts the whole timeline of the user instead.
+    :param user: the user whose home page we're building
+    :return: tuple (query of posts, newest first; timestamp column; id column)
+    """
+    if not enabled():
+        return user.followed_posts(), Post.timestamp, Post.id
+    # If the user follows someone whose posts are not fanned out, his timeline is incomplete.
+    # In that case we fall back to the join.
+    pulled_authors = db.session.query(followers.c.followed_id).\
+        join(User, User.id == followers.c.followed_id).\
+        filter(followers.c.follower_id == user.id, User.timeline_pull == True)
+    if db.session.query(pulled_authors.exists()).scalar():
+        return user.followed_posts(), Post.timestamp, Post.id
+    # the timeline rows have the timestamp and the id of the post, so the cursors are the same either way
+    query = Post.query.join(timeline, timeline.c.post_id == Post.id).\
+        filter(timeline.c.user_id == user.id).\
+        order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+    return query, timeline.c.timestamp, timeline.c.post_id
+
+
+def backfill(batch_size=500):
+    """ (Re)builds all the timelines from the followers and post tables.
+    This is used after the timelines are switched on for an existing database, or if we suspect the
+    timelines got out of sync. The work is committed in batches of followers, so that we don't hold the
+    database write lock for too long.
+    :param batch_size: number of followers processed in one transaction
+    :return: number of users processed
+    """
+    # first decide again who is too popular for fan-out
+    limit = fanout_limit()
+    popular = [followed_id for followed_id, count in
+               db.session.query(followers.c.followed_id, db.func.count(followers.c.follower_id)).
+               group_by(followers.c.followed_id) if count > limit]
+    User.query.update({'timeline_pull': False}, synchronize_session=False)
+    if popular:
+        User.query.filter(User.id.in_(popular)).update({'timeline_pull': True}, synchronize_session=False)
+    db.session.execute(timeline.delete())
+    db.session.commit()
+
+    user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            select([followers.c.follower_id, Post.id, Post.timestamp]).
+            select_from(followers.join(Post, Post.user_id == followers.c.followed_id).
+                        join(User.__table__, User.id == followers.c.followed_id)).
+            where(and_(followers.c.follower_id.in_(batch), User.timeline_pull != True))))
+        db.session.commit()
+    return len(user_ids)
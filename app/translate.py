@@ -7,33 +7,234 @@ try:
 except ImportError:
     from urllib.parse import urlencode   # Python 3
 import json
-from config import MS_TRANSLATOR_CLIENT_ID, MS_TRANSLATOR_CLIENT_SECRET
+from contextlib import contextmanager
+import socket
+import threading
+import time
+from config import MS_TRANSLATOR_CLIENT_ID, MS_TRANSLATOR_CLIENT_SECRET, TRANSLATION_CACHE_SIZE, \
+    TRANSLATION_CACHE_TTL, TRANSLATION_BATCH_SIZE, TRANSLATION_POOL_SIZE, TRANSLATION_MAX_URL_LENGTH
+from .cache import LRUCache
+
+
+class MicrosoftTranslator(object):
+    """ A client for the Microsoft Translator service.
+    We used to open a new HTTPS connection and get a new OAuth access token for every translation, and then open
+    one more connection for the translation itself. This client:
+        - keeps the access token until it expires (the service tells us how long it's valid),
+        - keeps the connections open in a small pool and reuses them (HTTP/1.1 keep-alive), reconnecting if the
+          server closed them. Up to pool_size translations are sent at the same time, each over its own connection,
+        - remembers the translations in an LRU cache with a time limit, so popular posts are translated only once.
+    The hosts can be changed, so the client can be tested against a local stand-in server.
+    """
+    def __init__(self, client_id, client_secret,
+                 auth_host='datamarket.accesscontrol.windows.net', auth_secure=True,
+                 api_host='api.microsofttranslator.com', api_secure=False,
+                 cache_size=TRANSLATION_CACHE_SIZE, cache_ttl=TRANSLATION_CACHE_TTL, timeout=10,
+                 pool_size=TRANSLATION_POOL_SIZE):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.hosts = {'auth': (auth_host, auth_secure), 'api': (api_host, api_secure)}
+        self.timeout = timeout
+        self.cache = LRUCache(cache_size, cache_ttl)
+        # An http connection can't be used by two threads at the same time, so a request takes a connection out of
+        # the pool (or opens a new one) and puts it back when it's done. The lock is held only for that (and for
+        # updating the counters), not during the request.
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.slots = threading.BoundedSemaphore(pool_size)     # requests that can be sent at the same time
+        self.connections = {'auth': [], 'api': []}              # idle connections to each host
+        self.token_lock = threading.Lock()                      # only one thread at a time renews the token
+        self.token = None
+        self.token_expires = 0
+        self.requests = {'auth': 0, 'api': 0}    # number of requests sent to each host, handy for testing
+        self.waiting = 0        # number of translations waiting for the lock (the queue in front of the service)
+
+    @contextmanager
+    def queued(self):
+        """ Waits for a free slot, counting the threads that are waiting for one. """
+        with self.lock:
+            self.waiting += 1
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+            yield
+
+    def configured(self):
+        return bool(self.client_id) and bool(self.client_secret)
+
+    def _request(self, host, method, path, body=None, headers=None):
+        """ Sends a request over the kept-alive connection to the given host. If the server has closed the
+        connection in the meantime, we open a new one and try once more.
+        :param host: 'auth' or 'api'
+        :return: body of the response, as bytes
+        """
+        for attempt in (1, 2):
+            connection = self._checkout(host, fresh=attempt == 2)
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()      # the whole response has to be read before the connection is reused
+                with self.lock:
+                    self.requests[host] += 1
+                if response.status != 200:
+                    raise httplib.HTTPException('{} {}'.format(response.status, response.reason))
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if attempt == 2:
+                    raise
+                continue
+            self._checkin(host, connection)
+            return data
+
+    def _checkout(self, host, fresh=False):
+        """
+        :param host: 'auth' or 'api'
+        :param fresh: open a new connection even if there's an idle one
+        :return: an idle connection from the pool, or a new one
+        """
+        if not fresh:
+            with self.lock:
+                if self.connections[host]:
+                    return self.connections[host].pop()
+        hostname, secure = self.hosts[host]
+        connection_class = httplib.HTTPSConnection if secure else httplib.HTTPConnection
+        return connection_class(hostname, timeout=self.timeout)
+
+    def _checkin(self, host, connection):
+        """ Puts the connection back into the pool, or closes it if the pool is full. """
+        with self.lock:
+            if len(self.connections[host]) < self.pool_size:
+                self.connections[host].append(connection)
+                return
+        connection.close()
+
+    def access_token(self):
+        """
+        :return: a valid OAuth access token, a cached one if it's not about to expire
+        """
+        with self.token_lock:
+            if self.token is None or time.time() >= self.token_expires:
+                params = urlencode({
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    'scope': 'http://api.microsofttranslator.com',
+                    'grant_type': 'client_credentials'})
+                response = json.loads(self._request('auth', 'POST', '/v2/OAuth2-13', params,
+                                                    {'Content-Type': 'application/x-www-form-urlencoded'}).
+                                      decode('utf-8'))
+                self.token = response[u'access_token']
+                # we renew the token a minute before it expires, to be on the safe side
+                self.token_expires = time.time() + int(response.get(u'expires_in', 600)) - 60
+            return self.token
+
+    def translate(self, text, sourcelang, destlang):
+        """
+        :return: the translated text
+        """
+        key = (text, sourcelang, destlang)
+        translation = self.cache.get(key)
+        if translation is not None:
+            return translation
+        with self.queued():
+            params = {'appId': 'Bearer ' + self.access_token(),
+                      'from': sourcelang,
+                      'to': destlang,
+                      'text': text.encode("utf-8")}
+            data = self._request('api', 'GET', '/V2/Ajax.svc/Translate?' + urlencode(params))
+        translation = json.loads("{\"response\":" + data.decode('utf-8-sig') + "}")["response"]
+        self.cache.set(key, translation)
+        return translation
+
+    @staticmethod
+    def translate_array_path(token, texts, sourcelang, destlang):
+        return '/V2/Ajax.svc/TranslateArray?' + urlencode({'appId': 'Bearer ' + token,
+                                                           'from': sourcelang,
+                                                           'to': destlang,
+                                                           'texts': json.dumps(texts)})
+
+    def next_batch(self, token, texts, sourcelang, destlang, batch_size, max_url_length):
+        """ Takes the texts for the next TranslateArray request from the start of the list: up to batch_size of
+        them, as long as the URL stays within max_url_length (but at least one text, however long it is).
+        :return: tuple (the texts of the batch, the path of the request)
+        """
+        batch = texts[:1]
+        path = self.translate_array_path(token, batch, sourcelang, destlang)
+        for text in texts[1:batch_size]:
+            longer = self.translate_array_path(token, batch + [text], sourcelang, destlang)
+            if len(longer) > max_url_length:
+                break
+            batch, path = batch + [text], longer
+        return batch, path
+
+    def translate_many(self, texts, sourcelang, destlang, batch_size=TRANSLATION_BATCH_SIZE,
+                       max_url_length=TRANSLATION_MAX_URL_LENGTH):
+        """ Translates many texts with as few requests as possible. The same text is translated only once, the
+        cached translations are not sent at all, and the rest goes to the TranslateArray method of the service,
+        batch_size texts per request (fewer if the URL would be longer than max_url_length).
+        :param texts: list of texts, all in the same language
+        :return: dictionary text -> translated text, the texts the service didn't translate are not in it
+        """
+        translations = {}
+        missing = []
+        for text in set(texts):
+            translation = self.cache.get((text, sourcelang, destlang))
+            if translation is not None:
+                translations[text] = translation
+            else:
+                missing.append(text)
+        while missing:
+            with self.queued():
+                batch, path = self.next_batch(self.access_token(), missing, sourcelang, destlang, batch_size,
+                                              max_url_length)
+                data = self._request('api', 'GET', path)
+            missing = missing[len(batch):]
+            # The response is a list with one object per text, in the same order. If the service sends back
+            # fewer (or more) of them, we can't tell which is which, and the texts of the batch stay untranslated.
+            results = json.loads(data.decode('utf-8-sig'))
+            if not isinstance(results, list) or len(results) != len(batch):
+                continue
+            for text, result in zip(batch, results):
+                if isinstance(result, dict) and result.get(u'TranslatedText') is not None:
+                    translations[text] = result[u'TranslatedText']
+                    self.cache.set((text, sourcelang, destlang), result[u'TranslatedText'])
+        return translations
+
+
+translator = MicrosoftTranslator(MS_TRANSLATOR_CLIENT_ID, MS_TRANSLATOR_CLIENT_SECRET)
 
 
 def microsoft_translate(text, sourcelang, destlang):
-    if MS_TRANSLATOR_CLIENT_ID == "" or MS_TRANSLATOR_CLIENT_SECRET == "":
+    if not translator.configured():
         return 'Error: translation service not configured.'
     try:
-        # get access token
-        params = urlencode({
-            'client_id': MS_TRANSLATOR_CLIENT_ID,
-            'client_secret': MS_TRANSLATOR_CLIENT_SECRET,
-            'scope': 'http://api.microsofttranslator.com',
-            'grant_type': 'client_credentials'})
-        conn = httplib.HTTPSConnection("datamarket.accesscontrol.windows.net")
-        conn.request("POST", "/v2/OAuth2-13", params)
-        response = json.loads(conn.getresponse().read().decode("utf-8"))
-        token = response[u'access_token']
-
-        # translate
-        conn = httplib.HTTPConnection('api.microsofttranslator.com')
-        params = {'appId': 'Bearer ' + token,
-                  'from': sourcelang,
-                  'to': destlang,
-                  'text': text.encode("utf-8")}
-        conn.request("GET", '/V2/Ajax.svc/Translate?' + urlencode(params))
-        response = json.loads("{\"response\":" + conn.getresponse().read().decode('utf-8-sig') + "}")
-        return response["response"]
+        return translator.translate(text, sourcelang, destlang)
     except Exception as e:
         return 'Unexpected error: {}'.format(e)
 
+
+def batch_translate(items):
+    """ Translates a bunch of texts in different languages. The texts are grouped by language pair, and each group
+    is translated with translate_many. If something goes wrong, only the items of that group get an error.
+    :param items: list of tuples (key, text, sourcelang, destlang); the key is anything that identifies the item
+    :return: a tuple of two dictionaries: key -> translated text, and key -> error message
+    """
+    translations = {}
+    errors = {}
+    groups = {}
+    for key, text, sourcelang, destlang in items:
+        groups.setdefault((sourcelang, destlang), []).append((key, text))
+    for (sourcelang, destlang), group in groups.items():
+        if not translator.configured():
+            errors.update((key, 'translation service not configured.') for key, text in group)
+            continue
+        try:
+            translated = translator.translate_many([text for key, text in group], sourcelang, destlang)
+        except Exception as e:
+            errors.update((key, 'Unexpected error: {}'.format(e)) for key, text in group)
+            continue
+        for key, text in group:
+            if text in translated:
+                translations[key] = translated[text]
+            else:
+                errors[key] = 'No translation received.'
+    return translations, errors
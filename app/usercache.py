@@ -0,0 +1,79 @@
+# In-process cache of the logged in users.
+#
+# Flask-Login calls load_user() at the start of every request of a logged in user, and it used to run
+# User.query.get() every time. Here we keep the column values of recently seen users in an LRU cache with a time
+# limit (USER_CACHE_SIZE, USER_CACHE_TTL), and build the User object from them without any SQL.
+# The User objects themselves can't be cached: they belong to the session of the request that loaded them.
+#
+# A cached user is thrown out whenever the user is written through the ORM (edit(), follow flags, ...), once when
+# the change is flushed and once more after the commit, so a request that read the old row in between doesn't leave
+# it in the cache. Bulk updates of the user table (Query.update) clear the whole cache. The writes that go around
+# the session (e.g. LastSeenBuffer) must call invalidate() themselves.
+# The cache lives in the process memory, so every process of the application has its own copy; the time limit makes
+# sure that changes made by other processes show up eventually.
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from app import app, db
+from .cache import LRUCache
+from .models import User
+
+
+class UserCache(object):
+    def __init__(self, maxsize=None, ttl=None):
+        """ The settings that are not given are taken from the application configuration. """
+        self.cache = LRUCache(maxsize or app.config.get('USER_CACHE_SIZE', 10000),
+                              ttl or app.config.get('USER_CACHE_TTL', 300))
+        self.columns = [attribute.key for attribute in User.__mapper__.column_attrs]
+        event.listen(User, 'after_update', self.on_write)
+        event.listen(User, 'after_delete', self.on_write)
+        event.listen(Session, 'after_commit', self.on_commit)
+        event.listen(Session, 'after_bulk_update', self.on_bulk_write)
+        event.listen(Session, 'after_bulk_delete', self.on_bulk_write)
+
+    def enabled(self):
+        return app.config.get('USER_CACHE_ENABLED', True)
+
+    def load(self, user_id):
+        """ Returns the user with the given id, attached to the current session.
+        :return: User object, or None if there's no such user
+        """
+        if not self.enabled():
+            return User.query.get(user_id)
+        values = self.cache.get(user_id)
+        if values is None:
+            user = User.query.get(user_id)
+            if user is not None:
+                self.cache.set(user_id, dict((column, getattr(user, column)) for column in self.columns))
+            return user
+        user = User(**values)
+        # make it look as if it was just loaded from the database, and put it into the session without a SELECT
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id):
+        self.cache.delete(user_id)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        """
+        :return: dictionary with the numbers of hits and misses, the hit ratio and the number of cached users
+        """
+        return {'hits': self.cache.hits, 'misses': self.cache.misses,
+                'hit_ratio': self.cache.hit_ratio(), 'size': len(self.cache)}
+
+    def on_write(self, mapper, connection, target):
+        self.invalidate(target.id)
+        object_session(target).info.setdefault('written_users', set()).add(target.id)
+
+    def on_commit(self, session):
+        for user_id in session.info.pop('written_users', ()):
+            self.invalidate(user_id)
+
+    def on_bulk_write(self, context):
+        if context.mapper is not None and context.mapper.class_ is User:
+            self.clear()
+
+
+user_cache = UserCache()
@@ -2,15 +2,24 @@ from flask import render_template, flash, redirect, session, url_for, request, g
 from flask.ext.login import login_user, logout_user, current_user, login_required
 from app import app, db, lm, oid
 from .forms import LoginForm, EditForm, PostForm    # .forms is the same as app.forms, just shorter
-from .models import User, Post                      # .models is the same as app.models, just shorter
+# .models is the same as app.models, just shorter
+from .models import User, Post, ArchivedPost, post_rows, follow_graph
 from datetime import datetime
+from sqlalchemy.exc import IntegrityError
 import sys
-from math import ceil
 from config import POSTS_PER_PAGE, LANGUAGES
 from .emails import follower_notification
 from app import babel
-from guess_language import guess_language
-from .translate import microsoft_translate
+from .langdetect import language_detector
+from .usercache import user_cache
+from .conditional import page_validators, user_version, timeline_version, not_modified, conditional_response
+from .translate import microsoft_translate, batch_translate
+from . import timeline
+from . import archive
+from .pagination import KeysetPage
+from .lastseen import last_seen_buffer
+from .search import search_posts
+from .decorators import read_only
 
 @app.before_request
 def before_request():
@@ -25,21 +34,33 @@ def before_request():
     request and any future requests made by the same client (a client session state).
     Data remains in the session until explicitly removed. To be able to do this,
     Flask keeps a different session container for each client of our application.
+
+    The last_seen time of the user is not committed here any more, it goes to a write-behind buffer that
+    writes many of them at once (see lastseen.py).
     '''
     g.locale = get_locale()
     g.config = app.config
     g.user = current_user
     if g.user.is_authenticated():
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        last_seen_buffer.touch(g.user)
+
+
+@app.before_first_request
+def warm_caches():
+    ''' Loads the whole follow graph into memory when the first request comes in, if that's configured.
+    Otherwise the follow graph cache is filled one user at a time, as the users show up.
+    '''
+    if app.config.get('FOLLOW_CACHE_WARM'):
+        follow_graph.warm()
 
 
 @app.route('/', methods=['GET', 'POST'])             # requests on these two routes will cause this
 @app.route('/index', methods=['GET', 'POST'])        # function to be run (these are mappings from URL to the function)
-@app.route('/index/<int:page>', methods=['GET', 'POST'])
+@app.route('/index/before/<before>', methods=['GET', 'POST'])   # older posts, see pagination.py
+@app.route('/index/after/<after>', methods=['GET', 'POST'])     # newer posts
 @login_required       # no access to this function if you're not logged in
-def index(page=1):
+@read_only            # GET requests only read, their queries go to the read connections (see engine.py)
+def index(before=None, after=None):
     post_form = PostForm()
     if post_form.validate_on_submit():
         # Form validation successful.
@@ -50,13 +71,12 @@ def index(page=1):
         post.body = post_form.post.data
         post.timestamp = datetime.utcnow()
         post.user_id = g.user.id              # this could have been done as post.author = g.user
-        language = guess_language(post.body)
-        # we'll try to automatically detect the post language
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post.language = language
         db.session.add(post)
+        db.session.flush()             # this gives us post.id, which we need for the fan-out
+        timeline.fan_out(post)         # put the post into the timelines of the followers
         db.session.commit()
+        # the language of the post is detected in the background (see langdetect.py)
+        language_detector.enqueue(post.id)
         flash('Your post is now live!', 'info')
         return redirect(url_for('index'))
     # If we're here then we one of these things happened:
@@ -64,18 +84,25 @@ def index(page=1):
     #    b) form validation failed
     # Either way, show the index page with posts.
     #
-    # This was how I did the pagination, but there's a far better way to do that in Flask:
-    # total_posts = g.user.followed_posts().count()
-    # first_page = None if total_posts <= POSTS_PER_PAGE else 1
-    # prev_page = None if page == 1 else page-1
-    # last_page = int(ceil(total_posts/POSTS_PER_PAGE))
-    # next_page = None if page == last_page else page + 1
-    posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)   # this is a Paginate object
-    return render_template('index.html',
-                           title='Home',
-                           user=g.user,
-                           posts=posts,
-                           form=post_form)
+    # The posts are paged with keyset pagination (see pagination.py), and fetched as PostRow tuples, with their
+    # authors in the same query.
+    #
+    # If the browser already has the current version of the page, we don't even do that (see conditional.py).
+    home_timeline, timestamp_column, id_column = timeline.home_timeline_keys(g.user)
+    # the posts that are too old for the post table are read from the archive, if the page gets that deep
+    archived = archive.followed_posts(g.user) if archive.enabled() else None
+    etag, last_modified, has_archived = page_validators(home_timeline, timeline_version(g.user.id),
+                                                        (timestamp_column, id_column), archive=archived)
+    if not_modified(etag, last_modified):
+        return conditional_response(None, etag, last_modified)
+    posts = KeysetPage(post_rows(home_timeline), POSTS_PER_PAGE, before, after, timestamp_column, id_column,
+                       archive=post_rows(archived, ArchivedPost) if has_archived else None)
+    return conditional_response(render_template('index.html',
+                                                title='Home',
+                                                user=g.user,
+                                                posts=posts,
+                                                form=post_form),
+                                etag, last_modified)
 # Why we sometimes use redirect and sometimes render_template?
 # We could have easily skipped the redirect and allowed the function to continue down into the
 # template rendering part, and it would have been more efficient (saved one client-server roundtrip).
@@ -160,16 +187,10 @@ def after_login(resp):
         if nickname is None or nickname == "":
             # we didn't get the nickname from OpenID, we'll use first part of email
             nickname = resp.email.split('@')[0]
-        # this will make sure that nickname is unique
-        nickname = User.make_unique_nickname(nickname)
-        # create user object
-        usr = User(nickname=nickname, email=resp.email)
-        # and insert it into the database
-        db.session.add(usr)
-        db.session.commit()
-        # add the user as follower to himself (so he can see his own posts among the posts of followed users)
-        db.session.add(usr.follow(usr))
-        db.session.commit()
+        usr = create_user(nickname, resp.email)
+        if usr is None:
+            flash('Could not create your account, please try again.', 'error')
+            return redirect(url_for('login'))
     # set remember_me, either from the value stored in session or default to False
     remember_me = False
     if 'remember_me' in session:
@@ -184,6 +205,36 @@ def after_login(resp):
     return redirect(request.args.get('next') or url_for('index'))
 
 
+def create_user(nickname, email, attempts=3):
+    """ Creates a new user with a unique nickname.
+    Between finding a free nickname and inserting the user, somebody else may sign up with the same nickname.
+    The unique index on the nickname won't let that through, so in that case we just try again with a new nickname.
+    :param nickname: the nickname the user wants
+    :param email: email of the user
+    :param attempts: how many times we try before giving up
+    :return: the new user, or None if we couldn't create him
+    """
+    for attempt in range(attempts):
+        # this will make sure that nickname is unique
+        usr = User(nickname=User.make_unique_nickname(nickname), email=email)
+        # and insert it into the database
+        db.session.add(usr)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            # maybe it's the same user, logging in twice at the same time
+            usr = User.query.filter_by(email=email).first()
+            if usr is not None:
+                return usr
+            continue
+        # add the user as follower to himself (so he can see his own posts among the posts of followed users)
+        db.session.add(usr.follow(usr))
+        db.session.commit()
+        return usr
+    return None
+
+
 @app.route('/logout')
 def logout():
     logout_user()
@@ -201,26 +252,62 @@ def load_user(user_id):
     :param id: ID of the user (unique identifier obtained by User.get_id(). That's why we need to convert it
                to int before handing it over to query.get method.
     :return:   object of class User.
+
+    The user usually comes from an in-process cache, without a query (see usercache.py).
     """
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
 
 
 @app.route('/user/<nickname>')
-@app.route('/user/<nickname>/<int:page>')
+@app.route('/user/<nickname>/before/<before>')
+@app.route('/user/<nickname>/after/<after>')
 @login_required
-def user(nickname, page=1):
+@read_only
+def user(nickname, before=None, after=None):
     """ This is the function for generating user's profile view.
     :param nickname: nickname of the user whose profile we want to show
+    :param before: cursor of the page with older posts (see pagination.py)
+    :param after: cursor of the page with newer posts
     :return: renders the page that displays user profile
     """
     usr = User.query.filter_by(nickname=nickname).first()
     if usr is None:
         flash('User {} not found.'.format(nickname))
         return redirect(url_for('index'))
-    posts = usr.posts.order_by(Post.timestamp.desc()).paginate(page, POSTS_PER_PAGE, False)   # this is a Paginate object
-    return render_template('user.html',
-                           user=usr,
-                           posts=posts)
+    # answer with 304 Not Modified if the browser already has this version of the page (see conditional.py)
+    archived = archive.user_posts(usr) if archive.enabled() else None
+    etag, last_modified, has_archived = page_validators(usr.posts, user_version(usr.id),
+                                                        state=(usr.nickname, usr.about_me, usr.avatar_hash,
+                                                               usr.last_seen, usr.follower_count(),
+                                                               usr.followed_count(), g.user.is_following(usr)),
+                                                        modified=(usr.last_seen,), archive=archived)
+    if not_modified(etag, last_modified):
+        return conditional_response(None, etag, last_modified)
+    posts = KeysetPage(post_rows(usr.posts), POSTS_PER_PAGE, before, after,     # newest first, see pagination.py
+                       archive=post_rows(archived, ArchivedPost) if has_archived else None)
+    return conditional_response(render_template('user.html',
+                                                user=usr,
+                                                posts=posts),
+                                etag, last_modified)
+
+
+@app.route('/search')
+@login_required
+@read_only
+def search():
+    """ Full text search of all the posts (see search.py). The search box in the navigation bar sends the text as
+    the q argument, e.g. /search?q=flask&page=2
+    :return: renders the page with search results
+    """
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    posts, has_next = search_posts(query, page)
+    return render_template('search_results.html',
+                           title='Search',
+                           query=query,
+                           posts=posts,
+                           page=page,
+                           has_next=has_next)
 
 
 @app.route('/edit', methods=['GET', 'POST'])
@@ -246,7 +333,7 @@ def edit():
             g.user.nickname = form.nickname.data
             g.user.about_me = form.about_me.data
             db.session.add(g.user)
-            db.session.commit()
+            db.session.commit()         # this also throws the old data out of the user cache
             flash('Your changes have been saved.', 'info')
             # display new user profile
             return redirect(url_for('user', nickname=g.user.nickname))
@@ -282,6 +369,14 @@ def internal_error(error):
     return render_template('500.html'), 500
 
 
+def fresh_is_following(follower, followed):
+    """ is_following() from the database. The cached follow graph of this process can be behind the other processes
+    (see followcache.py), and a follow or unfollow based on it would fail or do nothing.
+    """
+    follow_graph.invalidate([follower.id, followed.id])
+    return follower.is_following(followed)
+
+
 @app.route('/follow/<nickname>')
 @login_required
 def follow(nickname):
@@ -290,14 +385,15 @@ def follow(nickname):
         flash('Unknown user {}'.format(nickname), 'error')
     elif user_to_follow == g.user:
         flash('You cannot follow yourself!', 'error')
-    elif not g.user.is_following(user_to_follow):
+    elif not fresh_is_following(g.user, user_to_follow):
         u = g.user.follow(user_to_follow)
         if u is not None:
             db.session.add(u)
+            timeline.on_follow(g.user, user_to_follow)
+            # queue a notification for the followed user, he'll get it in the next digest email
+            follower_notification(user_to_follow, g.user)
             db.session.commit()
             flash('You are now following {}'.format(nickname), 'info')
-            # send a notification email to the followed user
-            follower_notification(user_to_follow, g.user)
         else:
             flash('Cannot follow {}'.format(nickname), 'error')
     else:
@@ -314,10 +410,11 @@ def unfollow(nickname):
         flash('Unknown user {}'.format(nickname), 'error')
     elif user_to_unfollow == g.user:
         flash('You cannot unfollow yourself!', 'error')
-    elif g.user.is_following(user_to_unfollow):
+    elif fresh_is_following(g.user, user_to_unfollow):
         u = g.user.unfollow(user_to_unfollow)
         if u is not None:
             db.session.add(u)
+            timeline.on_unfollow(g.user, user_to_unfollow)
             db.session.commit()
             flash('You are not following {} any more'.format(nickname), 'info')
         else:
@@ -344,16 +441,60 @@ def translate():
                                     request.form['destlang'])  })
 
 
+@app.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    """ Translates many posts with one call, e.g. all the foreign posts on a page.
+    The request is JSON: {"items": [{"post_id": 1, "sourcelang": "hr", "destlang": "en"}, ...]}
+    The response is JSON too: {"translations": {"1": "..."}, "errors": {"2": "..."}}, keyed by post id.
+    An error in one item doesn't spoil the others.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list):
+        return jsonify({'error': 'Expected a JSON object with a list of items.'}), 400
+    if len(data['items']) > app.config['TRANSLATION_BATCH_MAX_ITEMS']:
+        return jsonify({'error': 'Too many items, the maximum is {}.'.format(
+            app.config['TRANSLATION_BATCH_MAX_ITEMS'])}), 400
+    errors = {}
+    wanted = []
+    for item in data['items']:
+        try:
+            wanted.append((int(item['post_id']), str(item['sourcelang']), str(item['destlang'])))
+        except (KeyError, TypeError, ValueError):
+            errors[str(item.get('post_id') if isinstance(item, dict) else None)] = 'Invalid item.'
+    # load the texts of all the posts with one query
+    bodies = dict(db.session.query(Post.id, Post.body).filter(Post.id.in_([w[0] for w in wanted]))) if wanted else {}
+    missing = [w[0] for w in wanted if w[0] not in bodies]
+    if missing:
+        # old posts are in the archive (see archive.py)
+        bodies.update(db.session.query(ArchivedPost.id, ArchivedPost.body).filter(ArchivedPost.id.in_(missing)))
+    items = []
+    for post_id, sourcelang, destlang in wanted:
+        if post_id in bodies:
+            items.append((str(post_id), bodies[post_id], sourcelang, destlang))
+        else:
+            errors[str(post_id)] = 'Post not found.'
+    translations, translation_errors = batch_translate(items)
+    errors.update(translation_errors)
+    return jsonify({'translations': translations, 'errors': errors})
+
+
 @app.route('/delete/<int:id>')
 @login_required
 def delete(id):
     post = Post.query.get(id)
+    archived = post is None
+    if archived:
+        post = ArchivedPost.query.get(id)      # old posts are in the archive (see archive.py)
     if post is None:
         flash('Post with ID {} not found'.format(id), 'error')
         return redirect(url_for('index'))
-    if post.author != g.user:
+    if post.user_id != g.user.id:
         flash('You cannot delete this post!', 'error')
         return redirect(url_for('index'))
+    if not archived:
+        timeline.remove_post(post)      # the archived posts are not in the timelines
+    # this also throws the post out of the cache of rendered posts and out of the full text index
     db.session.delete(post)
     db.session.commit()
     flash('Your post has been deleted.', 'info')
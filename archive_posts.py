@@ -0,0 +1,10 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script moves the posts older than POST_ARCHIVE_AGE_DAYS (or the number of days given as the argument) from
+# the post table to the archive (see app/archive.py). Run it from cron, e.g. once a night.
+# The work is committed in batches, so the application can keep running while this script is working.
+import sys
+from app import archive
+
+age_days = int(sys.argv[1]) if len(sys.argv) > 1 else None
+posts = archive.archive_posts(age_days)
+print('{} posts archived.'.format(posts))
@@ -0,0 +1,17 @@
+# Benchmarks of the microblog application on a synthetic data set.
+#
+# tests.py works with a handful of users, which tells us nothing about how the pages behave with thousands of users
+# and a follow graph where a few users have most of the followers. This package:
+#     - generates a data set into a separate SQLite file (datagen.py): users, a power-law follow graph and posts
+#       with timestamps and languages spread over a number of days,
+#     - drives the real routes through the Flask test client, logged in as different users, and measures a few
+#       model functions directly (runner.py),
+#     - writes p50/p95/p99 latencies and the number of SQL statements per route to a JSON file, and compares two
+#       such files (compare.py), so we can see what a change did.
+#
+# Usage (from the directory with config.py):
+#     python -m benchmarks generate --db tmp/bench.db --users 5000
+#     python -m benchmarks run --db tmp/bench.db --out tmp/before.json
+#     ... change something ...
+#     python -m benchmarks run --db tmp/bench.db --out tmp/after.json
+#     python -m benchmarks compare tmp/before.json tmp/after.json
@@ -0,0 +1,71 @@
+# Command line of the benchmarks, see __init__.py for the usage.
+import argparse
+import json
+import os
+import sys
+from config import basedir
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks of the microblog.')
+    commands = parser.add_subparsers(dest='command')
+    generate = commands.add_parser('generate', help='create a database with synthetic data (drops it first!)')
+    generate.add_argument('--db', default='tmp/bench.db', help='SQLite file of the benchmark database')
+    generate.add_argument('--users', type=int, default=1000)
+    generate.add_argument('--follows', type=int, default=20, help='average number of followed users')
+    generate.add_argument('--posts', type=int, default=10, help='average number of posts of a user')
+    generate.add_argument('--alpha', type=float, default=1.1, help='exponent of the popularity distribution')
+    generate.add_argument('--days', type=int, default=30, help='the posts are spread over this many days')
+    generate.add_argument('--collisions', type=int, default=20,
+                          help='number of users with the same nickname and a suffix, for make_unique_nickname')
+    generate.add_argument('--seed', type=int, default=42)
+    run = commands.add_parser('run', help='run the benchmarks and write the results to a JSON file')
+    run.add_argument('--db', default='tmp/bench.db', help='SQLite file of the benchmark database')
+    run.add_argument('--out', default='tmp/bench.json', help='file for the results')
+    run.add_argument('--iterations', type=int, default=50)
+    run.add_argument('--warmup', type=int, default=5)
+    run.add_argument('--viewers', type=int, default=20, help='number of users we are logged in as')
+    run.add_argument('--seed', type=int, default=42)
+    compare = commands.add_parser('compare', help='compare the results of two runs')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help='slowdown of p50 or p95 in percent that counts as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        from .compare import compare as compare_results
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        lines, regressions = compare_results(old, new, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressions else 0
+    if args.command not in ('generate', 'run'):
+        parser.print_help()
+        return 2
+
+    # the application must use the benchmark database before anything touches the database
+    from app import app
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, args.db)
+    if args.command == 'generate':
+        from .datagen import generate as generate_data
+        counts = generate_data(users=args.users, follows=args.follows, posts=args.posts, alpha=args.alpha,
+                               days=args.days, collisions=args.collisions, seed=args.seed)
+        print('Generated {users} users, {follows} follow relationships and {posts} posts.'.format(**counts))
+    else:
+        from .runner import run as run_benchmarks
+        results = run_benchmarks(iterations=args.iterations, warmup=args.warmup, viewers=args.viewers,
+                                 seed=args.seed)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        for name, result in sorted(results['results'].items()):
+            print('{:<22} p50 {p50_ms:>9.2f} ms  p95 {p95_ms:>9.2f} ms  p99 {p99_ms:>9.2f} ms  '
+                  'sql {sql_mean:>6g}  errors {errors}'.format(name, **result))
+        print('Results written to {}'.format(args.out))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# Comparison of two benchmark results (the JSON files written by "python -m benchmarks run").
+
+
+def compare(old, new, threshold=10.0):
+    """ Compares the results of two runs, route by route.
+    :param old: results of the first run (the dictionary returned by runner.run)
+    :param new: results of the second run
+    :param threshold: change of p50 or p95 in percent that counts as a regression
+    :return: tuple (list of report lines, list of names of the routes that got slower than the threshold)
+    """
+    lines = ['{:<22}{:>24}{:>24}{:>16}'.format('route', 'p50 ms (old > new)', 'p95 ms (old > new)', 'sql (old > new)')]
+    regressions = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a = old['results'].get(name)
+        b = new['results'].get(name)
+        if a is None or b is None:
+            lines.append('{:<22}{}'.format(name, 'only in the new run' if a is None else 'only in the old run'))
+            continue
+        changes = [change(a[key], b[key]) for key in ('p50_ms', 'p95_ms')]
+        slower = any(c is not None and c > threshold for c in changes)
+        if slower:
+            regressions.append(name)
+        lines.append('{:<22}{:>24}{:>24}{:>16}{}'.format(
+            name,
+            '{:.2f} > {:.2f} {}'.format(a['p50_ms'], b['p50_ms'], percent(changes[0])),
+            '{:.2f} > {:.2f} {}'.format(a['p95_ms'], b['p95_ms'], percent(changes[1])),
+            '{:g} > {:g}'.format(a['sql_mean'], b['sql_mean']),
+            '  SLOWER' if slower else ''))
+    return lines, regressions
+
+
+def change(old, new):
+    """
+    :return: change from old to new in percent, None if old is 0
+    """
+    return (new - old) * 100.0 / old if old else None
+
+
+def percent(value):
+    return '(n/a)' if value is None else '({:+.0f}%)'.format(value)
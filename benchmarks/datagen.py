@@ -0,0 +1,131 @@
+# Generator of synthetic data for the benchmarks.
+#
+# The data goes into the database the application is configured with (the command line points it to a separate
+# file first), with plain executemany inserts, not through the ORM - a hundred thousand posts would take ages
+# otherwise. The database is dropped and created again, so never run this against a real database.
+#
+# Real social graphs are far from uniform: most users follow a few others, a few users follow a lot, and a handful
+# of users have most of the followers. So both the number of users someone follows and the number of posts he writes
+# are drawn from a Pareto distribution, and the users to follow are picked with a Zipf-like popularity (the user with
+# popularity rank r is picked with a weight of 1 / r ** alpha).
+# For the benchmark of make_unique_nickname there are also users with the nicknames COLLIDING_NICKNAME,
+# COLLIDING_NICKNAME + '2', ... up to the given number of collisions, and no other nickname starts with it.
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from app import db
+from app.models import User, Post, followers, email_hash, follow_graph
+from app import search, timeline
+
+WORDS = ('flask python post microblog hello world today coffee code database query index page timeline '
+         'follow friend music movie book travel weather morning evening weekend holiday work home').split()
+# a lot of posts are the same few texts
+COMMON_BODIES = ['Hello world!', '+1', 'Good morning everyone', 'lol', 'Happy new year!']
+LANGUAGES = [('en', 60), ('es', 15), ('fr', 10), ('de', 5), ('hr', 5), ('', 5)]
+COLLIDING_NICKNAME = 'john'
+
+
+def weighted_chooser(weights, rng):
+    """
+    :param weights: list of weights, one per item
+    :return: a function that returns a random index into the list, according to the weights
+    """
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return lambda: bisect_left(cumulative, rng.random() * total)
+
+
+def pareto_count(rng, mean, alpha, maximum):
+    """ A random count with the given mean, from a Pareto distribution (alpha > 1), at most maximum. """
+    return min(maximum, int(mean * (alpha - 1) / alpha * rng.paretovariate(alpha)))
+
+
+def generate(users=1000, follows=20, posts=10, alpha=1.1, days=30, common=0.1, collisions=20, seed=42,
+             batch_size=1000):
+    """ Creates an empty database and fills it with synthetic data.
+    :param users: number of users
+    :param follows: average number of users a user follows
+    :param posts: average number of posts of a user
+    :param alpha: exponent of the popularity distribution, bigger means more followers for the most popular users
+    :param days: the posts are spread over this many days before now
+    :param common: share of the posts that are one of a few common texts
+    :param collisions: number of users whose nickname is COLLIDING_NICKNAME with a suffix (or without one)
+    :param seed: seed of the random generator, the same seed gives the same data
+    :param batch_size: number of rows in one executemany
+    :return: dictionary with the numbers of users, follow relationships and posts
+    """
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    follow_graph.clear()
+    counts = {'users': users + collisions, 'follows': 0, 'posts': 0, 'nickname_collisions': collisions}
+    with db.engine.begin() as connection:
+        # the full text index is built at the end, it's much faster than the triggers doing it row by row
+        search.drop_triggers(connection)
+        rows = []
+        for user_id in range(1, users + 1):
+            nickname = 'user{}'.format(user_id)
+            email = nickname + '@example.com'
+            rows.append({'id': user_id, 'nickname': nickname, 'email': email, 'avatar_hash': email_hash(email),
+                         'about_me': 'I am {}'.format(nickname), 'timeline_pull': False,
+                         'last_seen': datetime.utcnow() - timedelta(seconds=rng.randint(0, days * 86400))})
+            if len(rows) >= batch_size:
+                connection.execute(User.__table__.insert(), rows)
+                rows = []
+        # john, john2, john3, ... (make_unique_nickname starts the suffixes with 2); they only follow themselves
+        for i in range(1, collisions + 1):
+            nickname = COLLIDING_NICKNAME + (str(i) if i > 1 else '')
+            email = nickname + '@example.com'
+            rows.append({'id': users + i, 'nickname': nickname, 'email': email, 'avatar_hash': email_hash(email),
+                         'about_me': 'I am {}'.format(nickname), 'timeline_pull': False, 'last_seen': None})
+        if rows:
+            connection.execute(User.__table__.insert(), rows)
+        connection.execute(followers.insert(), [{'follower_id': users + i, 'followed_id': users + i}
+                                                for i in range(1, collisions + 1)])
+        counts['follows'] += collisions
+
+        # the popularity ranks are shuffled, so the popular users are not simply the ones with small ids
+        ranked = list(range(1, users + 1))
+        rng.shuffle(ranked)
+        pick = weighted_chooser([1.0 / rank ** alpha for rank in range(1, users + 1)], rng)
+        rows = []
+        for user_id in range(1, users + 1):
+            followed = {user_id}    # everybody follows himself, like after_login does
+            wanted = pareto_count(rng, follows, 2.0, users - 1) + 1
+            attempts = 0
+            while len(followed) < wanted and attempts < wanted * 10:
+                followed.add(ranked[pick()])
+                attempts += 1
+            rows.extend({'follower_id': user_id, 'followed_id': followed_id} for followed_id in followed)
+            if len(rows) >= batch_size:
+                connection.execute(followers.insert(), rows)
+                counts['follows'] += len(rows)
+                rows = []
+        if rows:
+            connection.execute(followers.insert(), rows)
+            counts['follows'] += len(rows)
+
+        language = weighted_chooser([weight for code, weight in LANGUAGES], rng)
+        now = datetime.utcnow()
+        rows = []
+        for user_id in range(1, users + 1):
+            for i in range(pareto_count(rng, posts, 2.0, posts * 100)):
+                if rng.random() < common:
+                    body = rng.choice(COMMON_BODIES)
+                else:
+                    body = ' '.join(rng.choice(WORDS) for w in range(rng.randint(3, 15)))
+                rows.append({'body': body, 'user_id': user_id, 'language': LANGUAGES[language()][0],
+                             'timestamp': now - timedelta(seconds=rng.randint(0, days * 86400))})
+                if len(rows) >= batch_size:
+                    connection.execute(Post.__table__.insert(), rows)
+                    counts['posts'] += len(rows)
+                    rows = []
+        if rows:
+            connection.execute(Post.__table__.insert(), rows)
+            counts['posts'] += len(rows)
+    search.rebuild()
+    timeline.backfill()
+    return counts
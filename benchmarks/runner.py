@@ -0,0 +1,158 @@
+# Runs the benchmarks against the database the application is configured with (see datagen.py for the data).
+#
+# The routes are called through the Flask test client, so the whole request goes through the application: the
+# user loader, before_request, the view, the templates. The login goes around OpenID, the user id is put straight
+# into the session the way Flask-Login does it (like in tests.py). Some model functions that have no route of their
+# own are called directly, within a request context.
+# For every route we keep the time of every call and the number of SQL statements it executed, and report the
+# percentiles. The SQL statements are counted with an engine event, for the whole process.
+import platform
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from app import app, db
+from app.models import User, Post, followers
+from app.pagination import make_cursor
+from .datagen import COLLIDING_NICKNAME
+
+statements = [0]    # number of SQL statements executed so far
+Position = namedtuple('Position', ['timestamp', 'id'])     # what make_cursor needs from a post
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements[0] += 1
+
+
+def percentile(values, p):
+    """ Percentile by the nearest rank method.
+    :param values: sorted list of numbers
+    :param p: percentile, between 0 and 100
+    """
+    if not values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summary(times, sql_counts, errors):
+    times = sorted(times)
+    return {'calls': len(times),
+            'errors': errors,
+            'p50_ms': round(percentile(times, 50) * 1000, 3),
+            'p95_ms': round(percentile(times, 95) * 1000, 3),
+            'p99_ms': round(percentile(times, 99) * 1000, 3),
+            'mean_ms': round(sum(times) / len(times) * 1000, 3),
+            'sql_mean': round(float(sum(sql_counts)) / len(sql_counts), 2),
+            'sql_max': max(sql_counts)}
+
+
+def pick_viewers(count, rng):
+    """ The users we're logged in as: the ones that follow the most users (they have the most expensive home pages)
+    and a random sample of the rest.
+    """
+    heavy = [user_id for (user_id,) in db.session.query(followers.c.follower_id).
+             group_by(followers.c.follower_id).order_by(func.count().desc()).limit(max(1, count // 4))]
+    user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    others = rng.sample(user_ids, min(len(user_ids), count - len(heavy)))
+    return heavy + [user_id for user_id in others if user_id not in heavy]
+
+
+def popular_nicknames(count):
+    """ The users with the most followers (their profile pages are visited the most). """
+    return [nickname for (nickname,) in db.session.query(User.nickname).
+            join(followers, followers.c.followed_id == User.id).group_by(User.id).
+            order_by(func.count().desc()).limit(count)]
+
+
+def middle_cursor():
+    """ A cursor in the middle of the time range of the posts, for the pages deep in the past. """
+    oldest, newest = db.session.query(func.min(Post.timestamp), func.max(Post.timestamp)).one()
+    if oldest is None:
+        return None
+    return make_cursor(Position(oldest + (newest - oldest) / 2, 2 ** 31 - 1))
+
+
+def run(iterations=50, warmup=5, viewers=20, seed=42):
+    """ Runs all the benchmarks.
+    :param iterations: number of measured calls of every route
+    :param warmup: number of calls of every route before we start measuring (caches, ...)
+    :param viewers: number of different users we're logged in as
+    :return: dictionary with the data set, the settings and the results per route
+    """
+    started = datetime.utcnow()
+    rng = random.Random(seed)
+    app.config['TESTING'] = False                   # we don't want the statement limit assertions here
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    viewer_ids = pick_viewers(viewers, rng)
+    nicknames = popular_nicknames(viewers)
+    cursor = middle_cursor()
+    db.session.remove()
+
+    def get(url):
+        def call():
+            return client.get(url).status_code == 200
+        return call
+
+    def in_request(function):
+        # the model functions need a request context (the session, the statement counter of sqlstats.py)
+        def call():
+            with app.test_request_context():
+                function()
+                db.session.remove()
+            return True
+        return call
+
+    def benchmarks(i):
+        """ The benchmarks of the i-th iteration, name -> function that returns False if the call failed. """
+        viewer = viewer_ids[i % len(viewer_ids)]
+        nickname = nicknames[i % len(nicknames)]
+        result = [('index', get('/index')),
+                  ('user', get('/user/' + nickname)),
+                  ('search', get('/search?q=flask+python')),
+                  ('api_timeline', get('/api/v1/timeline')),
+                  ('followed_posts', in_request(
+                      lambda: User.query.get(viewer).followed_posts().limit(app.config['POSTS_PER_PAGE']).all())),
+                  ('is_following', in_request(
+                      lambda: User.query.get(viewer).is_following(User.query.filter_by(nickname=nickname).one()))),
+                  ('make_unique_nickname', in_request(lambda: User.make_unique_nickname(COLLIDING_NICKNAME)))]
+        if cursor is not None:
+            result += [('index_deep', get('/index/before/' + cursor)),
+                       ('user_deep', get('/user/{}/before/{}'.format(nickname, cursor)))]
+        return result
+
+    measurements = {}
+    for i in range(warmup + iterations):
+        with client.session_transaction() as session:
+            session['user_id'] = session['_user_id'] = str(viewer_ids[i % len(viewer_ids)])
+            session['_fresh'] = True
+        for name, call in benchmarks(i):
+            start_statements = statements[0]
+            start = time.perf_counter()
+            ok = call()
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                times, sql_counts, errors = measurements.setdefault(name, ([], [], [0]))
+                times.append(elapsed)
+                sql_counts.append(statements[0] - start_statements)
+                if not ok:
+                    errors[0] += 1
+    return {'started': started.isoformat() + 'Z',
+            'python': platform.python_version(),
+            'data': {'users': User.query.count(), 'posts': Post.query.count(),
+                     'follows': db.session.query(func.count()).select_from(followers).scalar(),
+                     # the nicknames make_unique_nickname has to skip
+                     'nickname_collisions': User.query.filter(User.nickname >= COLLIDING_NICKNAME,
+                                                              User.nickname < COLLIDING_NICKNAME + '~').count()},
+            'settings': {'iterations': iterations, 'warmup': warmup, 'viewers': len(viewer_ids),
+                         'TIMELINE_ENABLED': app.config.get('TIMELINE_ENABLED'),
+                         'FOLLOW_CACHE_ENABLED': app.config.get('FOLLOW_CACHE_ENABLED'),
+                         'USER_CACHE_ENABLED': app.config.get('USER_CACHE_ENABLED'),
+                         'POST_FRAGMENT_CACHE_ENABLED': app.config.get('POST_FRAGMENT_CACHE_ENABLED'),
+                         'POST_ARCHIVE_ENABLED': app.config.get('POST_ARCHIVE_ENABLED')},
+            'results': dict((name, summary(times, sql_counts, errors[0]))
+                            for name, (times, sql_counts, errors) in measurements.items())}
@@ -0,0 +1,32 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script imports users, posts and follow relationships from NDJSON or CSV files (see app/bulkload.py for the
+# columns), e.g.:
+#     ./bulk_import.py --users users.ndjson --follows follows.csv --posts posts.ndjson
+# If the import is interrupted, run the same command again and it continues where it stopped (--restart starts
+# from the beginning of the files). Stop the application first, its caches don't see the imported data.
+import argparse
+from app.bulkload import import_files
+
+
+def report(kind, stats):
+    print('{}: {} rows read, {} inserted, {} skipped in {:.1f} s ({:.0f} rows/s){}'.format(
+        kind, stats['rows'], stats['inserted'], stats['skipped'], stats['seconds'],
+        stats['rows'] / stats['seconds'] if stats['seconds'] else 0,
+        ', continued after row {}'.format(stats['resumed_at']) if stats['resumed_at'] else ''))
+
+
+parser = argparse.ArgumentParser(description='Bulk import of users, posts and follows.')
+parser.add_argument('--users', help='file with the users')
+parser.add_argument('--follows', help='file with the follow relationships')
+parser.add_argument('--posts', help='file with the posts')
+parser.add_argument('--batch-size', type=int, help='rows per transaction, BULK_IMPORT_BATCH_SIZE by default')
+parser.add_argument('--restart', action='store_true', help='ignore the checkpoints of an interrupted import')
+args = parser.parse_args()
+if not (args.users or args.follows or args.posts):
+    parser.error('nothing to import')
+results = import_files({'users': args.users, 'follows': args.follows, 'posts': args.posts},
+                       args.batch_size, not args.restart, report)
+print('Done.')
+for kind in ('users', 'follows', 'posts'):
+    if kind in results:
+        report(kind, results[kind])
@@ -33,6 +33,16 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
 # MySQL, Oracle, Postgres also available. The complete list: http://docs.sqlalchemy.org/en/rel_0_9/dialects/index.html
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
+# The read-only views read from here (see app/engine.py). None means the same database, through a separate pool of
+# read connections. Point it at a replica of app.db to take the reads off the main database file.
+SQLALCHEMY_READ_URI = os.environ.get('MICROBLOG_READ_DATABASE_URI')
+SQLITE_READ_POOL_SIZE = 5               # read connections that are kept open
+# Pragmas set on every SQLite connection
+SQLITE_JOURNAL_MODE = 'WAL'             # readers and the writer don't block each other
+SQLITE_SYNCHRONOUS = 'NORMAL'           # safe with WAL, a power loss may lose the last commits
+SQLITE_CACHE_SIZE = -64000              # page cache of each connection, negative means KiB (so 64 MB)
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024    # bytes of the database file read through memory mapped I/O
+SQLITE_BUSY_TIMEOUT = 5000              # milliseconds to wait for a lock before "database is locked"
 
 # mail server settings
 # MAIL_SERVER = 'localhost'
@@ -46,16 +56,98 @@ MAIL_USE_SSL = True
 MAIL_USERNAME = os.environ.get('MICROBLOG_MAIL_USERNAME')
 MAIL_PASSWORD = os.environ.get('MICROBLOG_MAIL_PASSWORD')
 
+# Emails are sent in the background by a pool of worker threads (see app/mailqueue.py).
+MAIL_WORKERS = 2            # number of worker threads, each keeps its own SMTP connection open
+MAIL_QUEUE_SIZE = 1000      # maximum number of emails waiting to be sent
+MAIL_PUT_TIMEOUT = 5        # seconds to wait for a place in a full queue before the email is dropped
+MAIL_BATCH_SIZE = 20        # maximum number of emails a worker sends in one go
+MAIL_MAX_RETRIES = 3        # how many times sending is retried after an SMTP or network error
+MAIL_RETRY_DELAY = 1.0      # seconds before the first retry, doubled for every next one
+MAIL_IDLE_TIMEOUT = 30      # seconds after which an unused SMTP connection is closed
+
+# New followers are announced in digest emails, sent by ./follower_digest.py (see send_follower_digests in emails.py)
+FOLLOWER_DIGEST_INTERVAL = 3600     # seconds between two digests, when the script runs with --loop
+FOLLOWER_DIGEST_BATCH_SIZE = 100    # number of users whose digests are built from one round of queries
+SERVER_URL = os.environ.get('MICROBLOG_SERVER_URL', 'http://localhost:5000/')   # for the links in the emails
+
+# The language of new posts is detected in the background (see app/langdetect.py)
+LANGUAGE_QUEUE_SIZE = 10000     # maximum number of posts waiting for detection, the rest is left to the backfill
+LANGUAGE_BATCH_SIZE = 100       # number of posts detected and updated together
+LANGUAGE_CACHE_SIZE = 10000     # number of post bodies whose language is remembered
+
+# The logged in users are loaded from an in-process cache (see app/usercache.py)
+USER_CACHE_ENABLED = True
+USER_CACHE_SIZE = 10000     # maximum number of cached users
+USER_CACHE_TTL = 300        # seconds a user stays in the cache, changes made by other processes show up after that
+
+# The rendered HTML of the posts is cached (see app/fragments.py)
+POST_FRAGMENT_CACHE_ENABLED = True
+POST_FRAGMENT_CACHE_SIZE = 10000    # maximum number of cached posts (one post has an entry per language and viewer)
+
+# JSON API (see app/api.py)
+API_PAGE_SIZE = 50              # default number of items on a page
+API_MAX_PAGE_SIZE = 200         # the limit argument can't go above this
+API_STREAM_BATCH_SIZE = 500     # number of rows read from the database at once when streaming NDJSON
+
+# Request metrics, exposed on /metrics (see app/metrics.py)
+METRICS_ENABLED = True
+SLOW_REQUEST_THRESHOLD = 1.0    # requests slower than this many seconds are logged, with their SQL statements
+SLOW_REQUEST_MAX_QUERIES = 100  # at most this many statements of a request are kept for the log
+
+# Sampling profiler, switched on at runtime from /admin/profiler (see app/sampler.py)
+SAMPLER_INTERVAL = 0.01         # seconds between two samples of the stacks
+SAMPLER_MAX_SECONDS = 3600      # the profiler can't be switched on for longer than this
+SAMPLER_MAX_STACKS = 10000      # maximum number of distinct stacks kept per endpoint
+
+# Export of the data of a user, /user/<nickname>/export and ./export_user.py (see app/export.py)
+EXPORT_BATCH_SIZE = 1000            # rows read from the database at once
+EXPORT_CHUNK_SIZE = 64 * 1024       # bytes sent (and compressed) at once
+
+# Bulk import of users, posts and follows, ./bulk_import.py (see app/bulkload.py)
+BULK_IMPORT_BATCH_SIZE = 5000       # rows inserted in one transaction
+BULK_IMPORT_REPORT_INTERVAL = 5     # seconds between two progress reports
+
+# Hot/cold storage of the posts, ./archive_posts.py (see app/archive.py)
+POST_ARCHIVE_ENABLED = True         # the pages read the archived posts too
+POST_ARCHIVE_AGE_DAYS = 365         # posts older than this are moved to the archive
+POST_ARCHIVE_BATCH_SIZE = 1000      # posts moved in one transaction
 
 # administrator list
 ADMINS = [os.environ.get('MICROBLOG_ADMIN_MAIL')]
+# Programs (e.g. a Prometheus server) get into the admin pages with this token, see app/decorators.py
+ADMIN_TOKEN = os.environ.get('MICROBLOG_ADMIN_TOKEN')
 
 # pagination
 POSTS_PER_PAGE = 3
 
-# Flask-WhooshAlchemy full text search config.
-# This is the full path and name of the whoosh database file:
-WHOOSH_BASE = os.path.join(basedir, 'search.db')
+# In debug and testing mode a request fails if it issues more SQL statements than this (see app/sqlstats.py).
+# This is how we find pages that load related objects one by one. Set to None to switch the check off.
+SQL_STATEMENT_LIMIT = 10
+
+# Materialized home timelines (see app/timeline.py).
+# When switched on, every new post is copied into the timelines of the author's followers, so the home page
+# doesn't have to join the posts with the followers. Run ./timeline_backfill.py after switching it on.
+TIMELINE_ENABLED = False
+# Authors with more followers than this are not fanned out. Their followers get the home page through the join.
+TIMELINE_FANOUT_LIMIT = 10000
+
+# In-process cache of the follow graph (see app/followcache.py). With FOLLOW_CACHE_WARM the whole graph is loaded
+# with the first request, otherwise it's loaded one user at a time. Every process has its own copy, the changes made
+# by the other processes show up after FOLLOW_CACHE_TTL seconds.
+FOLLOW_CACHE_ENABLED = True
+FOLLOW_CACHE_TTL = 60
+FOLLOW_CACHE_WARM = False
+
+# Write-behind buffer for the users' last_seen times (see app/lastseen.py).
+# Users seen less than LAST_SEEN_THRESHOLD seconds ago are not updated at all. The buffered values are written
+# when there are LAST_SEEN_FLUSH_SIZE of them, or LAST_SEEN_FLUSH_INTERVAL seconds after the previous write.
+LAST_SEEN_THRESHOLD = 60
+LAST_SEEN_FLUSH_SIZE = 100
+LAST_SEEN_FLUSH_INTERVAL = 30
+
+# Full text search (see app/search.py). The index is kept by SQLite itself (FTS5), in the same database file.
+# This is the maximum number of search results we show:
+MAX_SEARCH_RESULTS = 50
 
 # available languages for Flask-Babel
 LANGUAGES = {'en': 'English', 'hr': 'Hrvatski'}
@@ -63,3 +155,16 @@ LANGUAGES = {'en': 'English', 'hr': 'Hrvatski'}
 # Microsoft Translation Service
 MS_TRANSLATOR_CLIENT_ID = os.environ.get('MICROBLOG_MS_TRANSLATOR_CLIENT_ID')
 MS_TRANSLATOR_CLIENT_SECRET = os.environ.get('MICROBLOG_MS_TRANSLATOR_CLIENT_SECRET')
+# Translations are cached in memory (see app/translate.py): maximum number of cached translations, and the number
+# of seconds a translation is kept.
+TRANSLATION_CACHE_SIZE = 10000
+TRANSLATION_CACHE_TTL = 24 * 60 * 60
+# Number of connections to the translation service, which is also the number of requests sent at the same time.
+TRANSLATION_POOL_SIZE = 4
+# Number of texts sent to the translation service in one request, and the maximum number of posts that can be
+# translated with one call of /translate/batch.
+TRANSLATION_BATCH_SIZE = 50
+TRANSLATION_BATCH_MAX_ITEMS = 100
+# The texts go to the service in the URL of a GET request, and servers answer 414 (or 400) to URLs longer than a few
+# KB. A request has fewer texts than TRANSLATION_BATCH_SIZE if its URL would be longer than this.
+TRANSLATION_MAX_URL_LENGTH = 4000
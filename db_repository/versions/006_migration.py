@@ -0,0 +1,40 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+timeline = Table('timeline', post_meta,
+    Column('user_id', Integer, primary_key=True, nullable=False),
+    Column('post_id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+    Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp'),
+    Index('ix_timeline_post_id', 'post_id'),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('timeline_pull', Boolean(create_constraint=False)),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].create()
+    post_meta.tables['user'].columns['timeline_pull'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].drop()
+    post_meta.tables['user'].columns['timeline_pull'].drop()
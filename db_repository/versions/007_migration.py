@@ -0,0 +1,53 @@
+from sqlalchemy import *
+from migrate import *
+from hashlib import md5
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('avatar_hash', String(length=32)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('timeline_pull', Boolean(create_constraint=False)),
+)
+
+# number of users we calculate the avatar hash for in one transaction
+BATCH_SIZE = 1000
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['avatar_hash'].create()
+    # Fill in the hashes for existing users, in batches, so that we don't hold the write lock for too long on
+    # a big user table. We walk the table by id, each batch starts after the last id of the previous one.
+    user_table = post_meta.tables['user']
+    update = user_table.update().where(user_table.c.id == bindparam('user_id')).\
+        values(avatar_hash=bindparam('hash'))
+    last_id = 0
+    while True:
+        rows = migrate_engine.execute(select([user_table.c.id, user_table.c.email]).
+                                      where(user_table.c.id > last_id).
+                                      order_by(user_table.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        values = [{'user_id': row.id, 'hash': md5(row.email.encode('utf-8')).hexdigest()}
+                  for row in rows if row.email is not None]
+        if values:
+            with migrate_engine.begin() as connection:
+                connection.execute(update, values)
+        last_id = rows[-1].id
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['avatar_hash'].drop()
@@ -0,0 +1,29 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+notification = Table('notification', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('user_id', Integer),
+    Column('follower_id', Integer),
+    Column('timestamp', DateTime),
+    Index('ix_notification_user_id', 'user_id'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['notification'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['notification'].drop()
@@ -0,0 +1,52 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# Primary key of the followers table, the index in the other direction, and the index of the posts by author and
+# time (see app/models.py).
+# SQLite can't add a primary key to an existing table, so the followers table is copied into a new one. Duplicate
+# follow relationships (possible until now) are dropped on the way. ANALYZE gives the query planner the statistics
+# it needs to pick the new indexes.
+upgrade_statements = [
+    "CREATE TABLE followers_new (follower_id INTEGER NOT NULL, followed_id INTEGER NOT NULL, "
+    "PRIMARY KEY (follower_id, followed_id), "
+    "FOREIGN KEY(follower_id) REFERENCES user (id), FOREIGN KEY(followed_id) REFERENCES user (id))",
+    "INSERT OR IGNORE INTO followers_new (follower_id, followed_id) SELECT follower_id, followed_id FROM followers "
+    "WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL",
+    "DROP TABLE followers",
+    "ALTER TABLE followers_new RENAME TO followers",
+    "CREATE INDEX ix_followers_followed_id ON followers (followed_id, follower_id)",
+    "CREATE INDEX ix_post_user_id_timestamp ON post (user_id, timestamp)",
+    "ANALYZE",
+]
+downgrade_statements = [
+    "DROP INDEX IF EXISTS ix_post_user_id_timestamp",
+    "CREATE TABLE followers_old (follower_id INTEGER, followed_id INTEGER, "
+    "FOREIGN KEY(follower_id) REFERENCES user (id), FOREIGN KEY(followed_id) REFERENCES user (id))",
+    "INSERT INTO followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers",
+    "DROP TABLE followers",
+    "ALTER TABLE followers_old RENAME TO followers",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in upgrade_statements:
+            connection.execute(text(statement))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in downgrade_statements:
+            connection.execute(text(statement))
@@ -0,0 +1,38 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# The home timeline is sorted by (timestamp, post_id), the index has both, so a page is read straight from the
+# index instead of sorting the whole timeline of the user (see app/timeline.py).
+upgrade_statements = [
+    "DROP INDEX IF EXISTS ix_timeline_user_id_timestamp",
+    "CREATE INDEX ix_timeline_user_id_timestamp_post_id ON timeline (user_id, timestamp, post_id)",
+    "ANALYZE",
+]
+downgrade_statements = [
+    "DROP INDEX IF EXISTS ix_timeline_user_id_timestamp_post_id",
+    "CREATE INDEX ix_timeline_user_id_timestamp ON timeline (user_id, timestamp)",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in upgrade_statements:
+            connection.execute(text(statement))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in downgrade_statements:
+            connection.execute(text(statement))
@@ -0,0 +1,37 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# The posts whose language couldn't be detected had an empty language, like the ones that weren't detected yet.
+# Now they have 'und' (UNDETERMINED_LANGUAGE in app/models.py), and only NULL means "not detected yet".
+upgrade_statements = [
+    "UPDATE post SET language = 'und' WHERE language = ''",
+    "UPDATE post_archive SET language = 'und' WHERE language = ''",
+]
+downgrade_statements = [
+    "UPDATE post SET language = '' WHERE language = 'und'",
+    "UPDATE post_archive SET language = '' WHERE language = 'und'",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in upgrade_statements:
+            connection.execute(text(statement))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in downgrade_statements:
+            connection.execute(text(statement))
@@ -0,0 +1,59 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# The post table becomes AUTOINCREMENT, so the ids of the archived posts are never given to new posts (see
+# app/archive.py). SQLite can't change that on an existing table, so the table is built again, with the same ids,
+# and with its index and the full text triggers (see app/search.py). The full text index itself stays, it only
+# stores the ids. The sequence starts after the biggest id in both tables.
+columns = 'id, body, timestamp, user_id, language'
+triggers = [
+    "CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+]
+
+
+def rebuild_statements(id_column):
+    return [
+        "CREATE TABLE post_new ({}, body VARCHAR(140), timestamp DATETIME, user_id INTEGER, language VARCHAR(5), "
+        "FOREIGN KEY(user_id) REFERENCES user (id))".format(id_column),
+        "INSERT INTO post_new ({0}) SELECT {0} FROM post".format(columns),
+        "DROP TABLE post",
+        "ALTER TABLE post_new RENAME TO post",
+        "CREATE INDEX ix_post_user_id_timestamp ON post (user_id, timestamp)",
+    ] + triggers
+
+upgrade_statements = rebuild_statements('id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT') + [
+    "INSERT INTO sqlite_sequence (name, seq) SELECT 'post', 0 "
+    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'post')",
+    "UPDATE sqlite_sequence SET seq = max(seq, (SELECT coalesce(max(id), 0) FROM post_archive)) WHERE name = 'post'",
+]
+downgrade_statements = rebuild_statements('id INTEGER NOT NULL PRIMARY KEY')
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in upgrade_statements:
+            connection.execute(text(statement))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in downgrade_statements:
+            connection.execute(text(statement))
@@ -0,0 +1,47 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# Full text search index of the archived posts (SQLite FTS5), see app/search.py. Like the index of the posts in
+# migration 008, it's not something the model knows about, so the statements are written by hand.
+create_statements = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_archive_fts USING fts5(body, content='post_archive', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_insert AFTER INSERT ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_delete AFTER DELETE ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_archive_fts_update AFTER UPDATE OF body ON post_archive BEGIN "
+    "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_archive_fts (rowid, body) VALUES (new.id, new.body); END",
+    # index the posts that were archived before
+    "INSERT INTO post_archive_fts (post_archive_fts) VALUES ('rebuild')",
+]
+drop_statements = [
+    "DROP TRIGGER IF EXISTS post_archive_fts_insert",
+    "DROP TRIGGER IF EXISTS post_archive_fts_delete",
+    "DROP TRIGGER IF EXISTS post_archive_fts_update",
+    "DROP TABLE IF EXISTS post_archive_fts",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in create_statements:
+            connection.execute(text(statement))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    with migrate_engine.begin() as connection:
+        for statement in drop_statements:
+            connection.execute(text(statement))
@@ -0,0 +1,29 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script exports all the data of a user (profile, posts, followers, followed users) to a file, the same export
+# that the user gets on /user/<nickname>/export (see app/export.py), e.g.:
+#     ./export_user.py john --format csv --gzip
+# The export is written while it's read from the database, so it doesn't matter how many posts the user has.
+import argparse
+import sys
+from app.models import User
+from app.export import FORMATS, export, filename
+
+parser = argparse.ArgumentParser(description='Export of all the data of a user.')
+parser.add_argument('nickname')
+parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+parser.add_argument('--gzip', action='store_true', help='compress the export')
+parser.add_argument('-o', '--output', help='file name, microblog-<nickname>.<format> by default, - for stdout')
+args = parser.parse_args()
+user = User.query.filter_by(nickname=args.nickname).first()
+if user is None:
+    sys.exit('User {} not found.'.format(args.nickname))
+output = args.output or filename(user, args.format, args.gzip)
+f = sys.stdout.buffer if output == '-' else open(output, 'wb')
+try:
+    for chunk in export(user, args.format, args.gzip):
+        f.write(chunk)
+finally:
+    if f is not sys.stdout.buffer:
+        f.close()
+if output != '-':
+    print('Exported {} to {}.'.format(user.nickname, output))
@@ -0,0 +1,15 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script sends the digest emails with new followers (see send_follower_digests in app/emails.py).
+# Run it periodically, e.g. from cron, or start it with --loop and it will send the digests every
+# FOLLOWER_DIGEST_INTERVAL seconds. The period is the window in which the follows are collected into one email.
+import sys
+import time
+from app import app
+from app.emails import send_follower_digests
+
+while True:
+    sent = send_follower_digests()
+    print('{} follower digests sent.'.format(sent))
+    if '--loop' not in sys.argv:
+        break
+    time.sleep(app.config['FOLLOWER_DIGEST_INTERVAL'])
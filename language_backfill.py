@@ -0,0 +1,10 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script detects the language of all the posts that don't have one (see app/langdetect.py).
+# The language of new posts is detected in the background, and the posts that were still waiting in the queue when
+# the application stopped are left without a language. Run this script after a restart, or from cron.
+import sys
+from app.langdetect import language_detector
+
+batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else None
+posts = language_detector.backfill(batch_size)
+print('Language detected for {} posts.'.format(posts))
@@ -0,0 +1,8 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script rebuilds the full text search indexes of the posts (see app/search.py) from the post tables.
+# The index is normally kept in sync by database triggers, so you only need this if you suspect it got out of sync,
+# or after loading posts with the triggers switched off.
+from app import search
+
+search.rebuild()
+print('Search index rebuilt.')
@@ -2,12 +2,140 @@
 # This is a unit test script.
 # For more information see: http://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-vii-unit-testing
 import os
+import json
+import threading
+import time
+import shutil
+import gzip
+import tempfile
 import unittest
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler     # Python 2
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler      # Python 3
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urllib.parse import urlparse, parse_qs
 
+import socket
 from datetime import datetime, timedelta
-from config import basedir
+from flask.ext.mail import Mail, Message
+from config import basedir, TRANSLATION_MAX_URL_LENGTH
 from app import app, db
-from app.models import User, Post
+from app.models import User, Post, ArchivedPost, PostRow, post_rows, follow_graph, followers
+from app import timeline
+from app.pagination import KeysetPage, newest_first
+from app.lastseen import LastSeenBuffer
+from app import search
+from app.search import search_posts
+from app.cache import LRUCache
+from app import translate
+from app.translate import MicrosoftTranslator
+from app.mailqueue import MailDispatcher, open_connection
+from app import emails
+from app.langdetect import LanguageDetector, language_detector
+from app.usercache import user_cache
+from app.fragments import post_fragments
+from benchmarks import datagen, runner
+from benchmarks.compare import compare
+from app.metrics import metrics
+from app.sampler import sampler
+from app import followcache
+from app import archive
+from app import export
+from app import bulkload
+from app import queryplan
+from app import decorators
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+
+class TranslatorStandIn(BaseHTTPRequestHandler):
+    ''' A local stand-in for the Microsoft Translator service (both the OAuth and the translation part).
+    It "translates" by turning the text to upper case.
+    '''
+    protocol_version = 'HTTP/1.1'     # keep-alive
+    connections = 0
+    delay = 0                         # seconds a translation takes
+    short = False                     # TranslateArray leaves out the last translation
+    longest_path = 0
+
+    def setup(self):
+        TranslatorStandIn.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def reply(self, body):
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(json.dumps({'access_token': 'secret-token', 'expires_in': '600'}))
+
+    def do_GET(self):
+        TranslatorStandIn.longest_path = max(TranslatorStandIn.longest_path, len(self.path))
+        params = parse_qs(urlparse(self.path).query)
+        assert params['appId'] == ['Bearer secret-token']
+        time.sleep(TranslatorStandIn.delay)
+        if self.path.startswith('/V2/Ajax.svc/TranslateArray'):
+            texts = json.loads(params['texts'][0])
+            results = [{'TranslatedText': text.upper()} for text in texts]
+            self.reply(u'\ufeff' + json.dumps(results[:-1] if TranslatorStandIn.short else results))
+        else:
+            self.reply(u'\ufeff' + json.dumps(params['text'][0].upper()))
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SMTPStandIn(StreamRequestHandler):
+    ''' A local stand-in for an SMTP server. It accepts every message and remembers the recipients. '''
+    connections = 0
+    messages = []
+
+    def handle(self):
+        SMTPStandIn.connections += 1
+        self.reply('220 localhost ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode('utf-8')
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250 localhost')
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip().strip('<>'))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                SMTPStandIn.messages.append(recipients)
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            elif command in ('HELO', 'MAIL', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            else:
+                self.reply('502 Command not implemented')
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+
+class ThreadedSMTPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
 
 
 class TestCase(unittest.TestCase):
@@ -15,18 +143,37 @@ class TestCase(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+        app.config['TIMELINE_ENABLED'] = True
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+        app.config['SQL_STATEMENT_LIMIT'] = 10
         self.app = app.test_client()
         db.create_all()
+        follow_graph.clear()    # the ids are reused after drop_all, the cached graph would be wrong
+        user_cache.clear()      # same for the cached users
+        post_fragments.clear()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
 
+    def login(self, user):
+        self.login_id(user.id)
+
+    def login_id(self, user_id):
+        # Logs the user in without going through OpenID, by putting his id into the session the way Flask-Login does
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+
     def test_avatar(self):
         u = User(nickname='john', email='john@example.com')
         avatar = u.avatar(128)
         expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
         assert avatar[0:len(expected)] == expected
+        # the hash follows the email when it changes
+        u.email = 'susan@example.com'
+        assert u.avatar_hash == 'f3fc30174d7fd74ab6ca3c36d198fcb9'
+        assert u.avatar(128) == 'http://www.gravatar.com/avatar/{}?d=mm&s=128'.format(u.avatar_hash)
 
     def test_make_unique_nickname(self):
         u = User(nickname='john', email='john@example.com')
@@ -41,6 +188,25 @@ class TestCase(unittest.TestCase):
         assert nickname2 != 'john'
         assert nickname2 != nickname
 
+    def test_make_unique_nickname_query_count(self):
+        # Finding a free nickname costs one query, no matter how many variants of the nickname are taken.
+        from app.sqlstats import statement_count
+        db.session.add(User(nickname='johnny', email='johnny@example.com'))     # same prefix, but not a variant
+        db.session.add(User(nickname='joho', email='joho@example.com'))         # right after the prefix range
+        db.session.commit()
+        taken = 0
+        for collisions in (0, 1, 10, 50):
+            # take john, john2, john3, ... up to the number of collisions
+            for i in range(taken + 1, collisions + 1):
+                nickname = 'john' if i == 1 else 'john{}'.format(i)
+                db.session.add(User(nickname=nickname, email='{}@example.com'.format(nickname)))
+            db.session.commit()
+            taken = collisions
+            with app.test_request_context():
+                nickname = User.make_unique_nickname('john')
+                assert statement_count() == 1
+            assert nickname == ('john' if collisions == 0 else 'john{}'.format(collisions + 1))
+
     def test_follow(self):
         u1 = User(nickname='john', email='john@example.com')
         u2 = User(nickname='susan', email='susan@example.com')
@@ -64,6 +230,75 @@ class TestCase(unittest.TestCase):
         assert u1.followed.count() == 0    # test: u1 is not following anyone
         assert u2.followers.count() == 0   # test: u2 has no followers
 
+    def test_follow_graph_cache(self):
+        users = [User(nickname='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        u1, u2, u3, u4 = users
+        for u in (u2, u4, u3):
+            db.session.add(u1.follow(u))
+        db.session.add(u2.follow(u4))
+        db.session.commit()
+        # the cache gives the same answers as the database
+        assert list(follow_graph.followed_ids(u1.id)) == sorted([u2.id, u3.id, u4.id])
+        assert u1.is_following(u3) and not u3.is_following(u1)
+        assert u4.follower_count() == u4.followers.count() == 2
+        assert u1.followed_count() == u1.followed.count() == 3
+        # follow and unfollow keep the loaded arrays up to date
+        db.session.add(u1.unfollow(u3))
+        db.session.add(u3.follow(u4))
+        db.session.commit()
+        assert not u1.is_following(u3) and u3.is_following(u4)
+        assert u4.follower_count() == 3
+        # a rollback throws away the arrays the session changed, and only those
+        db.session.add(u1.follow(u3))
+        assert u1.is_following(u3)
+        db.session.rollback()
+        assert u1.id not in follow_graph.followed and u3.id not in follow_graph.followers
+        assert u2.id in follow_graph.followed
+        assert not u1.is_following(u3)
+        # a follow that happens while an array is being loaded is not lost
+        follow_graph.clear()
+        real_connection = db.session.connection
+
+        def connection(**kwargs):
+            with follow_graph.lock:
+                follow_graph._change(followcache._insert, 'followed', u3.id, u1.id)   # another thread
+            return real_connection(**kwargs)
+        db.session.connection = connection
+        try:
+            assert list(follow_graph.followed_ids(u3.id)) == sorted([u1.id, u4.id])
+        finally:
+            db.session.connection = real_connection
+        assert list(follow_graph.followed[u3.id]) == sorted([u1.id, u4.id]) and not follow_graph.loading
+        # and warm() loads everything in one go
+        assert follow_graph.warm() == 4
+        assert list(follow_graph.follower_ids(u4.id)) == sorted([u1.id, u2.id, u3.id])
+        # no SQL is needed for the checks once the graph is loaded
+        with app.test_request_context():
+            from app.sqlstats import statement_count
+            assert u2.is_following(u4) and u4.follower_count() == 3
+            assert statement_count() == 0
+        # the follows of the other processes (here written around the cache) show up after FOLLOW_CACHE_TTL
+        db.session.execute(followers.insert().values(follower_id=u2.id, followed_id=u1.id))
+        db.session.commit()
+        assert not u2.is_following(u1)
+        app.config['FOLLOW_CACHE_TTL'] = 0
+        try:
+            assert u2.is_following(u1)
+        finally:
+            app.config['FOLLOW_CACHE_TTL'] = 60
+        # and the follow and unfollow views check the database, not the cache
+        db.session.execute(followers.insert().values(follower_id=u3.id, followed_id=u2.id))
+        db.session.commit()
+        assert not u3.is_following(u2)
+        u2_id, u3_id = u2.id, u3.id
+        self.login(u3)
+        assert self.app.get('/follow/user1').status_code == 302     # not a duplicate row and a 500
+        assert 'already following' in self.app.get('/user/user1').data.decode('utf-8')
+        self.app.get('/unfollow/user1')
+        assert not db.session.query(followers).filter_by(follower_id=u3_id, followed_id=u2_id).count()
+
     def test_follow_posts(self):
         # make four users
         u1 = User(nickname='john', email='john@example.com')
@@ -113,6 +348,845 @@ class TestCase(unittest.TestCase):
         assert f3 == [p4, p3]
         assert f4 == [p4]
 
+    def test_timeline(self):
+        # make three users, everybody follows himself
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        for u in (u1, u2, u3):
+            db.session.add(u.follow(u))
+        db.session.commit()
+        # john follows susan before she writes anything, and mary after she wrote a post
+        db.session.add(u1.follow(u2))
+        timeline.on_follow(u1, u2)
+        db.session.commit()
+        utcnow = datetime.utcnow()
+        posts = []
+        for i, u in enumerate((u1, u2, u3)):
+            p = Post(body='post from ' + u.nickname, author=u, timestamp=utcnow + timedelta(seconds=i))
+            db.session.add(p)
+            db.session.flush()
+            timeline.fan_out(p)
+            posts.append(p)
+        db.session.commit()
+        db.session.add(u1.follow(u3))
+        timeline.on_follow(u1, u3)
+        db.session.commit()
+        # the materialized timeline has the same posts in the same order as the join
+        assert timeline.home_timeline(u1).all() == u1.followed_posts().all() == posts[::-1]
+        assert timeline.home_timeline(u2).all() == [posts[1]]
+        # unfollow and delete take the posts out of the timeline
+        db.session.add(u1.unfollow(u3))
+        timeline.on_unfollow(u1, u3)
+        timeline.remove_post(posts[1])
+        db.session.delete(posts[1])
+        db.session.commit()
+        assert timeline.home_timeline(u1).all() == [posts[0]]
+        # a popular author is not fanned out, his followers fall back to the join
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        p = Post(body='another post from susan', author=u2, timestamp=utcnow + timedelta(seconds=10))
+        db.session.add(p)
+        db.session.flush()
+        timeline.fan_out(p)
+        db.session.commit()
+        assert u2.timeline_pull
+        assert timeline.home_timeline(u1).all() == [p, posts[0]]
+        # the backfill rebuilds the same timelines from scratch
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+        timeline.backfill(batch_size=2)
+        assert not User.query.get(u2.id).timeline_pull
+        assert timeline.home_timeline(u1).all() == [p, posts[0]]
+
+    def test_keyset_pagination(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        utcnow = datetime.utcnow()
+        # seven posts, some of them with the same timestamp, so the id has to break the ties
+        for i in range(7):
+            db.session.add(Post(body='post {}'.format(i), author=u, timestamp=utcnow + timedelta(seconds=i // 2)))
+        db.session.commit()
+        expected = u.posts.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+        # walk all the way to the oldest posts...
+        pages = [KeysetPage(u.posts, 3)]
+        while pages[-1].has_older:
+            pages.append(KeysetPage(u.posts, 3, before=pages[-1].older_cursor))
+        assert [p.items for p in pages] == [expected[0:3], expected[3:6], expected[6:7]]
+        assert not pages[0].has_newer and pages[1].has_newer
+        # ...and back to the newest ones
+        back = KeysetPage(u.posts, 3, after=pages[2].newer_cursor)
+        assert back.items == expected[3:6]
+        assert back.has_newer and back.has_older
+        newest = KeysetPage(u.posts, 3, after=back.newer_cursor)
+        assert newest.items == expected[0:3]
+        assert not newest.has_newer
+
+    def test_search(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        p1 = Post(body='I am learning flask', author=u, timestamp=datetime.utcnow())
+        p2 = Post(body='flask, flask and more flask', author=u, timestamp=datetime.utcnow())
+        p3 = Post(body='nothing to see here', author=u, timestamp=datetime.utcnow())
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        # the triggers have indexed the new posts, and the better match comes first
+        posts, has_next = search_posts('flask')
+        assert [p.id for p in posts] == [p2.id, p1.id] and not has_next
+        assert search_posts('learn*')[0][0].body == p1.body
+        assert search_posts('flask', per_page=1) == (search_posts('flask')[0][:1], True)
+        assert search_posts('"OR flask:')[0] == []     # FTS5 syntax is searched for as plain text
+        # updates and deletes are reflected in the index
+        p1.body = 'I am learning django'
+        db.session.delete(p2)
+        db.session.commit()
+        assert search_posts('flask') == ([], False)
+        assert [p.id for p in search_posts('django')[0]] == [p1.id]
+        search.rebuild()
+        assert [p.id for p in search_posts('django')[0]] == [p1.id]
+
+    def test_translator(self):
+        TranslatorStandIn.connections = 0
+        server = ThreadedHTTPServer(('127.0.0.1', 0), TranslatorStandIn)
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            host = '127.0.0.1:{}'.format(server.server_address[1])
+            translator = MicrosoftTranslator('id', 'secret', auth_host=host, auth_secure=False, api_host=host)
+            assert translator.translate('dobar dan', 'hr', 'en') == 'DOBAR DAN'
+            assert translator.translate('laku noc', 'hr', 'en') == 'LAKU NOC'
+            # the token is reused, and the same text is not translated twice
+            assert translator.translate('dobar dan', 'hr', 'en') == 'DOBAR DAN'
+            assert translator.requests == {'auth': 1, 'api': 2}
+            # one connection for the token and one for the translations
+            assert TranslatorStandIn.connections == 2
+            # an expired token is renewed, a closed connection is reopened
+            translator.token_expires = 0
+            translator.connections['api'][0].close()
+            assert translator.translate('bok', 'hr', 'en') == 'BOK'
+            assert translator.requests == {'auth': 2, 'api': 3}
+            # the translations are sent in parallel, each over its own connection
+            TranslatorStandIn.delay = 0.3
+            threads = [threading.Thread(target=translator.translate, args=('tekst {}'.format(i), 'hr', 'en'))
+                       for i in range(3)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert time.time() - start < 0.8 and translator.requests['api'] == 6
+            assert len(translator.connections['api']) == 3
+            # a batch of long non-ASCII texts is split so that no URL is too long for the server
+            TranslatorStandIn.delay = 0
+            texts = [u'\u0161\u0111\u010d\u0107\u017e {} '.format(i) * 20 for i in range(50)]
+            requests = translator.requests['api']
+            translations = translator.translate_many(texts, 'hr', 'en')
+            assert translations == dict((text, text.upper()) for text in texts)
+            assert translator.requests['api'] - requests > 1
+            assert TranslatorStandIn.longest_path <= TRANSLATION_MAX_URL_LENGTH
+        finally:
+            TranslatorStandIn.delay = 0
+            server.shutdown()
+            server.server_close()
+
+    def test_translate_batch(self):
+        server = ThreadedHTTPServer(('127.0.0.1', 0), TranslatorStandIn)
+        threading.Thread(target=server.serve_forever).start()
+        default_translator = translate.translator
+        try:
+            host = '127.0.0.1:{}'.format(server.server_address[1])
+            translate.translator = MicrosoftTranslator('id', 'secret', auth_host=host, auth_secure=False,
+                                                       api_host=host)
+            u = User(nickname='john', email='john@example.com')
+            db.session.add(u)
+            posts = [Post(body=body, author=u, timestamp=datetime.utcnow(), language=language)
+                     for body, language in [('dobar dan', 'hr'), ('dobar dan', 'hr'), ('laku noc', 'hr'),
+                                            ('bonjour', 'fr')]]
+            db.session.add_all(posts)
+            db.session.commit()
+            ids = [str(p.id) for p in posts]
+            items = [{'post_id': p.id, 'sourcelang': p.language, 'destlang': 'en'} for p in posts]
+            self.login(u)
+            items.append({'post_id': 12345, 'sourcelang': 'hr', 'destlang': 'en'})
+            items.append({'sourcelang': 'hr'})
+            response = self.app.post('/translate/batch', data=json.dumps({'items': items}),
+                                     content_type='application/json')
+            result = json.loads(response.data.decode('utf-8'))
+            assert result['translations'] == dict(zip(ids, ['DOBAR DAN', 'DOBAR DAN', 'LAKU NOC', 'BONJOUR']))
+            assert result['errors'] == {'12345': 'Post not found.', 'None': 'Invalid item.'}
+            # one token, one request per language pair, the duplicate text is sent only once
+            assert translate.translator.requests == {'auth': 1, 'api': 2}
+            assert self.app.post('/translate/batch', data='nonsense').status_code == 400
+            # a response with a translation missing is an error of the items, not of the whole request
+            TranslatorStandIn.short = True
+            items = [{'post_id': p.id, 'sourcelang': 'hr', 'destlang': 'de'} for p in posts[:3]]
+            response = self.app.post('/translate/batch', data=json.dumps({'items': items}),
+                                     content_type='application/json')
+            assert response.status_code == 200
+            result = json.loads(response.data.decode('utf-8'))
+            assert result['translations'] == {} and len(result['errors']) == 3
+        finally:
+            TranslatorStandIn.short = False
+            translate.translator = default_translator
+            server.shutdown()
+            server.server_close()
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)           # b is the least recently used one
+        assert cache.get('b') is None and cache.get('c') == 3
+        assert cache.hits == 2 and cache.misses == 1
+        cache = LRUCache(10, ttl=-1)    # everything expires right away
+        cache.set('a', 1)
+        assert cache.get('a', 'missing') == 'missing' and len(cache) == 0
+
+    def test_last_seen_buffer(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com', last_seen=datetime.utcnow())
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        app.config['LAST_SEEN_FLUSH_SIZE'] = 100
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        buf = LastSeenBuffer()
+        now = datetime.utcnow()
+        buf.touch(u1, now)
+        buf.touch(u2, now)                          # susan was seen just now, she's skipped
+        buf.touch(u1, now + timedelta(seconds=1))   # john is already in the buffer
+        assert list(buf.pending.keys()) == [u1.id]
+        assert User.query.get(u1.id).last_seen is None    # nothing is written yet
+        assert buf.flush() == 1
+        db.session.expire_all()
+        assert User.query.get(u1.id).last_seen == now
+        # when the buffer is full it's flushed right away
+        app.config['LAST_SEEN_FLUSH_SIZE'] = 1
+        buf.touch(u1, now + timedelta(hours=1))
+        assert not buf.pending
+        db.session.expire_all()
+        assert User.query.get(u1.id).last_seen == now + timedelta(hours=1)
+
+    def test_post_rows(self):
+        # john follows five users, each of them has one post
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(u.follow(u))
+        utcnow = datetime.utcnow()
+        for i in range(5):
+            author = User(nickname='user{}'.format(i), email='user{}@example.com'.format(i))
+            db.session.add(author)
+            db.session.add(Post(body='post {}'.format(i), author=author, timestamp=utcnow + timedelta(seconds=i)))
+            db.session.add(u.follow(author))
+        db.session.commit()
+        rows = post_rows(u.followed_posts()).all()
+        assert len(rows) == 5 and all(isinstance(row, PostRow) for row in rows)
+        assert rows[0].author_nickname == 'user4' and rows[0].body == 'post 4'
+        assert rows[0].author_avatar(50) == User.query.filter_by(nickname='user4').first().avatar(50)
+        # the page is rendered with a fixed number of statements, no matter how many authors there are
+        app.config['SQL_STATEMENT_LIMIT'] = 5
+        timeline.backfill()     # the posts were not fanned out when they were written
+        self.login(u)
+        response = self.app.get('/index')
+        assert response.status_code == 200
+        assert b'user4' in response.data and b'user2' in response.data
+        response = self.app.get('/user/user4')
+        assert response.status_code == 200 and b'post 4' in response.data
+
+    def test_mail_dispatcher(self):
+        SMTPStandIn.connections = 0
+        SMTPStandIn.messages = []
+        server = ThreadedSMTPServer(('127.0.0.1', 0), SMTPStandIn)
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            state = Mail().init_mail({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': server.server_address[1],
+                                      'MAIL_USE_SSL': False, 'MAIL_USE_TLS': False})
+            failures = [socket.error('connection refused')]
+
+            def connect():
+                # the first attempt fails, like a server that is restarting
+                if failures:
+                    raise failures.pop()
+                return open_connection(state)
+
+            dispatcher = MailDispatcher(workers=1, batch_size=10, retry_delay=0.01, connect=connect)
+            for i in range(5):
+                msg = Message(subject='hello', sender='admin@example.com', recipients=['user{}@example.com'.format(i)])
+                msg.body = 'hello'
+                assert dispatcher.send(msg)
+            dispatcher.shutdown()   # sends what's left in the queue before returning
+            assert dispatcher.sent == 5 and dispatcher.failed == 0
+            assert SMTPStandIn.messages == [['user{}@example.com'.format(i)] for i in range(5)]
+            assert SMTPStandIn.connections == 1     # all the emails went over the same connection
+            # a full queue doesn't block the request for long, the email is dropped instead
+            dispatcher = MailDispatcher(workers=1, queue_size=1, put_timeout=0.01)
+            dispatcher.start = lambda: None     # no workers, so nothing leaves the queue
+            assert dispatcher.send(msg)
+            assert not dispatcher.send(msg)
+            assert dispatcher.dropped == 1 and dispatcher.depth() == 1
+            # and shutdown doesn't wait forever for workers that don't take anything out of the full queue
+            dispatcher.threads = [threading.current_thread()]
+            dispatcher.shutdown()
+            assert dispatcher.depth() == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_follower_digest(self):
+        users = [User(nickname=nickname, email=nickname + '@example.com')
+                 for nickname in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(users)
+        db.session.commit()
+        john, susan, mary, david = [u.id for u in users]
+        # three users follow john, one of them changes his mind before the digest is sent
+        for user_id in (susan, mary, david):
+            self.login_id(user_id)
+            assert self.app.get('/follow/john').status_code == 302
+        self.login_id(david)
+        self.app.get('/unfollow/john')
+        # susan gets followed by john
+        self.login_id(john)
+        self.app.get('/follow/susan')
+
+        class Outbox(list):
+            send = list.append
+        default_dispatcher = emails.mail_dispatcher
+        emails.mail_dispatcher = outbox = Outbox()
+        try:
+            assert emails.send_follower_digests() == 2
+            assert emails.send_follower_digests() == 0     # the events are gone after they have been sent
+        finally:
+            emails.mail_dispatcher = default_dispatcher
+        digests = dict((msg.recipients[0], msg) for msg in outbox)
+        assert sorted(digests) == ['john@example.com', 'susan@example.com']
+        assert digests['john@example.com'].subject == '[microblog] You have 2 new followers!'
+        assert 'susan' in digests['john@example.com'].body and 'mary' in digests['john@example.com'].body
+        assert 'david' not in digests['john@example.com'].body
+        assert 'http://localhost:5000/user/mary' in digests['john@example.com'].html
+        assert digests['susan@example.com'].subject == '[microblog] john is now following you!'
+
+    def test_language_detection(self):
+        english = 'This is a rather long sentence that is written in the English language, to be detected.'
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        response = self.app.post('/index', data={'post': english})
+        assert response.status_code == 302
+        language_detector.join()    # the detection runs in the background
+        assert Post.query.one().language == 'en'
+        # the backfill detects the language of the posts that don't have one, detecting each body only once
+        db.session.add_all([Post(body=english, author=u, timestamp=datetime.utcnow()) for i in range(3)])
+        db.session.add(Post(body='1 2 3', author=u, timestamp=datetime.utcnow()))
+        db.session.commit()
+        detector = LanguageDetector(batch_size=2)
+        assert detector.backfill() == 4
+        assert detector.cache.misses == 2 and detector.cache.hits == 2
+        db.session.expire_all()
+        assert [p.language for p in Post.query.order_by(Post.id)] == ['en', 'en', 'en', 'en', 'und']
+        # the post whose language can't be detected is not tried again
+        assert detector.backfill() == 0
+
+    def test_user_cache(self):
+        u = User(nickname='john', email='john@example.com', about_me='old about me', last_seen=datetime.utcnow())
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        hits = user_cache.stats()['hits']
+        assert b'old about me' in self.app.get('/user/john').data
+        assert b'old about me' in self.app.get('/user/john').data
+        assert user_cache.stats()['hits'] == hits + 1   # the second request didn't load the user from the database
+        # editing the profile throws the cached user out
+        response = self.app.post('/edit', data={'nickname': 'johnny', 'about_me': 'new about me'})
+        assert response.status_code == 302
+        assert b'new about me' in self.app.get('/user/johnny').data
+        # and so does any other write to the user table
+        misses = user_cache.stats()['misses']
+        User.query.update({'about_me': 'bulk about me'})
+        db.session.commit()
+        assert b'bulk about me' in self.app.get('/user/johnny').data
+        assert user_cache.stats()['misses'] == misses + 1
+
+    def test_post_fragment_cache(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body='post from john', author=u1, timestamp=datetime.utcnow())
+        p2 = Post(body='post from susan', author=u2, timestamp=datetime.utcnow())
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        john, susan, p1_id = u1.id, u2.id, p1.id
+        self.login_id(john)
+        hits, misses = post_fragments.hits, post_fragments.misses
+        assert b'post from john' in self.app.get('/user/john').data
+        assert post_fragments.misses == misses + 1 and post_fragments.hits == hits
+        response = self.app.get('/user/john')
+        assert post_fragments.hits == hits + 1 and b'Delete' in response.data
+        # another viewer doesn't get the author's Delete link
+        self.login_id(susan)
+        response = self.app.get('/user/john')
+        assert b'post from john' in response.data and b'Delete' not in response.data
+        assert len(post_fragments) == 2
+        # following someone and being seen don't change the posts
+        u1, u2 = User.query.get(john), User.query.get(susan)
+        db.session.add(u1.follow(u2))
+        u1.last_seen = datetime.utcnow()
+        db.session.commit()
+        assert len(post_fragments) == 2
+        # changing the nickname throws out the posts of the user
+        self.login_id(john)
+        self.app.post('/edit', data={'nickname': 'johnny', 'about_me': ''})
+        assert len(post_fragments) == 0
+        assert b'>johnny</a>' in self.app.get('/user/johnny').data
+        # and so does deleting the post
+        self.app.get('/delete/{}'.format(p1_id))
+        assert len(post_fragments) == 0
+        assert b'post from john' not in self.app.get('/user/johnny').data
+        assert 0 < post_fragments.hit_ratio() < 1
+
+    def test_conditional_get(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(u.follow(u))
+        db.session.add(Post(body='first post', author=u, timestamp=datetime.utcnow() - timedelta(minutes=5)))
+        db.session.commit()
+        timeline.backfill()
+        self.login(u)
+        etags = {}
+        for url in ('/index', '/user/john'):
+            response = self.app.get(url)
+            etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+            etags[url] = etag
+            assert response.status_code == 200 and etag and last_modified
+            # nothing has changed, so the page is neither queried nor rendered again
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304 and response.data == b''
+            # If-Modified-Since alone doesn't see deleted posts or profile changes, it's not enough for a 304
+            response = self.app.get(url, headers={'If-Modified-Since': last_modified})
+            assert response.status_code == 200
+        # a new post changes both pages
+        response = self.app.post('/index', data={'post': 'second post'})
+        self.app.get('/index')  # shows the flashed message
+        language_detector.join()
+        for url in ('/index', '/user/john'):
+            response = self.app.get(url, headers={'If-None-Match': etags[url]})
+            assert response.status_code == 200 and b'second post' in response.data
+        # and so does a change of the profile
+        etag = self.app.get('/user/john').headers['ETag']
+        self.app.post('/edit', data={'nickname': 'john', 'about_me': 'new about me'})
+        self.app.get('/user/john')
+        response = self.app.get('/user/john', headers={'If-None-Match': etag})
+        assert response.status_code == 200 and b'new about me' in response.data
+        # deleting a post that is not the newest one changes the pages, and so does a detected language
+        first_post = Post.query.filter_by(body='first post').one()
+        for url in ('/index', '/user/john'):
+            response = self.app.get(url)
+            etags[url], last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        LanguageDetector().classify([first_post.id])
+        for url in ('/index', '/user/john'):
+            assert self.app.get(url, headers={'If-None-Match': etags[url]}).status_code == 200
+            etags[url] = self.app.get(url).headers['ETag']
+        self.app.get('/delete/{}'.format(first_post.id))
+        self.app.get('/index')  # shows the flashed message
+        for url in ('/index', '/user/john'):
+            response = self.app.get(url, headers={'If-None-Match': etags[url]})
+            assert response.status_code == 200 and b'first post' not in response.data
+            response = self.app.get(url, headers={'If-Modified-Since': last_modified})
+            assert response.status_code == 200 and b'first post' not in response.data
+
+    def test_api(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        for u in (u1, u2, u3):
+            db.session.add(u.follow(u))
+        db.session.add(u2.follow(u1))
+        db.session.add(u3.follow(u1))
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u1, timestamp=now + timedelta(seconds=i))
+                            for i in range(5)])
+        db.session.commit()
+        timeline.backfill()
+        self.login(u2)
+        # the timeline of susan, two posts at a time, following the cursors
+        bodies = []
+        url = '/api/v1/timeline?limit=2'
+        while url:
+            response = self.app.get(url)
+            assert response.status_code == 200
+            page = json.loads(response.data.decode('utf-8'))
+            bodies += [post['body'] for post in page['posts']]
+            assert all(post['author']['nickname'] == 'john' for post in page['posts'])
+            url = page['next_url']
+        assert bodies == ['post 4', 'post 3', 'post 2', 'post 1', 'post 0']
+        # the same list as NDJSON, from a cursor on
+        response = self.app.get('/api/v1/timeline?limit=2')
+        cursor = json.loads(response.data.decode('utf-8'))['next']
+        response = self.app.get('/api/v1/users/john/posts?format=ndjson&before=' + cursor)
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.data.decode('utf-8').splitlines()
+        assert [json.loads(line)['body'] for line in lines] == ['post 2', 'post 1', 'post 0']
+        # the followers of john
+        response = self.app.get('/api/v1/users/john/followers?limit=1')
+        page = json.loads(response.data.decode('utf-8'))
+        assert [f['nickname'] for f in page['followers']] == ['susan']
+        page = json.loads(self.app.get(page['next_url']).data.decode('utf-8'))
+        assert [f['nickname'] for f in page['followers']] == ['mary'] and page['next'] is None
+        response = self.app.get('/api/v1/users/john/followers?format=ndjson')
+        assert len(response.data.decode('utf-8').splitlines()) == 2
+        assert self.app.get('/api/v1/users/nobody/posts').status_code == 404
+
+    def test_benchmarks(self):
+        counts = datagen.generate(users=50, follows=5, posts=4, seed=1)
+        assert User.query.count() == 70 and Post.query.count() == counts['posts'] > 0
+        # the nickname of the make_unique_nickname benchmark is taken, with the suffixes up to 20
+        assert User.make_unique_nickname(datagen.COLLIDING_NICKNAME) == datagen.COLLIDING_NICKNAME + '21'
+        # everybody follows himself, and the most popular user has many more followers than the average one
+        follower_counts = sorted(User.query.get(i).follower_count() for i in range(1, 51))
+        assert follower_counts[0] >= 1 and follower_counts[-1] > 2 * counts['follows'] / 50
+        assert search_posts('flask')[0]     # the full text index was rebuilt
+        results = runner.run(iterations=3, warmup=1, viewers=4)
+        assert results['data'] == counts
+        for name in ('index', 'index_deep', 'user', 'followed_posts', 'make_unique_nickname'):
+            result = results['results'][name]
+            assert result['calls'] == 3 and result['errors'] == 0
+            assert 0 < result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+            assert result['sql_max'] >= 1
+        assert runner.percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95) == 10
+        slower = json.loads(json.dumps(results))
+        slower['results']['index']['p50_ms'] *= 2
+        lines, regressions = compare(results, slower)
+        assert regressions == ['index'] and len(lines) == len(results['results']) + 1
+
+    def test_metrics(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        metrics.clear()
+        self.app.get('/user/john')
+        self.app.get('/user/john')
+        # the metrics are only for the administrators
+        assert self.app.get('/metrics').status_code == 404
+        app.config['ADMIN_TOKEN'] = 'secret'
+        try:
+            response = self.app.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        finally:
+            app.config['ADMIN_TOKEN'] = None
+        assert response.status_code == 200
+        text = response.data.decode('utf-8')
+        assert 'microblog_request_duration_seconds_count{endpoint="user"} 2' in text
+        assert 'microblog_request_duration_seconds_bucket{endpoint="user",le="+Inf"} 2' in text
+        assert 'microblog_responses_total{endpoint="metrics_view",status="404"} 1' in text
+        assert 'microblog_sql_statements_total{endpoint="user"}' in text
+        assert 'microblog_template_seconds_total{endpoint="user"}' in text
+        assert 'microblog_mail_queue_depth 0' in text and 'microblog_translate_queue_depth 0' in text
+        # slow requests are logged with their SQL statements
+        messages = []
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        app.logger.warning, default_warning = messages.append, app.logger.warning
+        try:
+            self.app.get('/user/john')
+        finally:
+            app.logger.warning = default_warning
+            app.config['SLOW_REQUEST_THRESHOLD'] = 1.0
+        assert len(messages) == 1 and 'GET /user/john' in messages[0] and 'SELECT' in messages[0]
+        # statements outside a real request, and statements that fail, leave nothing behind on the connection
+        with app.test_request_context():
+            User.query.count()
+            self.assertRaises(OperationalError, db.session.execute, 'SELECT * FROM no_such_table')
+            db.session.rollback()
+        with db.engine.connect() as connection:
+            assert not connection.info.get('metrics_start')
+
+    def test_sampler(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        headers = {'Authorization': 'Bearer secret'}
+        app.config['ADMIN_TOKEN'] = 'secret'
+        try:
+            assert self.app.post('/admin/profiler/start?percent=100&seconds=60').status_code == 404
+            # a logged in administrator without the token can look, but not switch the profiler on (CSRF)
+            decorators.ADMINS.append('john@example.com')
+            try:
+                assert self.app.get('/admin/profiler').status_code == 200
+                assert self.app.post('/admin/profiler/start?percent=100&seconds=60').status_code == 404
+                assert not sampler.is_active()
+            finally:
+                decorators.ADMINS.remove('john@example.com')
+            response = self.app.post('/admin/profiler/start?percent=100&seconds=60&clear=1', headers=headers)
+            assert json.loads(response.data.decode('utf-8'))['active']
+            sampler.interval = 0.001
+            # keep the server busy until we have a few samples
+            for i in range(500):
+                self.app.get('/user/john')
+                if sampler.samples >= 5:
+                    break
+            self.app.post('/admin/profiler/stop', headers=headers)
+            assert not sampler.is_active() and sampler.samples >= 5
+            response = self.app.get('/admin/profiler/stacks?endpoint=user', headers=headers)
+        finally:
+            app.config['ADMIN_TOKEN'] = None
+        assert 'attachment' in response.headers['Content-Disposition']
+        lines = response.data.decode('utf-8').splitlines()
+        assert lines and all(line.startswith('user;') for line in lines)
+        assert any('app.views.user' in line for line in lines)
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == sampler.samples
+
+    def test_read_write_split(self):
+        with db.engine.connect() as connection:
+            assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.execute('PRAGMA synchronous').scalar() == 1     # NORMAL
+            assert connection.execute('PRAGMA busy_timeout').scalar() == app.config['SQLITE_BUSY_TIMEOUT']
+        john = User(nickname='john', email='john@example.com')
+        db.session.add(john)
+        db.session.add(User(nickname='david', email='david@example.com'))
+        db.session.commit()
+        self.login(john)
+        # a replica with other users than the main database, so we can see where the reads went
+        path = os.path.join(basedir, 'test_replica.db')
+        replica = create_engine('sqlite:///' + path)
+        db.Model.metadata.create_all(replica)
+        replica.execute(User.__table__.insert(), [{'nickname': 'john', 'email': 'john@example.com'},
+                                                  {'nickname': 'susan', 'email': 'susan@example.com'}])
+        app.config['SQLALCHEMY_READ_URI'] = 'sqlite:///' + path
+        try:
+            assert 'susan' in self.app.get('/user/susan').data.decode('utf-8')      # read-only view, the replica
+            assert self.app.get('/user/david').status_code == 302
+            self.app.get('/follow/david')                                           # writes, the main database
+            db.session.remove()
+            david = User.query.filter_by(nickname='david').one()
+            assert User.query.filter_by(nickname='john').one().is_following(david)
+            # the read connections can't write
+            with db.get_read_engine(app).connect() as connection:
+                self.assertRaises(OperationalError, connection.execute, User.__table__.delete())
+            # a write that doesn't get the write lock in time fails, instead of going ahead without it
+            holder = threading.Thread(target=db.write_lock.lock.acquire)
+            holder.start()
+            holder.join()
+            timeout, db.write_lock.timeout = db.write_lock.timeout, 0.05
+            timeouts = db.write_lock.timeouts
+            try:
+                with db.engine.connect() as connection:
+                    self.assertRaises(TimeoutError, connection.execute, User.__table__.delete())
+                assert db.write_lock.timeouts == timeouts + 1 and User.query.count() == 2
+            finally:
+                db.write_lock.timeout = timeout
+                db.write_lock.lock = threading.RLock()     # the thread that took it is gone
+        finally:
+            db.get_read_engine(app).dispose()
+            app.config['SQLALCHEMY_READ_URI'] = None
+            replica.dispose()
+            os.remove(path)
+
+    def test_query_plans(self):
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        db.session.add_all([john.follow(john), john.follow(susan), susan.follow(susan)])
+        db.session.add(Post(body='post from susan', author=susan, timestamp=datetime.utcnow()))
+        db.session.commit()
+        # none of the hot queries reads a whole table, and the paged ones read the page in the order of an index
+        assert queryplan.check(john, susan) == {}
+        # while this one does read the whole table
+        plan = queryplan.explain(Post.query.filter(Post.body == 'post from susan'))
+        assert len(queryplan.table_scans(plan)) == 1
+        # and the home page sorted by the columns of the post table sorts the whole timeline of the user
+        plan = queryplan.explain(newest_first(timeline.home_timeline(john)).limit(10))
+        assert queryplan.temp_sorts(plan) == ['USE TEMP B-TREE FOR ORDER BY']
+
+    def test_bulk_import(self):
+        john = User(nickname='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        directory = tempfile.mkdtemp()
+        users = os.path.join(directory, 'users.ndjson')
+        follows = os.path.join(directory, 'follows.csv')
+        posts = os.path.join(directory, 'posts.ndjson')
+        with open(users, 'w') as f:
+            for row in [{'nickname': 'john', 'email': 'john@example.com'},      # already in the database
+                        {'nickname': 'john', 'email': 'john@example.org'},
+                        {'nickname': 'susan', 'email': 'susan@example.com', 'about_me': 'Hi!'},
+                        {'nickname': 'susan', 'email': 'susan@example.org'},
+                        {'email': 'david@example.com', 'last_seen': '2014-12-19T10:30:11Z'}]:
+                f.write(json.dumps(row) + '\n')
+        with open(follows, 'w') as f:
+            f.write('follower,followed\n'
+                    'john@example.com,susan@example.com\n'
+                    'david@example.com,susan@example.com\n'
+                    'david@example.com,nobody@example.com\n')
+        with open(posts, 'w') as f:
+            for i in range(5):
+                f.write(json.dumps({'email': 'susan@example.com', 'body': 'imported post {}'.format(i),
+                                    'timestamp': '2014-12-19 10:30:1{}'.format(i)}) + '\n')
+        try:
+            results = bulkload.import_files({'users': users, 'follows': follows, 'posts': posts}, batch_size=2)
+            assert [results[kind]['inserted'] for kind in ('users', 'follows', 'posts')] == [4, 2, 5]
+            assert results['users']['skipped'] == 1 and results['follows']['skipped'] == 1
+            nicknames = dict(db.session.query(User.email, User.nickname))
+            assert nicknames['john@example.org'] == 'john2'
+            assert nicknames['susan@example.com'] == 'susan' and nicknames['susan@example.org'] == 'susan2'
+            assert nicknames['david@example.com'] == 'david'
+            susan = User.query.filter_by(email='susan@example.com').one()
+            assert susan.is_following(susan) and john.is_following(susan) and susan.follower_count() == 3
+            # the deferred indexes, the search index and the timelines are built again
+            assert 'ix_post_user_id_timestamp' in [ix['name'] for ix in inspect(db.engine).get_indexes('post')]
+            assert len(search_posts('imported', per_page=10)[0]) == 5
+            assert timeline.home_timeline(john).count() == 5
+            assert bulkload.read_checkpoint('posts', posts) == 0
+            # an interrupted import continues after the last committed batch, and imports no post twice
+            with open(posts, 'w') as f:
+                for i in range(5):
+                    f.write(json.dumps({'email': 'susan@example.com', 'body': 'second post {}'.format(i)}) + '\n')
+            load_posts = bulkload.LOADERS['posts']
+            calls = []
+
+            def interrupted(connection, rows):
+                inserted = load_posts(connection, rows)
+                calls.append(inserted)
+                if len(calls) == 2:
+                    raise KeyboardInterrupt     # after the insert, the batch and its checkpoint are rolled back
+                return inserted
+            bulkload.LOADERS['posts'] = interrupted
+            try:
+                self.assertRaises(KeyboardInterrupt, bulkload.load_file, 'posts', posts, batch_size=2)
+            finally:
+                bulkload.LOADERS['posts'] = load_posts
+            assert bulkload.read_checkpoint('posts', posts) == 2
+            stats = bulkload.load_file('posts', posts, batch_size=2)
+            assert stats['resumed_at'] == 2 and stats['inserted'] == 3
+            assert Post.query.filter(Post.body.startswith('second post')).count() == 5
+            assert bulkload.read_checkpoint('posts', posts) == 0
+            assert User.make_unique_nicknames(['john', 'john', 'mary']) == ['john3', 'john4', 'mary']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_export(self):
+        john = User(nickname='john', email='john@example.com', about_me='Hi!')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        db.session.add_all([john.follow(john), susan.follow(susan), susan.follow(john), john.follow(susan)])
+        now = datetime.utcnow()
+        for i in range(5):
+            db.session.add(Post(body='post {}'.format(i), author=john, timestamp=now + timedelta(seconds=i)))
+        db.session.add(Post(body='not john', author=susan, timestamp=now))
+        db.session.commit()
+        john_id = john.id
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        app.config['EXPORT_CHUNK_SIZE'] = 10
+        try:
+            self.login(susan)
+            assert self.app.get('/user/john/export').status_code == 403     # not your data
+            self.login_id(john_id)
+            response = self.app.get('/user/john/export')
+            assert response.mimetype == 'application/x-ndjson'
+            rows = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+            assert [row['type'] for row in rows] == ['user'] + ['post'] * 5 + ['follower', 'followed']
+            assert rows[0]['about_me'] == 'Hi!' and rows[1]['body'] == 'post 4'
+            assert rows[6]['nickname'] == rows[7]['nickname'] == 'susan'
+            response = self.app.get('/user/john/export?format=csv&gzip=1')
+            assert response.headers['Content-Disposition'] == \
+                'attachment; filename="microblog-john.csv.gz"; filename*=UTF-8\'\'microblog-john.csv.gz'
+            # a nickname with quotes, slashes or non-ASCII letters doesn't get into the header or the path as it is
+            user = User(nickname='j\u00f6hn "x"; ../y')
+            assert export.filename(user, 'csv', False) == 'microblog-john_x_.._y.csv'
+            assert export.content_disposition(user, 'csv', False) == \
+                'attachment; filename="microblog-john_x_.._y.csv"; ' \
+                'filename*=UTF-8\'\'microblog-j%C3%B6hn%20%22x%22%3B%20..%2Fy.csv'
+            lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+            assert lines[0] == ','.join(export.CSV_COLUMNS) and len(lines) == 9
+            assert lines[2].startswith('post,') and ',post 4,' in lines[2]
+            assert b''.join(export.export(User.query.get(john_id))).decode('utf-8') == \
+                '\n'.join(json.dumps(row) for row in rows) + '\n'
+        finally:
+            app.config['EXPORT_BATCH_SIZE'] = 1000
+            app.config['EXPORT_CHUNK_SIZE'] = 64 * 1024
+
+    def test_post_archive(self):
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        db.session.add_all([john.follow(john), susan.follow(susan), susan.follow(john)])
+        now = datetime.utcnow()
+        for i in range(5):
+            db.session.add(Post(body='old post {}'.format(i), author=john,
+                                timestamp=now - timedelta(days=400, seconds=-i)))
+        for i in range(2):
+            db.session.add(Post(body='new post {}'.format(i), author=john, timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        timeline.backfill()
+        john_id = john.id
+        expected = ['new post 1', 'new post 0'] + ['old post {}'.format(i) for i in range(4, -1, -1)]
+        assert archive.archive_posts(batch_size=2) == 5
+        assert Post.query.count() == 2 and ArchivedPost.query.count() == 5
+        assert db.session.query(timeline.timeline).count() == 4     # the new posts, in two timelines
+        # still searchable, from the full text index of the archive
+        assert sorted(p.body for p in search_posts('old', per_page=10)[0]) == \
+            ['old post {}'.format(i) for i in range(5)]
+        # a post older than the archived ones can be in the post table (imported, or not archived yet)
+        john = User.query.get(john_id)
+        post = Post(body='older post', author=john, timestamp=now - timedelta(days=500))
+        db.session.add(post)
+        db.session.flush()
+        timeline.fan_out(post)
+        db.session.commit()
+        expected.append('older post')
+        # the pages go on into the archive, in both directions, with the posts of both in the right order
+        archived = post_rows(archive.user_posts(john), ArchivedPost)
+        pages = [KeysetPage(post_rows(john.posts), 3, archive=archived)]
+        while pages[-1].has_older:
+            pages.append(KeysetPage(post_rows(john.posts), 3, before=pages[-1].older_cursor, archive=archived))
+        assert [[p.body for p in page.items] for page in pages] == [expected[0:3], expected[3:6], expected[6:8]]
+        back = KeysetPage(post_rows(john.posts), 3, after=pages[2].newer_cursor, archive=archived)
+        assert [p.body for p in back.items] == expected[3:6] and back.has_newer
+        newest = KeysetPage(post_rows(john.posts), 3, after=back.newer_cursor, archive=archived)
+        assert [p.body for p in newest.items] == expected[0:3] and not newest.has_newer
+        self.login(susan)
+        response = self.app.get('/index')
+        assert b'new post 0' in response.data and b'old post 4' in response.data
+        response = self.app.get('/user/john')
+        assert b'old post 4' in response.data and b'old post 3' not in response.data
+        # the API and the export have all of them
+        bodies = []
+        url = '/api/v1/timeline?limit=3'
+        while url:
+            page = json.loads(self.app.get(url).data.decode('utf-8'))
+            bodies += [post['body'] for post in page['posts']]
+            url = page['next_url']
+        assert bodies == expected
+        response = self.app.get('/api/v1/users/john/posts?format=ndjson')
+        assert [json.loads(line)['body'] for line in response.data.decode('utf-8').splitlines()] == expected
+        rows = [json.loads(line) for line in b''.join(export.export(john)).decode('utf-8').splitlines()]
+        assert [row['body'] for row in rows if row['type'] == 'post'] == expected
+        # the author can delete an archived post, nobody else can
+        post_id = ArchivedPost.query.filter_by(body='old post 4').one().id
+        version = User.query.get(john_id).posts_version
+        self.app.get('/delete/{}'.format(post_id))
+        assert ArchivedPost.query.get(post_id) is not None
+        self.login_id(john_id)
+        self.app.get('/delete/{}'.format(post_id))
+        assert ArchivedPost.query.get(post_id) is None
+        assert User.query.get(john_id).posts_version > version      # the pages with the post have changed
+        assert [p.body for p in search_posts('old', per_page=10)[0]].count('old post 4') == 0
+        assert b'old post 4' not in self.app.get('/user/john').data
+        # the whole post table can be archived, a new post doesn't get the id of an archived one
+        newest_id = db.session.query(db.func.max(Post.id)).scalar()
+        assert archive.archive_posts(age_days=-1) == 3 and Post.query.count() == 0
+        assert len(search_posts('post', per_page=10)[0]) == 7
+        post = Post(body='newer post', author=User.query.get(john_id), timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+        assert post.id > newest_id
+
 
 from coverage import coverage
 # This will make our tests run with 'coverage', so that at the end we get a report of how much of our code
@@ -0,0 +1,11 @@
+#!/home/dkovac/virtualenv/python3.4_flask/bin/python
+# This script (re)builds the materialized home timelines (see app/timeline.py) from the followers and post tables.
+# Run it once after switching TIMELINE_ENABLED on for a database that already has posts, or any time you suspect
+# the timelines got out of sync.
+# The work is committed in batches, so the application can keep running while this script is working.
+import sys
+from app import timeline
+
+batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+users = timeline.backfill(batch_size)
+print('Timelines rebuilt for {} users.'.format(users))